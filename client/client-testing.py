@@ -1,30 +1,97 @@
 from utils.client_com import Client
+from utils.command_executor import CommandExecutor
+from utils.client_logger import configure_logging
+from utils.rx_engine import RXEngine, SimulatedRXStreamer
+from utils.rx_capture import RXCapture
+import logging
 import signal
 import time
 import sys
 import argparse, shlex
 from datetime import datetime, timezone, timedelta
-import uhd
 import numpy as np
 import yaml
 
 """Parse the command line arguments"""
 parser = argparse.ArgumentParser()
 parser.add_argument("--config-file", type=str)
+parser.add_argument("--simulate", action="store_true", help="Use a simulated device instead of the USRP")
+parser.add_argument("--capture-dir", type=str, help="Record every capture to this directory (SigMF)")
+parser.add_argument("--time-source", choices=("host", "external"), default="host",
+                    help="Set the USRP time from the host clock, or on the shared PPS (with the 10 MHz reference)")
 
 args = parser.parse_args()
 
 client = None 
-got_start = False
 
+########################################
+# RX parameters
+########################################
+CENTER_FREQ = 915e6      # Hz
+SAMPLE_RATE = 1e6        # Hz
+GAIN = 30                # dB
+CHANNEL = 0              # RX channel 0 = first channel on B210
 
-def handle_usrp_sync(command, args):
-    print("Received usrp_sync command:", command, args)
-    
-    client.send("usrp_ack")
-    global got_start
-    
-    got_start = True
+
+def setup_rx():
+    """Return the RX streamer and a function returning the current device time."""
+    if args.simulate:
+        # the simulated device runs on the wall clock
+        return SimulatedRXStreamer(sample_rate=SAMPLE_RATE, tone_freq=100e3), time.time
+
+    import uhd
+
+    usrp = uhd.usrp.MultiUSRP("")
+    if args.time_source == "external":
+        usrp.set_clock_source("external")
+        usrp.set_time_source("external")
+    usrp.set_rx_rate(SAMPLE_RATE, CHANNEL)
+    usrp.set_rx_freq(CENTER_FREQ, CHANNEL)
+    usrp.set_rx_gain(GAIN, CHANNEL)
+    # Give hardware time to lock PLLs
+    time.sleep(0.1)
+    set_device_time(usrp, uhd)
+    rx_streamer = usrp.get_rx_stream(uhd.usrp.StreamArgs("fc32", "sc16"))
+    return rx_streamer, lambda: usrp.get_time_now().get_real_secs()
+
+
+def set_device_time(usrp, uhd):
+    """
+    Set the USRP time to the host's wall clock, so that every tile's device
+    time runs on the same (server synchronized) time scale.
+
+    With the external time source the time is set on a PPS edge: tiles
+    sharing the PPS then have exactly the same device time, as long as their
+    host clocks agree within half a second (NTP).
+    """
+    if args.time_source == "host":
+        # as accurate as the host clock (and this call's latency)
+        usrp.set_time_now(uhd.types.TimeSpec(time.time()))
+        return
+
+    deadline = time.monotonic() + CLOCK_TIMEOUT / 1000
+    while not usrp.get_mboard_sensor("ref_locked", 0).to_bool():
+        if time.monotonic() > deadline:
+            raise RuntimeError("USRP did not lock to the external reference")
+        time.sleep(0.01)
+
+    # right after a PPS edge, so the next one is the host's next whole second
+    last_pps = usrp.get_time_last_pps().get_real_secs()
+    while usrp.get_time_last_pps().get_real_secs() == last_pps:
+        time.sleep(0.01)
+    usrp.set_time_next_pps(uhd.types.TimeSpec(round(time.time()) + 1.0))
+    # wait for that PPS to latch the time
+    time.sleep(1.1)
+
+
+def make_sync_handler(capture):
+    def handle_usrp_sync(ctx):
+        # runs on a worker thread; the executor already sent usrp_ack and sends
+        # usrp_done with the capture's result (or usrp_error) when this returns (or raises)
+        print("Received usrp_sync command:", ctx.command, ctx.args)
+        return capture.handle(ctx)
+
+    return handle_usrp_sync
 
 
 def handle_signal(signum, frame):
@@ -35,25 +102,32 @@ def handle_signal(signum, frame):
 signal.signal(signal.SIGINT, handle_signal)
 signal.signal(signal.SIGTERM, handle_signal)
 
-CLOCK_TIMEOUT = 1000  # 1000mS timeout for external clock locking
+CLOCK_TIMEOUT = 1000  # 1000mS timeout for external clock locking (see set_device_time)
 
 
 if __name__ == "__main__":
+    # log from a background thread, keep per-message debug output in check and
+    # dump the recent debug history when an error is logged
+    configure_logging(async_mode=True, console_level=logging.INFO, rate_limit=10,
+                      ring_buffer_bytes=1 << 20)
     client = Client(args.config_file)
-    client.on("usrp_sync", handle_usrp_sync)
+    rx_streamer, device_time = setup_rx()
+    # arms the streamer on the start time of the command, the same device
+    # time on every tile (the device time is set in setup_rx)
+    capture = RXCapture(RXEngine(rx_streamer), device_time, client,
+                        sample_rate=SAMPLE_RATE, center_freq=CENTER_FREQ, gain=GAIN, capture_dir=args.capture_dir)
+    executor = CommandExecutor(client)
+    executor.register("usrp_sync", make_sync_handler(capture))
     client.start()
     print("Client running...")
     
     try:
         while client.running:
-            if got_start:
-                got_start = False
-                time.sleep(5)
-                client.send("usrp_done")
             time.sleep(0.1)
     except KeyboardInterrupt:
         pass
 
+    executor.shutdown()
     client.stop()
     client.join()
     print("Client terminated.")
@@ -0,0 +1,81 @@
+from utils.client_com import Client
+import argparse
+import logging
+import random
+import signal
+import time
+import zmq
+
+"""
+Run a swarm of simulated tiles in a single process.
+
+Every simulated tile is a regular Client with a fake 'rpi-<ID>' hostname. It
+acknowledges each usrp_* command immediately and reports usrp_done after a
+fake work delay. Used by server/load-test.py to measure the control plane
+without real tiles.
+"""
+
+"""Parse the command line arguments"""
+parser = argparse.ArgumentParser()
+parser.add_argument("--config-file", type=str, required=True)
+parser.add_argument("--ids", nargs="+", required=True, help="Tile IDs to simulate")
+parser.add_argument("--work-delay", type=float, default=0.0, help="Mean fake work time before usrp_done [s]")
+parser.add_argument("--work-jitter", type=float, default=0.0, help="Uniform +/- jitter on the work time [s]")
+
+args = parser.parse_args()
+
+COMMANDS = ("usrp_sync", "usrp_pilot")
+
+running = True
+
+
+def handle_signal(signum, frame):
+    global running
+    running = False
+
+
+signal.signal(signal.SIGINT, handle_signal)
+signal.signal(signal.SIGTERM, handle_signal)
+
+
+def make_handler(client):
+    def handle_command(command, cmd_args):
+        client.respond("usrp_ack", cmd_args)
+        delay = args.work_delay + random.uniform(-args.work_jitter, args.work_jitter)
+        if delay > 0:
+            # blocks only this tile's event loop, like a real tile doing the work
+            time.sleep(delay)
+        client.respond("usrp_done", cmd_args)
+
+    return handle_command
+
+
+if __name__ == "__main__":
+    # Client loggers are created at DEBUG level; keep thousands of tiles quiet
+    logging.disable(logging.INFO)
+
+    # one context (and I/O thread) for the whole swarm instead of one per tile
+    context = zmq.Context()
+    # per tile: DEALER, SUB and wake PULL, plus the PUSH wake socket of every
+    # other thread that sends through it or stops it (the main thread here)
+    context.set(zmq.MAX_SOCKETS, 4 * len(args.ids) + 64)
+
+    clients = []
+    for tile_id in args.ids:
+        client = Client(args.config_file, hostname=f"rpi-{tile_id}", context=context)
+        for command in COMMANDS:
+            client.on(command, make_handler(client))
+        client.start()
+        clients.append(client)
+
+    try:
+        while running:
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+
+    for client in clients:
+        client.stop()
+    for client in clients:
+        client.join()
+    context.term()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the client scripts import their helpers as the top-level "utils" package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
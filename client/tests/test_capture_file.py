@@ -0,0 +1,53 @@
+import numpy as np
+
+from utils.capture_file import CaptureFile, CaptureWriter
+
+SAMPLE_RATE = 1000.0
+BLOCK = 100
+
+
+def write_blocks(path, timestamps, discontinuities=None):
+    """Write BLOCK-sample blocks numbered 0, 1, ... at the given timestamps."""
+    with CaptureWriter(path, SAMPLE_RATE, tile_id="A05") as writer:
+        for i, timestamp in enumerate(timestamps):
+            samples = np.full(BLOCK, i, dtype=np.complex64)
+            writer.write(samples, timestamp, bool(discontinuities and discontinuities[i]))
+    return CaptureFile(path)
+
+
+def test_read_time_contiguous(tmp_path):
+    capture = write_blocks(str(tmp_path / "c"), [10.0, 10.1, 10.2])
+    samples = capture.read_time(10.05, 0.2)
+    assert len(samples) == 200
+    assert samples[0] == 0 and samples[-1] == 2
+
+
+def test_read_stops_at_timestamp_gap(tmp_path):
+    # 0.5 s of samples missing between the second and third block
+    capture = write_blocks(str(tmp_path / "c"), [10.0, 10.1, 10.7])
+    assert list(capture.boundaries) == [200]
+
+    samples = capture.read_time(10.15, 0.2)
+    assert len(samples) == 50
+    assert np.all(samples == 1)
+    assert len(capture.read(150, 1000)) == 50
+    # reads from after the gap start at the right sample
+    samples = capture.read_time(10.75, 0.01)
+    assert len(samples) == 10 and np.all(samples == 2)
+
+
+def test_read_stops_at_discontinuity(tmp_path):
+    # flagged by the streamer (e.g. an overflow) without timestamps
+    with CaptureWriter(str(tmp_path / "c"), SAMPLE_RATE) as writer:
+        for i in range(3):
+            writer.write(np.full(BLOCK, i, dtype=np.complex64), discontinuity=(i == 2))
+    capture = CaptureFile(str(tmp_path / "c"))
+    assert [c["core:sample_start"] for c in capture.captures] == [0, 200]
+    assert len(capture.read(0, 300)) == 200
+    assert len(capture.read(200, 300)) == 100
+
+
+def test_read_time_in_gap(tmp_path):
+    capture = write_blocks(str(tmp_path / "c"), [10.0, 10.7])
+    assert capture.sample_at(10.3) is None
+    assert len(capture.read_time(10.3, 0.1)) == 0
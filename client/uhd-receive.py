@@ -1,12 +1,35 @@
 #!/usr/bin/env python3
-import uhd
-import numpy as np
+from utils.rx_engine import RXEngine, SimulatedRXStreamer
+from utils.rx_stats import RXStats, RXStatsReporter
+from utils.capture_file import CaptureWriter
+import collections
+import argparse
 import time
 import os
 import sys
 
+"""Parse the command line arguments"""
+parser = argparse.ArgumentParser()
+parser.add_argument("--config-file", type=str, help="Experiment settings (required with --stream)")
+parser.add_argument("--stream", action="store_true", help="Publish the received samples to the server")
+parser.add_argument("--continuous", action="store_true", help="Receive until Ctrl+C instead of NUM_SAMPS samples")
+parser.add_argument("--simulate", action="store_true", help="Use a simulated device instead of the USRP")
+parser.add_argument("--output", type=str,
+                    help="Record the samples to OUTPUT.sigmf-data/-meta (the measurement goes into the metadata)")
+parser.add_argument("--report-interval", type=float, default=0.0,
+                    help="Report the RX statistics to the server every REPORT_INTERVAL seconds (0: off)")
+
+args = parser.parse_args()
+
+if args.stream and not args.config_file:
+    parser.error("--stream requires --config-file")
+if args.report_interval and not args.config_file:
+    parser.error("--report-interval requires --config-file")
+
 # check if UHD_IMAGES_DIR is set, no use in continuing otherwise because failure is guaranteed
-if os.environ.get("UHD_IMAGES_DIR"):
+if args.simulate:
+    pass
+elif os.environ.get("UHD_IMAGES_DIR"):
     print(os.environ.get("UHD_IMAGES_DIR"))
 else:
     print("UHD_IMAGES_DIR not set")
@@ -24,62 +47,109 @@ SAMPLE_RATE = 1e6        # Hz
 GAIN = 30                # dB
 NUM_SAMPS = 100000       # Number of samples to capture
 CHANNEL = 0              # RX channel 0 = first channel on B210
+BLOCK_SAMPS = 10000      # Samples per block of the RX engine's ring
+NUM_BLOCKS = 64          # Blocks in the ring
 
 ########################################
-# Create USRP
+# Create USRP and RX streamer
 ########################################
-usrp = uhd.usrp.MultiUSRP(f"fpga={fpga_path}")
-
-# Set rate, frequency, gain
-usrp.set_rx_rate(SAMPLE_RATE, CHANNEL)
-usrp.set_rx_freq(CENTER_FREQ, CHANNEL)
-usrp.set_rx_gain(GAIN, CHANNEL)
+if args.simulate:
+    rx_streamer = SimulatedRXStreamer(sample_rate=SAMPLE_RATE, tone_freq=100e3)
+else:
+    import uhd
 
-# Give hardware time to lock PLLs
-time.sleep(0.1)
+    usrp = uhd.usrp.MultiUSRP(f"fpga={fpga_path}")
 
-########################################
-# Create RX streamer
-########################################
-stream_args = uhd.usrp.StreamArgs("fc32", "sc16")   # Complex float32 samples
-rx_streamer = usrp.get_rx_stream(stream_args)
+    # Set rate, frequency, gain
+    usrp.set_rx_rate(SAMPLE_RATE, CHANNEL)
+    usrp.set_rx_freq(CENTER_FREQ, CHANNEL)
+    usrp.set_rx_gain(GAIN, CHANNEL)
 
-# Buffer for samples
-buffer_samps = np.zeros((NUM_SAMPS,), dtype=np.complex64)
+    # Give hardware time to lock PLLs
+    time.sleep(0.1)
 
-########################################
-# Issue streaming command
-########################################
-stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.num_done)
-stream_cmd.num_samps = NUM_SAMPS
-stream_cmd.stream_now = True
-rx_streamer.issue_stream_cmd(stream_cmd)
+    stream_args = uhd.usrp.StreamArgs("fc32", "sc16")   # Complex float32 samples
+    rx_streamer = usrp.get_rx_stream(stream_args)
 
 ########################################
 # Receive samples
 ########################################
+engine = RXEngine(rx_streamer, block_samps=BLOCK_SAMPS, num_blocks=NUM_BLOCKS)
+
+publisher = None
+if args.stream:
+    from utils.iq_stream import IQPublisher
+    publisher = IQPublisher(args.config_file)
+# blocks being sent without copying, released once their samples left the socket
+sending = collections.deque()
+
+# statistics of the whole capture, measured as the blocks arrive
+stats = RXStats()
+client = reporter = None
+if args.report_interval:
+    from utils.client_com import Client
+    client = Client(args.config_file)
+    client.start()
+    reporter = RXStatsReporter(client, args.report_interval, center_freq=CENTER_FREQ, sample_rate=SAMPLE_RATE)
 num_rx = 0
-md = uhd.types.RXMetadata()
 
-while num_rx < NUM_SAMPS:
-    samps = rx_streamer.recv(buffer_samps[num_rx:], md, timeout=2.0)
-    num_rx += samps
-    if md.error_code != uhd.types.RXMetadataErrorCode.none:
-        print("RX error:", md.strerror())
-        break
+writer = None
+if args.output:
+    writer = CaptureWriter(args.output, SAMPLE_RATE, CENTER_FREQ, GAIN,
+                           capacity_samps=NUM_SAMPS, description="uhd-receive.py", overwrite=True)
+
+engine.start(num_samps=None if args.continuous else NUM_SAMPS)
+try:
+    for block in engine:
+        samples = block.samples if args.continuous else block.samples[:NUM_SAMPS - num_rx]
+        stats.update(samples)
+        if reporter is not None:
+            reporter.update(samples, block.timestamp)
+        num_rx += len(samples)
+        if writer is not None:
+            writer.write(samples, block.timestamp, block.discontinuity)
 
-print(f"Received {num_rx} samples")
+        if publisher is None:
+            block.release()
+        else:
+            tracker = publisher.publish(block.samples, block.timestamp, track=True,
+                                        sample_rate=SAMPLE_RATE, center_freq=CENTER_FREQ)
+            if tracker is False:
+                block.release()
+            else:
+                sending.append((block, tracker))
+            while sending and sending[0][1].done:
+                sending.popleft()[0].release()
+
+        if not args.continuous and num_rx >= NUM_SAMPS:
+            break
+except KeyboardInterrupt:
+    pass
+engine.stop()
+
+if publisher is not None:
+    publisher.close()
+if reporter is not None:
+    reporter.report()
+    client.stop()
+
+print(f"Received {engine.samples} samples ({engine.overflows} overflows, {engine.dropped} blocks dropped)")
 
 ########################################
 # Compute simple measurement
 ########################################
 # Power (RMS)
-rms = np.sqrt(np.mean(np.abs(buffer_samps[:num_rx])**2))
-power_db = 20 * np.log10(rms)
+result = stats.snapshot()
+rms = result["rms"] or 0.0
+power_db = result["power_dbfs"] if num_rx else float("-inf")
 
-with open("power.txt", "w") as f:
-    f.write(f"Measured RMS: {rms:.6f}\n")
-    f.write(f"Power (dBFS): {power_db:.2f} dBFS\n")
+if writer is not None:
+    writer.close(rx_stats=result)
+    print(f"Recorded {num_rx} samples to {writer.path}")
+else:
+    with open("power.txt", "w") as f:
+        f.write(f"Measured RMS: {rms:.6f}\n")
+        f.write(f"Power (dBFS): {power_db:.2f} dBFS\n")
 
 ########################################
 # Done
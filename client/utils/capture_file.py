@@ -0,0 +1,435 @@
+"""
+Capture files: raw samples with SigMF metadata and a seek index.
+
+A capture <name> consists of three files:
+
+    <name>.sigmf-data   the samples, back to back (SigMF dataset)
+    <name>.sigmf-meta   SigMF JSON metadata: datatype, sample rate, center
+                        frequency, gain, tile ID and a capture segment (with
+                        the hardware timestamp of its first sample) for every
+                        discontinuity in the stream
+    <name>.sigmf-index  one INDEX_DTYPE record per written block: its first
+                        sample and hardware timestamp, for seeking by time
+
+Any SigMF tool can read the data and metadata; the techtile: fields are a
+SigMF extension. CaptureWriter writes through a preallocated memory map that
+grows in steps, so recording costs one copy per block and no allocation.
+CaptureFile and CaptureSet open recordings lazily: metadata is parsed on
+first use and samples are memory-mapped, never read as a whole.
+
+    with CaptureWriter("data/A05-run1", sample_rate=1e6, center_freq=915e6, tile_id="A05") as writer:
+        for block in engine:
+            writer.write(block.samples, block.timestamp, block.discontinuity)
+            block.release()
+
+    captures = CaptureSet("data")
+    capture = captures["A05-run1"]              # by capture name
+    latest = captures.by_tile("A05")[-1]        # a tile's captures, oldest first
+    samples = captures.read_time(t0, 0.01)      # tile -> samples at hardware time t0
+"""
+import datetime
+import glob
+import json
+import os
+
+import numpy as np
+
+SIGMF_VERSION = "1.0.0"
+DATA_EXT = ".sigmf-data"
+META_EXT = ".sigmf-meta"
+INDEX_EXT = ".sigmf-index"
+
+INDEX_DTYPE = np.dtype([("sample", "<i8"), ("timestamp", "<f8")])
+
+# SigMF datatype -> (numpy dtype of the stored values, values per sample)
+DATATYPES = {
+    "cf32_le": (np.dtype("<c8"), 1),
+    "cf64_le": (np.dtype("<c16"), 1),
+    "ci16_le": (np.dtype("<i2"), 2),
+    "ci8": (np.dtype("i1"), 2),
+}
+
+# Samples the data file is preallocated (and grown) with by default
+DEFAULT_GROW_SAMPS = 1 << 22
+
+
+def sigmf_datatype(dtype):
+    """SigMF datatype of numpy samples: complex arrays, or interleaved integer I/Q (n, 2)."""
+    dtype = np.dtype(dtype)
+    for name, (stored, _) in DATATYPES.items():
+        # samples are stored little-endian, whatever their byte order in memory
+        if stored.kind == dtype.kind and stored.itemsize == dtype.itemsize:
+            return name
+    raise ValueError(f"No SigMF datatype for {dtype}")
+
+
+def _base(path):
+    for ext in (DATA_EXT, META_EXT, INDEX_EXT):
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+class CaptureWriter:
+    def __init__(self, path, sample_rate, center_freq=None, gain=None, tile_id=None, dtype=np.complex64,
+                 capacity_samps=DEFAULT_GROW_SAMPS, grow_samps=DEFAULT_GROW_SAMPS, description="", overwrite=False,
+                 **extra):
+        """
+        Parameters
+        ----------
+        path : str
+            Capture name (the file names without extension).
+        sample_rate : float
+            Sample rate [Hz].
+        center_freq : float, optional
+            Center frequency [Hz].
+        gain : float, optional
+            Receive gain [dB].
+        tile_id : str, optional
+            ID of the recording tile.
+        dtype : numpy.dtype
+            Sample type: complex64/complex128, or int16/int8 with samples as
+            (n, 2) interleaved I/Q.
+        capacity_samps : int
+            Samples the data file is preallocated for.
+        grow_samps : int
+            Samples the data file grows by when it is full.
+        description : str
+            Free text description of the capture.
+        overwrite : bool
+            Replace an existing capture of the same name instead of raising
+            FileExistsError.
+        **extra
+            Extra global metadata, stored as techtile:<key>.
+        """
+        self.path = _base(path)
+        self.datatype = sigmf_datatype(dtype)
+        self._stored, self._values = DATATYPES[self.datatype]
+        self.sample_bytes = self._stored.itemsize * self._values
+        self.grow_samps = grow_samps
+        self.center_freq = center_freq
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.meta = {
+            "global": {
+                "core:datatype": self.datatype,
+                "core:sample_rate": sample_rate,
+                "core:version": SIGMF_VERSION,
+                "core:description": description,
+                "core:extensions": [{"name": "techtile", "version": "1.0.0", "optional": True}],
+            },
+            "captures": [],
+            "annotations": [],
+        }
+        fields = dict(extra, tile=tile_id, gain=gain)
+        self.meta["global"].update({f"techtile:{k}": v for k, v in fields.items() if v is not None})
+
+        self.num_samps = 0
+        self.capacity = 0
+        self.map = None
+        self._next_timestamp = None
+        # "x": fail instead of truncating an earlier capture
+        self._data = open(self.path + DATA_EXT, "wb+" if overwrite else "xb+")
+        self._index = open(self.path + INDEX_EXT, "wb")
+        self._grow(max(capacity_samps, 1))
+        # metadata right away, so a capture that is not closed can still be read
+        self._write_meta()
+
+    def write(self, samples, timestamp=None, discontinuity=False):
+        """
+        Append a block of samples.
+
+        Parameters
+        ----------
+        samples : numpy.ndarray
+            Samples of the writer's dtype, shape (n,) (complex) or (n, 2).
+        timestamp : float, optional
+            Hardware time of the first sample [s].
+        discontinuity : bool
+            Samples were lost before this block. A new capture segment also
+            starts when the timestamp does not follow from the previous block.
+        """
+        n = samples.shape[0]
+        if n == 0:
+            return
+        if self.num_samps + n > self.capacity:
+            self._grow(max(self.grow_samps, self.num_samps + n - self.capacity))
+        values = samples.reshape(n, -1) if self._values == 2 else samples
+        self.map[self.num_samps:self.num_samps + n] = values
+
+        sample_rate = self.meta["global"]["core:sample_rate"]
+        expected = self._next_timestamp
+        if (not self.meta["captures"] or discontinuity
+                or (timestamp is not None and expected is not None and abs(timestamp - expected) > 0.5 / sample_rate)):
+            self._new_segment(timestamp)
+        if timestamp is not None:
+            np.array([(self.num_samps, timestamp)], dtype=INDEX_DTYPE).tofile(self._index)
+            self._next_timestamp = timestamp + n / sample_rate
+        else:
+            self._next_timestamp = None
+        self.num_samps += n
+
+    def annotate(self, sample_start, sample_count, label="", **fields):
+        """Add a SigMF annotation (e.g. a detected tone), extra fields as techtile:<key>."""
+        annotation = {"core:sample_start": sample_start, "core:sample_count": sample_count}
+        if label:
+            annotation["core:label"] = label
+        annotation.update({f"techtile:{k}": v for k, v in fields.items()})
+        self.meta["annotations"].append(annotation)
+
+    def close(self, **extra):
+        """Flush, trim the data file to the samples written and write the final metadata."""
+        if self._data is None:
+            return
+        self.meta["global"].update({f"techtile:{k}": v for k, v in extra.items()})
+        self.map.flush()
+        self.map = None  # unmaps the data file
+        self._data.truncate(self.num_samps * self.sample_bytes)
+        self._data.close()
+        self._data = None
+        self._index.close()
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _grow(self, samps):
+        if self.map is not None:
+            self.map.flush()
+            self.map = None
+        self.capacity += samps
+        size = self.capacity * self.sample_bytes
+        # reserve the blocks up front, so writing does not extend the file
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(self._data.fileno(), 0, size)
+        else:
+            self._data.truncate(size)
+        shape = (self.capacity, self._values) if self._values == 2 else (self.capacity,)
+        self.map = np.memmap(self._data, dtype=self._stored, mode="r+", shape=shape)
+
+    def _new_segment(self, timestamp):
+        segment = {"core:sample_start": self.num_samps}
+        if self.center_freq is not None:
+            segment["core:frequency"] = self.center_freq
+        if timestamp is not None:
+            segment["techtile:timestamp"] = timestamp
+            segment["core:datetime"] = datetime.datetime.fromtimestamp(
+                timestamp, datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+        self.meta["captures"].append(segment)
+
+    def _write_meta(self):
+        tmp = self.path + META_EXT + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp, self.path + META_EXT)
+
+
+class CaptureFile:
+    """A recorded capture, opened lazily: nothing is read until it is used."""
+
+    def __init__(self, path):
+        self.path = _base(path)
+        self._meta = None
+        self._samples = None
+        self._index = None
+        self._boundaries = None
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            with open(self.path + META_EXT, "r") as f:
+                self._meta = json.load(f)
+        return self._meta
+
+    @property
+    def datatype(self):
+        return self.meta["global"]["core:datatype"]
+
+    @property
+    def sample_rate(self):
+        return self.meta["global"]["core:sample_rate"]
+
+    @property
+    def tile(self):
+        return self.meta["global"].get("techtile:tile")
+
+    @property
+    def captures(self):
+        return self.meta["captures"]
+
+    @property
+    def center_freq(self):
+        return self.captures[0].get("core:frequency") if self.captures else None
+
+    @property
+    def start_time(self):
+        """Hardware timestamp of the first sample (None if it was not recorded)."""
+        return self.captures[0].get("techtile:timestamp") if self.captures else None
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def samples(self):
+        """All samples, as a read-only memory map."""
+        if self._samples is None:
+            stored, values = DATATYPES[self.datatype]
+            size = os.path.getsize(self.path + DATA_EXT) // (stored.itemsize * values)
+            shape = (size, values) if values == 2 else (size,)
+            # np.memmap cannot map empty files
+            self._samples = (np.memmap(self.path + DATA_EXT, dtype=stored, mode="r", shape=shape)
+                             if size else np.empty(shape, dtype=stored))
+        return self._samples
+
+    @property
+    def index(self):
+        """INDEX_DTYPE records (first sample, timestamp) of the recorded blocks."""
+        if self._index is None:
+            path = self.path + INDEX_EXT
+            self._index = (np.memmap(path, dtype=INDEX_DTYPE, mode="r")
+                           if os.path.exists(path) and os.path.getsize(path) else np.empty(0, dtype=INDEX_DTYPE))
+        return self._index
+
+    @property
+    def boundaries(self):
+        """
+        First samples of the contiguous runs after the first: the capture
+        segment starts, and the blocks whose timestamp does not follow from
+        the previous one.
+        """
+        if self._boundaries is None:
+            starts = [segment["core:sample_start"] for segment in self.captures[1:]]
+            index = self.index
+            if len(index) > 1:
+                expected = index["timestamp"][:-1] + np.diff(index["sample"]) / self.sample_rate
+                gaps = np.abs(index["timestamp"][1:] - expected) > 0.5 / self.sample_rate
+                starts.extend(index["sample"][1:][gaps].tolist())
+            self._boundaries = np.unique(np.asarray(starts, dtype=np.int64))
+        return self._boundaries
+
+    def __len__(self):
+        return len(self.samples)
+
+    def read(self, start, count):
+        """
+        Samples [start, start + count) (a view on the file), short at the
+        next gap: samples after it are not contiguous with these.
+        """
+        boundaries = self.boundaries
+        i = int(np.searchsorted(boundaries, start, side="right"))
+        if i < len(boundaries):
+            count = min(count, int(boundaries[i]) - start)
+        return self.samples[start:start + count]
+
+    def sample_at(self, timestamp):
+        """Index of the sample recorded at hardware time timestamp (None before the first block)."""
+        index = self.index
+        i = int(np.searchsorted(index["timestamp"], timestamp, side="right")) - 1
+        if i < 0:
+            return None
+        offset = int(round((timestamp - index["timestamp"][i]) * self.sample_rate))
+        end = int(index["sample"][i + 1]) if i + 1 < len(index) else len(self)
+        # past the end of its block: the samples of timestamp were not recorded
+        return int(index["sample"][i]) + offset if int(index["sample"][i]) + offset < end else None
+
+    def read_time(self, timestamp, duration):
+        """Samples from hardware time timestamp for duration seconds (may be short at gaps or the end)."""
+        start = self.sample_at(timestamp)
+        if start is None:
+            return self.samples[:0]
+        return self.read(start, int(round(duration * self.sample_rate)))
+
+
+class CaptureSet:
+    """
+    The captures in a directory, by capture name, and grouped by tile.
+
+    A tile can have many captures (e.g. one per capture command); by_tile
+    lists them in recording order. Only the file names are listed up front;
+    every CaptureFile is opened lazily on access.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.paths = {os.path.basename(p): p
+                      for p in sorted(_base(p) for p in glob.glob(os.path.join(directory, "*" + META_EXT)))}
+        self._files = {}
+        self._by_tile = None
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def keys(self):
+        """Capture names."""
+        return list(self.paths)
+
+    def __getitem__(self, name):
+        path = self.paths.get(name)
+        if path is None:
+            raise KeyError(name)
+        return self._open(path)
+
+    def tiles(self):
+        """IDs of the tiles with captures (captures without one are grouped under None)."""
+        return list(self._tiles())
+
+    def by_tile(self, tile):
+        """The captures of a tile, ordered by the timestamp of their first sample."""
+        return list(self._tiles().get(tile, ()))
+
+    def read_time(self, timestamp, duration):
+        """
+        Samples from hardware time timestamp for duration seconds, by tile:
+        from the tile's latest capture that started at or before timestamp.
+        Tiles without such a capture are left out.
+        """
+        samples = {}
+        for tile, captures in self._tiles().items():
+            started = [c for c in captures if c.start_time is not None and c.start_time <= timestamp]
+            if started:
+                samples[tile] = started[-1].read_time(timestamp, duration)
+        return samples
+
+    def _open(self, path):
+        capture = self._files.get(path)
+        if capture is None:
+            capture = self._files[path] = CaptureFile(path)
+        return capture
+
+    def _tiles(self):
+        if self._by_tile is None:
+            # reads the (small) metadata files, not the data
+            by_tile = {}
+            for path in self.paths.values():
+                capture = self._open(path)
+                by_tile.setdefault(capture.tile, []).append(capture)
+            for captures in by_tile.values():
+                # untimed captures last, names break ties
+                captures.sort(key=lambda c: (c.start_time is None, c.start_time or 0.0, c.name))
+            self._by_tile = by_tile
+        return self._by_tile
+
+
+__all__ = [
+    "SIGMF_VERSION",
+    "INDEX_DTYPE",
+    "DATATYPES",
+    "DEFAULT_GROW_SAMPS",
+    "sigmf_datatype",
+    "CaptureWriter",
+    "CaptureFile",
+    "CaptureSet",
+]
@@ -1,16 +1,72 @@
+import collections
 import logging
+import queue
 import re
 import socket
 import threading
 import time
+import uuid
 import yaml
 import zmq
 
 # from client_logger import get_logger
 from .client_logger import *
+from . import codec
+
+# PUB topics, see server/utils/server_com.py. The first frame of every sync
+# message is its topic followed by a per-topic sequence number ("all/17").
+GLOBAL_TOPIC = "all/"
+
+# Largest publish gap that is NACKed at once
+MAX_NACK = 1024
+
+# Time stop() allows messages queued before it to be sent [ms]
+STOP_LINGER_MS = 200
+
+
+def tile_topic(tile_id):
+    return f"tile/{tile_id}/"
+
+
+def split_topic(topic_frame):
+    """Split a sync topic frame into (topic, seq); seq is None for unnumbered publishes."""
+    topic, _, seq = topic_frame.rpartition("/")
+    return topic + "/", int(seq) if seq else None
+
+
+def tile_id_from_hostname(hostname=None):
+    """Return the tile ID of a 'rpi-<ID>' hostname (default: this machine's hostname)."""
+    hostname = hostname or socket.gethostname()
+    m = re.match(r"rpi-(.+)", hostname, re.IGNORECASE)
+    # TODO stop because no valid hostname, we cannot continue
+    if not m:
+        raise ValueError(
+            f"Hostname '{hostname}' does not match expected pattern 'rpi-<ID>'"
+        )
+    return m.group(1)
+
+
+def command_id(args):
+    """Return the correlation ID ("cmd_id") of a server command, or None."""
+    if not args or not isinstance(args[0], dict):
+        return None
+    return args[0].get("cmd_id")
+
 
 class Client:
-    def __init__(self, config_path="client_config.yaml"):
+    def __init__(self, config_path="client_config.yaml", hostname=None, context=None):
+        """
+        Parameters
+        ----------
+        config_path : str
+            Path to the experiment settings YAML file.
+        hostname : str, optional
+            Hostname to derive the client ID from, defaults to the machine's
+            hostname. Used to simulate tiles (see server/load-test.py).
+        context : zmq.Context, optional
+            Shared ZMQ context, e.g. when running many clients in one process.
+            A shared context is not terminated by stop().
+        """
         self.logger = get_logger(__name__, level=logging.DEBUG)
 
         # Load YAML config
@@ -27,15 +83,8 @@ class Client:
         self.heartbeat_interval = experiment_settings.get("heartbeat_interval", 5)
 
         # Derive ID from hostname
-        _hostname = socket.gethostname()
-        m = re.match(r"rpi-(.+)", _hostname, re.IGNORECASE)
-        # TODO stop because no valid hostname, we cannot continue
-        if not m:
-            raise ValueError(
-                f"Hostname '{_hostname}' does not match expected pattern 'rpi-<ID>'"
-            )
-        self.hostname = _hostname[4:]
-        self.client_id = m.group(1).encode()
+        self.hostname = tile_id_from_hostname(hostname)
+        self.client_id = self.hostname.encode()
         self.logger.debug("Client ID derived from hostname: %s", self.client_id)
 
         # State
@@ -43,12 +92,23 @@ class Client:
         self.thread = None
 
         # Setup ZMQ
-        self.context = zmq.Context()
+        self._own_context = context is None
+        self.context = zmq.Context() if context is None else context
         self.messaging = self.context.socket(zmq.DEALER)
         self.messaging.setsockopt(zmq.IDENTITY, self.client_id)
 
         self.sync = self.context.socket(zmq.SUB)
-        self.sync.setsockopt_string(zmq.SUBSCRIBE, "")  # subscribe to all topics
+        # Messages for all tiles and for this tile; group topics are added
+        # when the server sends a 'subscribe' message
+        self.sync.setsockopt_string(zmq.SUBSCRIBE, GLOBAL_TOPIC)
+        self.sync.setsockopt_string(zmq.SUBSCRIBE, tile_topic(self.client_id.decode()))
+        self.group_topics = set()
+        # topic -> last sequence number seen, and topic -> sequence numbers
+        # that were NACKed and not received yet
+        self._pub_seq = {}
+        self._missing = {}
+        # cmd_ids of recently handled commands, to drop any further copy
+        self._seen_cmds = collections.deque(maxlen=1024)
 
         # Robust reconnection handling
         self.messaging.setsockopt(zmq.RECONNECT_IVL, 1000)  # retry every 1s
@@ -57,8 +117,38 @@ class Client:
         self.messaging.setsockopt(zmq.HEARTBEAT_TIMEOUT, 10000)
         self.messaging.setsockopt(zmq.HEARTBEAT_TTL, 30000)
 
+        # Only the event loop thread touches the messaging socket. Other
+        # threads (e.g. command workers) queue their messages on the outbox
+        # and wake the loop through their own inproc PUSH socket.
+        self._outbox = queue.SimpleQueue()
+        self._wake_endpoint = f"inproc://client-wake-{id(self)}"
+        self._wake = self.context.socket(zmq.PULL)
+        self._wake.bind(self._wake_endpoint)
+        self._local = threading.local()
+        self._wake_sockets = []
+        self._wake_lock = threading.Lock()
+        self._wake_closed = False
+
         # Event handling
         self.callbacks = {}
+        # Messages dropped because they could not be handled (malformed)
+        self.invalid_messages = 0
+
+        # Clock offset to the server (local clock - server clock) as measured
+        # by the server, None until the first estimate arrives
+        self.clock_offset = None
+        self._last_recv_time = 0.0
+
+        # Session of this client run, so the server can tell a restarted tile
+        # from one that reconnected, and the epoch of the server run we are
+        # registered with (announced on our tile topic, see _handle_epoch)
+        self.session = uuid.uuid4().hex
+        self.server_epoch = None
+
+        # Header codec; switched to msgpack once the server is seen using it
+        self.codec = codec.JSON
+        self._hello_header = codec.JSON.encode({"codecs": codec.supported_codecs(), "session": self.session})
+        self._heartbeat_frames = [b"heartbeat", self._hello_header]
 
         self.logger.debug(
             "Initialized client with messaging=%s, sync=%s, heartbeat=%ss",
@@ -92,15 +182,17 @@ class Client:
         self.running = False
         self.logger.debug("Client stop requested")
 
-        try:
-            self.messaging.close(0)
-            self.sync.close(0)
-        except Exception as exc:
-            self.logger.debug("Socket close during stop raised: %s", exc)
-        try:
-            self.context.term()
-        except Exception as exc:
-            self.logger.debug("Context term during stop raised: %s", exc)
+        if self.thread is threading.current_thread():
+            return  # called from a callback, the loop exits when it returns
+        # the event loop closes its sockets when it exits; wait for that before
+        # terminating the context
+        self._wakeup()
+        self.thread.join()
+        if self._own_context:
+            try:
+                self.context.term()
+            except Exception as exc:
+                self.logger.debug("Context term during stop raised: %s", exc)
 
     def join(self):
         if self.thread:
@@ -120,85 +212,236 @@ class Client:
         ----------
         msg_type : str
             Message type string (e.g., 'heartbeat', 'request', etc.).
-        payload_frames : optional list of bytes or str
-            Additional frames to send after the message type.
+        payload_frames : optional list of bytes, str or objects
+            Additional frames to send after the message type. Objects (dict,
+            list, ...) are encoded with the negotiated codec (see codec.py),
+            raw buffers (bytes, numpy arrays) are sent without a copy.
+
+        Safe to call from any thread: messages from other threads than the
+        event loop are queued and sent by the loop.
         """
 
-        frames = [msg_type.encode()]
-        for frame in payload_frames:
-            if isinstance(frame, str):
-                frame = frame.encode()
-            frames.append(frame)
+        frames = codec.encode_frames(msg_type, payload_frames, self.codec)
 
-        self.messaging.send_multipart(frames)
-        self.logger.debug("Sent message type '%s' with %d payload frames", msg_type, len(payload_frames))
+        if self.thread is None or threading.current_thread() is self.thread:
+            self.messaging.send_multipart(frames, copy=False)
+        else:
+            self._outbox.put(frames)
+            sock = self._wake_socket()
+            if sock is None:
+                self.logger.debug("Client stopped; dropping '%s'", msg_type)
+                return
+            try:
+                sock.send(b"", zmq.NOBLOCK)
+            except zmq.Again:
+                pass  # the loop has plenty of wakeups queued already
+            except zmq.ZMQError as exc:
+                self.logger.debug("Client stopped; dropping '%s': %s", msg_type, exc)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Sent message type '%s' with %d payload frames", msg_type, len(payload_frames))
+
+    def respond(self, msg_type, request_args, **fields):
+        """
+        Reply to a server command, echoing its correlation ID.
+
+        Parameters
+        ----------
+        msg_type : str
+            Response type (e.g., 'usrp_ack', 'usrp_done').
+        request_args : list
+            The args the command callback was called with.
+        fields
+            Optional extra result fields sent along with the reply.
+        """
+        reply = dict(fields)
+        cmd_id = command_id(request_args)
+        if cmd_id is not None:
+            reply["cmd_id"] = cmd_id
+        self.send(msg_type, reply)
+
+    def server_to_local(self, server_time):
+        """Convert a server wall clock time (e.g. a command's "start_time") to the local clock."""
+        return server_time + (self.clock_offset or 0.0)
+
+    def local_to_server(self, local_time):
+        """Convert a local wall clock time to the server clock (inverse of server_to_local)."""
+        return local_time - (self.clock_offset or 0.0)
+
+    def _wake_socket(self):
+        """This thread's PUSH socket to wake the event loop (None once the loop exited)."""
+        sock = getattr(self._local, "wake", None)
+        if sock is None:
+            with self._wake_lock:
+                if self._wake_closed:
+                    return None
+                sock = self.context.socket(zmq.PUSH)
+                sock.setsockopt(zmq.LINGER, 0)
+                sock.connect(self._wake_endpoint)
+                self._wake_sockets.append(sock)
+            self._local.wake = sock
+        return sock if not sock.closed else None
+
+    def _wakeup(self):
+        """Interrupt the event loop's poll from another thread."""
+        sock = self._wake_socket()
+        if sock is not None:
+            try:
+                sock.send(b"", zmq.NOBLOCK)
+            except zmq.ZMQError:
+                pass  # wakeups already queued, or the loop exited
 
     def _run(self):
         self.logger.debug("Client event loop starting")
         poller = zmq.Poller()
         poller.register(self.messaging, zmq.POLLIN)
         poller.register(self.sync, zmq.POLLIN)
+        poller.register(self._wake, zmq.POLLIN)
 
-        last_heartbeat = 0
+        # Sleep in poll until the next heartbeat is due (monotonic clock), so
+        # an idle client only wakes up once per heartbeat interval and
+        # messages are handled as soon as they arrive
+        next_heartbeat = time.monotonic()
 
         while self.running:
-            now = time.time()
+            now = time.monotonic()
 
             # Send heartbeat (non-blocking)
-            if now - last_heartbeat >= self.heartbeat_interval:
+            if now >= next_heartbeat:
                 try:
-                    self.messaging.send_multipart([b"heartbeat", b"alive"], zmq.NOBLOCK)
-                    self.logger.debug("Heartbeat sent")
+                    self.messaging.send_multipart(self._heartbeat_frames, zmq.NOBLOCK)
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug("Heartbeat sent")
                 except zmq.Again:
                     self.logger.debug("Heartbeat send would block; server likely down")
-                last_heartbeat = now
+                next_heartbeat = now + self.heartbeat_interval
 
             # Poll server messages
+            timeout_ms = max(0, int((next_heartbeat - time.monotonic()) * 1000) + 1)
             try:
-                events = dict(poller.poll(timeout=100))
+                events = dict(poller.poll(timeout=timeout_ms))
             except zmq.error.ZMQError as exc:
                 self.logger.debug("Poller error, stopping: %s", exc)
                 break
 
-            if self.messaging in events:
-                try:
-                    frames = self.messaging.recv_multipart(zmq.NOBLOCK)
-                except zmq.Again:
-                    continue
-                except zmq.ZMQError as exc:
-                    self.logger.debug("Messaging recv error: %s", exc)
-                    break
-
-                self.logger.debug("Received messaging frames: %s", frames)
-                self._handle_server_message(frames)
-                
-            if self.sync in events:
-                try:
-                    frames = self.sync.recv_multipart(zmq.NOBLOCK)
-                except zmq.Again:
-                    continue
-                except zmq.ZMQError as exc:
-                    self.logger.debug("Sync recv error: %s", exc)
-                    break
-
-                self.logger.debug("Received sync frames: %s", frames)
-                self._handle_server_message(frames)
+            try:
+                if self._wake in events:
+                    self._drain_wakeups()
+                if self.messaging in events:
+                    self._drain_messaging()
+                if self.sync in events:
+                    self._drain_sync()
+            except zmq.ZMQError as exc:
+                self.logger.debug("Recv error, stopping: %s", exc)
+                break
 
-        # Cleanup
+        # Cleanup: send what other threads queued before stop() (e.g. a final
+        # report), allowing it a moment to leave the socket
         try:
-            self.messaging.close(0)
+            self._drain_wakeups()
+        except zmq.ZMQError as exc:
+            self.logger.debug("Could not send queued messages: %s", exc)
+        try:
+            self.messaging.close(STOP_LINGER_MS)
             self.sync.close(0)
+            self._wake.close(0)
+            with self._wake_lock:
+                self._wake_closed = True
+                for sock in self._wake_sockets:
+                    sock.close(0)
         except Exception as exc:
             self.logger.debug("Socket cleanup raised: %s", exc)
         self.logger.debug("Client event loop exited")
 
+    def _drain_wakeups(self):
+        # consume all wakeups first, every queued message is sent below
+        while True:
+            try:
+                self._wake.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        while True:
+            try:
+                frames = self._outbox.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.messaging.send_multipart(frames, zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                self.logger.warning("Dropping queued '%s'; send would block", bytes(frames[0]).decode())
+
+    def _drain_messaging(self):
+        """Handle all frames queued on the messaging socket."""
+        while self.running:
+            try:
+                frames = self.messaging.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+
+            self._last_recv_time = time.time()
+            # per-message debug output is guarded, it formats every frame
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Received messaging frames: %s", frames)
+            try:
+                if frames and frames[0].bytes == b"repub":
+                    # a missed publish, resent after our NACK
+                    self._handle_published(frames[1], frames[2:], repair=True)
+                else:
+                    self._handle_server_message(frames)
+            except zmq.ZMQError:
+                raise
+            except Exception as exc:
+                self._invalid_message(frames, exc)
+
+    def _drain_sync(self):
+        """Handle all frames queued on the sync socket."""
+        while self.running:
+            try:
+                frames = self.sync.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Received sync frames: %s", frames)
+            try:
+                if frames:
+                    self._handle_published(frames[0], frames[1:])
+            except zmq.ZMQError:
+                raise
+            except Exception as exc:
+                self._invalid_message(frames, exc)
+
+    def _invalid_message(self, frames, exc):
+        """Drop a message that could not be handled, instead of ending the event loop."""
+        self.invalid_messages += 1
+        msg_type = frames[0].bytes[:32].decode(errors="replace") if frames else ""
+        self.logger.error("Dropping malformed message '%s': %r", msg_type, exc)
+
     def _handle_server_message(self, frames):
         if not frames:
             self.logger.debug("Empty frame list received; ignoring")
             return
 
-        command = frames[0].decode()
-        args = [f.decode() for f in frames[1:]]
+        # message type, decoded header and raw (zmq.Frame) bulk frames
+        command = frames[0].bytes.decode()
+        args = list(frames[1:])
+        if args:
+            if codec.is_msgpack(args[0]) and self.codec is not codec.MSGPACK:
+                # the server speaks msgpack, so we may reply with it as well
+                self.codec = codec.MSGPACK or codec.JSON
+            try:
+                args[0] = codec.decode(args[0])
+            except ValueError as e:
+                self.logger.error("Could not decode %s: %s", command, e)
+                return
+
+            cmd_id = command_id(args)
+            if cmd_id is not None:
+                # a copy of a command we already handled: a NACK repair or
+                # ACK-timeout resend, or the original arriving after either
+                if cmd_id in self._seen_cmds:
+                    self.logger.debug("Dropping duplicate %s with cmd_id %s", command, cmd_id)
+                    return
+                self._seen_cmds.append(cmd_id)
 
         # If a callback exists, call it
         if command in self.callbacks:
@@ -208,8 +451,14 @@ class Client:
                 self.logger.error("Callback error for %s: %s", command, e)
             return
 
-        # Default built-in handlers
-        if command == "ping":
+        # Default built-in handlers (a malformed message raises, see _invalid_message)
+        if command == "subscribe":
+            self._update_group_topics(args)
+        elif command == "time_req":
+            self._handle_time_req(args)
+        elif command == "epoch":
+            self._handle_epoch(args)
+        elif command == "ping":
             try:
                 self.messaging.send_multipart([b"pong", b"ok"], zmq.NOBLOCK)
                 self.logger.debug("Responded to ping with pong")
@@ -221,3 +470,118 @@ class Client:
                 self.logger.debug("Sent unknown_command error for %s", command)
             except zmq.Again:
                 self.logger.debug("Failed to send unknown_command; send would block")
+
+    def _handle_published(self, topic_frame, frames, repair=False):
+        """Handle a (re)published message after checking its sequence number."""
+        topic, seq = split_topic(topic_frame.bytes.decode())
+        if seq is not None and not self._check_sequence(topic, seq, repair):
+            self.logger.debug("Dropping duplicate publish %s%s", topic, seq)
+            return
+        self._handle_server_message(frames)
+
+    def _check_sequence(self, topic, seq, repair):
+        """
+        Track the sequence numbers of a topic and NACK gaps.
+
+        Returns True if the message is new and must be handled, False for
+        duplicates (e.g. a resend of a message that arrived after all).
+        """
+        last = self._pub_seq.get(topic)
+        missing = self._missing.setdefault(topic, set())
+
+        if seq in missing:
+            missing.discard(seq)
+            return True
+        if repair:
+            return False
+        if last is None or seq == last + 1:
+            self._pub_seq[topic] = seq
+            return True
+        if seq > last + 1:
+            first = max(last + 1, seq - MAX_NACK)
+            self.logger.debug("Missed publishes %s%d-%d, sending NACK", topic, first, seq - 1)
+            missing.update(range(first, seq))
+            if len(missing) > MAX_NACK:
+                # keep the most recent gaps only, older ones are not resent anymore
+                missing.intersection_update(range(seq - MAX_NACK, seq))
+            self._pub_seq[topic] = seq
+            try:
+                self.messaging.send_multipart(
+                    codec.encode_frames("nack", [{"topic": topic, "seqs": [first, seq - 1]}], self.codec),
+                    zmq.NOBLOCK)
+            except zmq.Again:
+                self.logger.debug("Failed to send NACK; send would block")
+            return True
+        if seq == 1:
+            # the server restarted and numbers its publishes from 1 again
+            self._pub_seq[topic] = seq
+            missing.clear()
+            return True
+        return False
+
+    def _update_group_topics(self, args):
+        """Replace the group topic subscriptions and confirm to the server."""
+        # check the whole message first, so a malformed one leaves the
+        # current subscriptions untouched
+        try:
+            topics = args[0] if args else []
+            # sequence numbers of our topics at the time of (re)registration
+            seqs = codec.decode(args[1]) if len(args) > 1 else {}
+            if (not isinstance(topics, list) or not all(isinstance(t, str) for t in topics)
+                    or not isinstance(seqs, dict)
+                    or not all(isinstance(t, str) and isinstance(n, int) for t, n in seqs.items())):
+                raise ValueError(f"unexpected topics {topics!r} or sequence numbers {seqs!r}")
+        except ValueError as e:
+            self.invalid_messages += 1
+            self.logger.error("Ignoring malformed subscribe, keeping the current subscriptions: %s", e)
+            return
+        topics = set(topics)
+        if seqs:
+            self._pub_seq.update(seqs)
+            for topic in seqs:
+                self._missing.pop(topic, None)
+        for topic in self.group_topics - topics:
+            self.sync.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+        for topic in topics - self.group_topics:
+            self.sync.setsockopt_string(zmq.SUBSCRIBE, topic)
+        self.group_topics = topics
+        self.logger.debug("Subscribed to group topics: %s", sorted(topics))
+
+        try:
+            self.messaging.send_multipart([b"subscribed"], zmq.NOBLOCK)
+        except zmq.Again:
+            self.logger.debug("Failed to confirm subscriptions; send would block")
+
+    def _handle_epoch(self, args):
+        """Register with a (re)started server right away instead of at the next heartbeat."""
+        epoch = args[0].get("epoch") if args and isinstance(args[0], dict) else None
+        if not isinstance(epoch, str):
+            self.logger.warning("Ignoring epoch announcement without an epoch: %r", args[0] if args else None)
+            return
+        if epoch == self.server_epoch:
+            return  # our SUB socket reconnected to the same server run
+        if self.server_epoch is not None:
+            # a new server run: its sequence numbers and cmd_ids start over
+            self.logger.info("Server restarted (epoch %s), registering again", epoch)
+            self._pub_seq.clear()
+            self._missing.clear()
+            self._seen_cmds.clear()
+            self.clock_offset = None
+        self.server_epoch = epoch
+        try:
+            self.messaging.send_multipart([b"hello", self._hello_header], zmq.NOBLOCK)
+        except zmq.Again:
+            self.logger.debug("Failed to send hello; send would block")
+
+    def _handle_time_req(self, args):
+        """Answer a clock probe with our receive and send timestamps."""
+        request = args[0] if args else None
+        if not isinstance(request, dict) or not isinstance(request.get("t1"), (int, float)):
+            raise ValueError(f"time_req without a t1 timestamp: {request!r}")
+        if isinstance(request.get("offset"), (int, float)):
+            self.clock_offset = request["offset"]
+        reply = {"t1": request["t1"], "t2": self._last_recv_time, "t3": time.time()}
+        try:
+            self.messaging.send_multipart(codec.encode_frames("time_resp", [reply], self.codec), zmq.NOBLOCK)
+        except zmq.Again:
+            self.logger.debug("Failed to answer time_req; send would block")
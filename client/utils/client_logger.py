@@ -1,11 +1,29 @@
+import atexit
+import copy
 import logging
+import logging.handlers
+import numbers
+import queue
+import sys
+import threading
+import time
 from datetime import datetime
 from typing import Optional
 
+_FORMAT = "[%(asctime)s] [%(levelname)s] (%(threadName)-10s) %(message)s"
+
 
 class LogFormatter(logging.Formatter):
     """Custom log formatter that prints timestamps with fractional seconds."""
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # "HH:MM:" and the seconds of the last formatted whole second, so
+        # the local time is only converted once per second
+        self._second = None
+        self._prefix = ""
+        self._seconds = 0
+
     @staticmethod
     def pp_now() -> str:
         """Return the current time of day as a formatted string with milliseconds."""
@@ -14,26 +32,347 @@ class LogFormatter(logging.Formatter):
 
     def formatTime(self, record, datefmt: Optional[str] = None) -> str:  # noqa: N802
         """Override the default time formatter to include fractional seconds."""
-        converter = self.converter(record.created)
         if datefmt:
-            return converter.strftime(datefmt)
-        return LogFormatter.pp_now()
+            return time.strftime(datefmt, self.converter(record.created))
+        second = int(record.created)
+        if second != self._second:
+            local = self.converter(second)
+            self._second = second
+            self._prefix = time.strftime("%H:%M:", local)
+            self._seconds = local.tm_sec
+        return "{}{:05.2f}".format(self._prefix, self._seconds + record.created - second)
+
+    def formatMessage(self, record) -> str:  # noqa: N802
+        """Add the count of records RateLimitFilter dropped before this one."""
+        message = super().formatMessage(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            message = f"{message} ({suppressed} similar messages suppressed)"
+        return message
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per message class (logger and format string).
+
+    Every message class may log `burst` records at once and `rate` records
+    per second on average; the rest is dropped and counted in the `suppressed`
+    attribute of the next record that passes (shown by LogFormatter). Records
+    at or above `max_level` are never limited.
+    """
+
+    def __init__(self, rate: float = 10.0, burst: int = 20, max_level: int = logging.ERROR):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_level = max_level
+        self.suppressed = 0
+        # (logger name, msg) -> [tokens, last update, suppressed records]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.max_level:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), record.created, 0]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (record.created - bucket[1]) * self.rate)
+                bucket[1] = record.created
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1
+            skipped, bucket[2] = bucket[2], 0
+        if skipped:
+            record.suppressed = skipped
+        return True
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keep the most recent formatted records in a fixed-size in-memory byte ring.
+
+    Meant to run at DEBUG level next to a quieter console handler: when a
+    record at or above `dump_level` arrives, the recent history leading up to
+    it is written to `dump_path` (appended) or stderr.
+    """
+
+    def __init__(self, capacity: int = 1 << 20, dump_level: int = logging.ERROR, dump_path: Optional[str] = None):
+        super().__init__(logging.DEBUG)
+        self.buffer = bytearray(capacity)
+        self.pos = 0
+        self.wrapped = False
+        self.dump_level = dump_level
+        self.dump_path = dump_path
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self._write((self.format(record) + "\n").encode(errors="replace"))
+            if record.levelno >= self.dump_level:
+                self.dump()
+        except Exception:
+            self.handleError(record)
+
+    def contents(self) -> bytes:
+        """Return the buffered records, oldest first."""
+        if not self.wrapped:
+            return bytes(self.buffer[:self.pos])
+        data = bytes(self.buffer[self.pos:]) + bytes(self.buffer[:self.pos])
+        # the oldest record was partly overwritten
+        return data[data.find(b"\n") + 1:]
+
+    def dump(self) -> None:
+        """Write the buffered records to dump_path or stderr."""
+        header = f"----- log ring buffer dump {datetime.now():%Y-%m-%d %H:%M:%S} -----\n".encode()
+        data = header + self.contents()
+        if self.dump_path:
+            with open(self.dump_path, "ab") as f:
+                f.write(data)
+        else:
+            sys.stderr.buffer.write(data)
+            sys.stderr.flush()
+
+    def _write(self, data: bytes) -> None:
+        capacity = len(self.buffer)
+        if len(data) > capacity:
+            data = data[-capacity:]
+        end = self.pos + len(data)
+        if end <= capacity:
+            self.buffer[self.pos:end] = data
+        else:
+            split = capacity - self.pos
+            self.buffer[self.pos:] = data[:split]
+            self.buffer[:end - capacity] = data[split:]
+        if end >= capacity:
+            self.wrapped = True
+        self.pos = end % capacity
+
+
+class _Snapshot:
+    """str() and repr() of a logging argument, taken when the record was created."""
+
+    __slots__ = ("text", "rep")
+
+    def __init__(self, value):
+        self.text = str(value)
+        self.rep = repr(value)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return self.rep
+
+
+def _frozen(value) -> bool:
+    """True if value can be formatted later: immutable and picklable."""
+    if value is None or isinstance(value, (str, bytes, numbers.Number)):
+        return True
+    if type(value) is tuple:
+        return all(_frozen(item) for item in value)
+    return False
+
+
+def _freeze(value):
+    return value if _frozen(value) else _Snapshot(value)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the message is formatted by the listener thread. Only arguments
+        # that may change before it gets to them (or cannot be pickled) are
+        # converted to text now; numbers and strings are queued as they are.
+        record = copy.copy(record)
+        if not isinstance(record.msg, str):
+            record.msg = str(record.msg)
+        if isinstance(record.args, tuple):
+            record.args = tuple(_freeze(arg) for arg in record.args)
+        elif record.args:
+            # a single mapping argument: "%(name)s" formatting
+            record.args = {key: _freeze(value) for key, value in record.args.items()}
+        if record.exc_info:
+            record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _FanOutHandler(logging.Handler):
+    """Pass records to several handlers (console and ring buffer) in the calling thread."""
+
+    def __init__(self, handlers):
+        super().__init__()
+        self.handlers = handlers
+
+    def handle(self, record):
+        if not self.filter(record):
+            return False
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+
+# Formats tracebacks of queued records in the logging thread
+_exc_formatter = logging.Formatter()
+
+# Handler attached to every logger returned by get_logger (console or queue)
+_handler = None
+# Level of every logger returned by get_logger, once set by configure_logging
+_level = None
+_loggers = set()
+_listener = None
+_lock = threading.Lock()
+
+
+def _console_handler(level: int = logging.NOTSET) -> logging.Handler:
+    console = logging.StreamHandler()
+    console.setLevel(level)
+    console.setFormatter(LogFormatter(fmt=_FORMAT))
+    return console
+
+
+def _attach(handler: logging.Handler) -> None:
+    """Replace the shared handler on all get_logger loggers (called with _lock held)."""
+    global _handler
+    for name in _loggers:
+        logger = logging.getLogger(name)
+        if _handler is not None:
+            logger.removeHandler(_handler)
+        logger.addHandler(handler)
+    _handler = handler
+
+
+def configure_logging(
+    async_mode: bool = False,
+    console_level: int = logging.DEBUG,
+    level: Optional[int] = None,
+    queue_size: int = 10000,
+    rate_limit: Optional[float] = None,
+    burst: int = 20,
+    ring_buffer_bytes: int = 0,
+    dump_path: Optional[str] = None,
+) -> None:
+    """
+    Configure the output of all loggers created with get_logger.
+
+    Parameters
+    ----------
+    async_mode : bool
+        Hand records to a background listener thread through a bounded
+        queue, so logging never blocks on the console. Records are dropped
+        (see dropped_records) when the queue is full.
+    console_level : int
+        Minimum level printed to the console.
+    level : int, optional
+        Level of all get_logger loggers, overriding the level they were
+        created with. Defaults to the lowest level that is output:
+        console_level, or DEBUG with the ring buffer. Records below it are
+        not even created.
+    queue_size : int
+        Records queued in async mode.
+    rate_limit : float, optional
+        Records per second allowed per message class (see RateLimitFilter).
+        Applied before queueing, to the console and the ring buffer alike.
+    burst : int
+        Records per message class allowed at once when rate limited.
+    ring_buffer_bytes : int
+        Size of an in-memory ring of recent records at DEBUG level (0
+        disables), dumped to dump_path (or stderr) on every ERROR.
+    dump_path : str, optional
+        File the ring buffer is appended to on errors.
+    """
+    global _listener, _level
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+        if level is None:
+            level = logging.DEBUG if ring_buffer_bytes else console_level
+        _level = level
+        for name in _loggers:
+            logging.getLogger(name).setLevel(level)
+
+        handlers = [_console_handler(console_level)]
+        if ring_buffer_bytes:
+            ring = RingBufferHandler(ring_buffer_bytes, dump_path=dump_path)
+            ring.setFormatter(LogFormatter(fmt=_FORMAT))
+            handlers.append(ring)
+
+        if async_mode:
+            handler = _DroppingQueueHandler(queue.Queue(queue_size))
+            _listener = logging.handlers.QueueListener(handler.queue, *handlers, respect_handler_level=True)
+            _listener.start()
+        elif len(handlers) == 1:
+            handler = handlers[0]
+        else:
+            handler = _FanOutHandler(handlers)
+
+        if rate_limit:
+            # on the handler of the loggers, so floods are dropped before they are queued
+            handler.addFilter(RateLimitFilter(rate_limit, burst))
+        _attach(handler)
+
+
+def dropped_records() -> int:
+    """Records dropped because the async logging queue was full."""
+    return getattr(_handler, "dropped", 0)
+
+
+def shutdown_logging() -> None:
+    """Flush and stop the async logging listener (also done at exit)."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(shutdown_logging)
 
 
 def get_logger(name: str = __name__, level: int = logging.DEBUG) -> logging.Logger:
-    """Create or return a logger configured with the custom formatter."""
+    """
+    Create or return a logger configured with the custom formatter.
+
+    level is only used until configure_logging sets the level of all loggers.
+    """
     logger = logging.getLogger(name)
-    logger.setLevel(level)
 
-    if not any(isinstance(h, logging.StreamHandler) for h in logger.handlers):
-        console = logging.StreamHandler()
-        formatter = LogFormatter(
-            fmt="[%(asctime)s] [%(levelname)s] (%(threadName)-10s) %(message)s"
-        )
-        console.setFormatter(formatter)
-        logger.addHandler(console)
+    with _lock:
+        logger.setLevel(level if _level is None else _level)
+        if _handler is None:
+            _attach(_console_handler())
+        if name not in _loggers:
+            _loggers.add(name)
+            logger.addHandler(_handler)
 
     return logger
 
 
-__all__ = ["LogFormatter", "get_logger"]
+__all__ = [
+    "LogFormatter",
+    "RateLimitFilter",
+    "RingBufferHandler",
+    "configure_logging",
+    "dropped_records",
+    "shutdown_logging",
+    "get_logger",
+]
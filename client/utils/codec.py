@@ -0,0 +1,127 @@
+"""
+Message codecs for server <-> tile traffic.
+
+A message consists of a message type frame, an optional header frame with
+the control data (command arguments, replies, ...) and any number of raw
+frames (bulk data, numpy buffers) that are sent and received untouched.
+
+The header is encoded with the codec negotiated between server and tile:
+  - msgpack: compact binary encoding, prefixed with MSGPACK_TAG
+  - json:    plain UTF-8 JSON text, understood by every version
+
+MSGPACK_TAG (0xc1) is never produced by msgpack and is not a valid first byte
+of UTF-8 text, so a receiver can always tell both encodings apart. Tiles
+advertise the codecs they support in their heartbeat; peers that do not
+advertise anything only receive JSON.
+
+Keep server/utils/codec.py and client/utils/codec.py identical.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, JSON is always available
+    msgpack = None
+
+MSGPACK_TAG = b"\xc1"
+
+
+class JsonCodec:
+    name = "json"
+
+    @staticmethod
+    def encode(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+
+class MsgpackCodec:
+    name = "msgpack"
+
+    @staticmethod
+    def encode(obj):
+        return MSGPACK_TAG + msgpack.packb(obj, use_bin_type=True)
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+
+# Supported codecs, most preferred first
+CODECS = [codec for codec in (MSGPACK, JSON) if codec is not None]
+
+
+def supported_codecs():
+    """Names of the codecs available in this process, most preferred first."""
+    return [codec.name for codec in CODECS]
+
+
+def select_codec(peer_codecs):
+    """Return the most preferred codec that the peer supports as well."""
+    for codec in CODECS:
+        if codec.name in peer_codecs:
+            return codec
+    return JSON
+
+
+def is_raw(frame):
+    """True if frame must be sent as is (bytes, zmq.Frame, numpy array, ...)."""
+    if isinstance(frame, (bytes, bytearray, memoryview)):
+        return True
+    try:
+        memoryview(frame)
+    except TypeError:
+        return False
+    return True
+
+
+def encode_frames(msg_type, payload_frames, codec=JSON):
+    """
+    Build the frames of a message.
+
+    str payloads are UTF-8 encoded, raw buffers are passed through without a
+    copy and any other object (dict, list, numbers) is encoded with codec.
+    """
+    frames = [msg_type.encode()]
+    for f in payload_frames:
+        if isinstance(f, str):
+            f = f.encode()
+        elif not is_raw(f):
+            f = codec.encode(f)
+        frames.append(f)
+    return frames
+
+
+def decode(frame):
+    """
+    Decode a header frame of either codec.
+
+    Text that is not valid JSON (e.g. the legacy heartbeat payload "alive")
+    is returned as str.
+    """
+    data = frame.bytes if hasattr(frame, "bytes") else bytes(frame)
+    if data[:1] == MSGPACK_TAG:
+        if msgpack is None:
+            raise ValueError("Received a msgpack frame but msgpack is not installed")
+        return msgpack.unpackb(data[1:], raw=False)
+    text = data.decode()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def is_msgpack(frame):
+    data = frame.bytes if hasattr(frame, "bytes") else frame
+    return data[:1] == MSGPACK_TAG
+
+
+__all__ = [
+    "MSGPACK_TAG",
+    "JSON",
+    "MSGPACK",
+    "supported_codecs",
+    "select_codec",
+    "is_raw",
+    "encode_frames",
+    "decode",
+    "is_msgpack",
+]
@@ -0,0 +1,171 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .client_logger import *
+from .client_com import command_id
+
+# Server message that cancels a running command, see USRP_Control.cancel_command
+CANCEL_COMMAND = "usrp_cancel"
+
+
+class CommandCancelled(Exception):
+    """Raised inside a handler (by CommandContext.wait/check) when its command is cancelled."""
+
+
+class CommandContext:
+    """
+    A received command as seen by its handler.
+
+    Attributes
+    ----------
+    command : str
+        Command name, e.g. 'usrp_sync'.
+    args : list
+        Arguments as passed to Client callbacks: decoded header first, raw
+        (zmq.Frame) bulk frames after it.
+    params : dict
+        The decoded header (command parameters), empty if there is none.
+    cmd_id : int or None
+        Correlation ID of the command.
+    """
+
+    def __init__(self, command, args):
+        self.command = command
+        self.args = args
+        self.params = args[0] if args and isinstance(args[0], dict) else {}
+        self.cmd_id = command_id(args)
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check(self):
+        """Raise CommandCancelled if the command was cancelled."""
+        if self._cancelled.is_set():
+            raise CommandCancelled(f"{self.command} {self.cmd_id} cancelled")
+
+    def wait(self, timeout):
+        """Sleep for timeout seconds, raise CommandCancelled as soon as the command is cancelled."""
+        if self._cancelled.wait(timeout):
+            raise CommandCancelled(f"{self.command} {self.cmd_id} cancelled")
+
+
+class CommandExecutor:
+    """
+    Run command handlers on a worker pool with automatic ACK/DONE replies.
+
+    Client callbacks run on the client's I/O thread, so a slow callback
+    delays heartbeats and every other message. Handlers registered with the
+    executor run on worker threads instead:
+
+        executor = CommandExecutor(client)
+
+        def handle_sync(ctx):
+            ctx.wait(5)                 # the actual work, cancellable
+            return {"status": "ok"}     # extra fields for usrp_done
+
+        executor.register("usrp_sync", handle_sync)
+
+    On receipt of a command the executor replies 'usrp_ack' from the I/O
+    thread and queues the handler. When the handler returns, its result
+    (a dict or None) is sent along with 'usrp_done'. If it raises, or the
+    command is cancelled, 'usrp_error' is sent with an "error" field. All
+    replies echo the command's cmd_id.
+
+    A command is cancelled by the server ('usrp_cancel') or with cancel().
+    Queued commands are dropped; running handlers observe the cancellation
+    through CommandContext.wait/check/cancelled.
+    """
+
+    def __init__(self, client, max_workers=2):
+        self.client = client
+        self.logger = get_logger(__name__, level=logging.DEBUG)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="command")
+        # cmd_id (or id(ctx) without one) -> (CommandContext, Future)
+        self.active = {}
+        self._lock = threading.Lock()
+        self.client.on(CANCEL_COMMAND, self._on_cancel)
+
+    def register(self, command, handler, ack=True):
+        """
+        Run handler(ctx) on the worker pool for every received command.
+
+        Parameters
+        ----------
+        command : str
+            Server command, e.g. 'usrp_sync'.
+        handler : callable
+            Called with a CommandContext; returns a dict of extra usrp_done
+            fields or None.
+        ack : bool
+            Send 'usrp_ack' as soon as the command is received.
+        """
+        self.client.on(command, lambda cmd, args: self._on_command(cmd, args, handler, ack))
+
+    def cancel(self, cmd_id):
+        """Cancel a queued or running command. Returns False if it is unknown."""
+        with self._lock:
+            entry = self.active.get(cmd_id)
+        if entry is None:
+            return False
+        ctx, future = entry
+        ctx.cancel()
+        future.cancel()  # only succeeds if the handler did not start yet
+        return True
+
+    def shutdown(self, wait=True):
+        """Cancel all commands and stop the worker pool."""
+        with self._lock:
+            keys = list(self.active)
+        for key in keys:
+            self.cancel(key)
+        self.pool.shutdown(wait=wait)
+
+    def _on_command(self, command, args, handler, ack):
+        # runs on the client's I/O thread: reply and hand over, never block
+        ctx = CommandContext(command, args)
+        if ack:
+            self.client.respond("usrp_ack", args)
+
+        key = ctx.cmd_id if ctx.cmd_id is not None else id(ctx)
+        future = self.pool.submit(self._execute, ctx, handler)
+        with self._lock:
+            self.active[key] = (ctx, future)
+        future.add_done_callback(lambda f: self._finished(key, ctx, f))
+
+    @staticmethod
+    def _execute(ctx, handler):
+        ctx.check()
+        return handler(ctx)
+
+    def _finished(self, key, ctx, future):
+        with self._lock:
+            self.active.pop(key, None)
+
+        if future.cancelled():
+            error = CommandCancelled(f"{ctx.command} {ctx.cmd_id} cancelled")
+        else:
+            error = future.exception()
+
+        if error is None:
+            result = future.result()
+            self.client.respond("usrp_done", ctx.args, **(result or {}))
+        elif isinstance(error, CommandCancelled):
+            self.logger.info("Command %s (%s) cancelled", ctx.command, ctx.cmd_id)
+            self.client.respond("usrp_error", ctx.args, error="cancelled")
+        else:
+            self.logger.error("Command %s (%s) failed: %s", ctx.command, ctx.cmd_id, error)
+            self.client.respond("usrp_error", ctx.args, error=str(error), type=type(error).__name__)
+
+    def _on_cancel(self, command, args):
+        cancel_id = args[0].get("cancel_id") if args and isinstance(args[0], dict) else None
+        if not self.cancel(cancel_id):
+            self.logger.debug("Cancel for unknown command %s", cancel_id)
+
+
+__all__ = ["CANCEL_COMMAND", "CommandCancelled", "CommandContext", "CommandExecutor"]
@@ -0,0 +1,177 @@
+"""
+Zero-copy IQ sample streaming from the tiles to the server.
+
+Every tile publishes its received sample blocks on an XPUB socket that
+connects to the server's IQ port (server/iq_port in the experiment settings,
+IQ_PUB_PORT by default). The server binds a single SUB socket and
+reassembles the per-tile streams (see server/utils/iq_stream.py). A block is
+one message:
+
+    [b"iq/<ID>/", header, samples]
+
+  - header:  JSON {"seq", "timestamp", "dtype", "shape", ...}. seq counts
+             the blocks of this publisher (dropped ones included, so the
+             server sees them as gaps), timestamp is the hardware time of
+             the first sample, shape[0] the number of samples.
+  - samples: the raw buffer of a numpy array (e.g. complex64, or int16 with
+             shape (n, 2) for sc16), sent with copy=False.
+
+Outgoing blocks are bounded by the send high water mark. When it is reached,
+publish() waits for room (backpressure on the receive loop) or drops the
+block, depending on its timeout.
+
+Keep the message layout in sync with server/utils/iq_stream.py.
+"""
+import logging
+import yaml
+import zmq
+import numpy as np
+
+from .client_logger import *
+from .client_com import tile_id_from_hostname
+from .constants import IQ_PUB_PORT
+from . import codec
+
+# Default number of blocks queued towards the server before publish() blocks or drops
+DEFAULT_HWM = 64
+
+
+def iq_topic(tile_id):
+    return f"iq/{tile_id}/"
+
+
+class IQPublisher:
+    """
+    Publish IQ sample blocks of this tile to the server.
+
+    Not thread-safe: publish from a single thread, e.g. the receive loop.
+
+        publisher = IQPublisher(args.config_file)
+        publisher.publish(samples, md.time_spec.get_real_secs(), sample_rate=SAMPLE_RATE)
+        ...
+        publisher.close()
+    """
+
+    def __init__(self, config_path="client_config.yaml", hostname=None, context=None, hwm=DEFAULT_HWM):
+        """
+        Parameters
+        ----------
+        config_path : str
+            Path to the experiment settings YAML file.
+        hostname : str, optional
+            Hostname to derive the tile ID from, defaults to the machine's
+            hostname.
+        context : zmq.Context, optional
+            Shared ZMQ context. A shared context is not terminated by close().
+        hwm : int
+            Maximum number of blocks queued towards the server.
+        """
+        self.logger = get_logger(__name__, level=logging.DEBUG)
+
+        with open(config_path, "r", encoding="utf-8") as f:
+            experiment_settings = yaml.safe_load(f)
+        server_settings = experiment_settings.get("server", {})
+        host = server_settings.get("host", "")
+        iq_port = server_settings.get("iq_port", IQ_PUB_PORT)
+        self.endpoint = f"tcp://{host}:{iq_port}"
+
+        self.tile_id = tile_id_from_hostname(hostname)
+        self.topic = iq_topic(self.tile_id).encode()
+
+        self._own_context = context is None
+        self.context = zmq.Context() if context is None else context
+        # XPUB with NODROP: at the high water mark sends fail with EAGAIN
+        # instead of silently dropping, so publish() can apply backpressure
+        self.socket = self.context.socket(zmq.XPUB)
+        self.socket.setsockopt(zmq.XPUB_NODROP, 1)
+        self.socket.setsockopt(zmq.SNDHWM, hwm)
+        self.socket.connect(self.endpoint)
+
+        # Current send timeout (ms) of the socket, see publish()
+        self._sndtimeo = -1
+        # Block sequence number and counters
+        self.seq = 0
+        self.sent = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+
+        self.logger.debug("IQ publisher for tile %s connecting to %s (hwm=%d)", self.tile_id, self.endpoint, hwm)
+
+    def publish(self, samples, timestamp, timeout=None, track=False, **metadata):
+        """
+        Publish one block of samples.
+
+        The samples are sent without copying: the buffer must not be modified
+        until it has been sent. Pass a fresh array per block, or track=True
+        and wait on the returned tracker before reusing a buffer.
+
+        Parameters
+        ----------
+        samples : numpy.ndarray
+            Sample block, the first axis counts samples.
+        timestamp : float
+            Hardware time of the first sample [s].
+        timeout : float, optional
+            Seconds to wait for room when the high water mark is reached;
+            None waits indefinitely, 0 drops the block right away.
+        track : bool
+            Return a zmq.MessageTracker of the samples frame instead of True.
+        **metadata
+            Extra header fields, e.g. sample_rate or center_freq.
+
+        Returns
+        -------
+        bool or zmq.MessageTracker
+            False if the block was dropped, otherwise True (or the tracker).
+        """
+        self._drain_subscriptions()
+
+        samples = np.ascontiguousarray(samples)
+        header = {
+            "seq": self.seq,
+            "timestamp": timestamp,
+            "dtype": samples.dtype.str,
+            "shape": list(samples.shape),
+            **metadata,
+        }
+        self.seq += 1
+
+        # POLLOUT does not reflect the XPUB_NODROP high water mark, so wait
+        # in send() itself, bounded by the send timeout
+        sndtimeo = -1 if timeout is None else int(timeout * 1000)
+        if sndtimeo != self._sndtimeo:
+            self.socket.setsockopt(zmq.SNDTIMEO, sndtimeo)
+            self._sndtimeo = sndtimeo
+        try:
+            self.socket.send_multipart([self.topic, codec.JSON.encode(header)], zmq.SNDMORE)
+        except zmq.Again:
+            return self._drop(header)
+        # the first frame was queued, so the rest of the message is accepted
+        tracker = self.socket.send(samples, copy=False, track=track)
+        self.sent += 1
+        self.bytes_sent += samples.nbytes
+        return tracker if track else True
+
+    def close(self, linger_ms=1000):
+        """Close the socket, waiting up to linger_ms for queued blocks to be sent."""
+        self.socket.close(linger=linger_ms)
+        if self._own_context:
+            self.context.term()
+        self.logger.debug("IQ publisher closed: %d blocks sent, %d dropped", self.sent, self.dropped)
+
+    def _drop(self, header):
+        self.dropped += 1
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("IQ block %d dropped (send queue full)", header["seq"])
+        return False
+
+    def _drain_subscriptions(self):
+        # XPUB delivers the server's (un)subscriptions; nothing to do with them
+        try:
+            while True:
+                self.socket.recv(zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+
+__all__ = ["DEFAULT_HWM", "iq_topic", "IQPublisher"]
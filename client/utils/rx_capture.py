@@ -0,0 +1,208 @@
+"""
+Timed RX captures, started on the same device time on every tile.
+
+A capture command (e.g. 'usrp_sync' with dir="RX") is handled by
+RXCapture.handle on a CommandExecutor worker. The start time of the capture
+is taken from the command, in order of preference:
+
+  - start_time: server wall clock [s], scheduled by the server for the whole
+                fleet (USRP_Control.send_command(..., start_margin_s=...)).
+                Converted to the local clock with the offset the server
+                measured for this tile, then to device time.
+  - at:         absolute device (USRP) time [ms].
+  - delay:      time after reception of the command [ms].
+
+The stream is armed with that time, so the device starts sampling on it
+(UHD stream command with a time_spec), not when the software gets around to
+it. This only starts the tiles together if their device times agree: set
+them from a shared PPS or from the (synchronized) host clock first, see
+client-testing.py. The reply ('usrp_done') holds the requested and the
+actual device time of the first sample, the latter also converted to the
+server clock (comparable across tiles), the number of samples and the
+capture's statistics.
+Captures share the streamer and run one at a time: a command that arrives
+during a capture waits for it, and fails if it is still running at the
+command's start time.
+With a capture_dir the samples are recorded as well (see capture_file.py),
+one capture per command named <tile>-<UTC time>-<cmd_id> (cmd_ids restart
+with every server run), and the reply holds the file name:
+
+    executor.register("usrp_sync", RXCapture(engine, usrp.get_time_now().get_real_secs, client).handle)
+"""
+import logging
+import os
+import threading
+import time
+
+from .client_logger import *
+from .capture_file import CaptureWriter
+from .rx_stats import RXStats
+from .spectral import WelchPSD, summarize
+
+# Samples captured when the command does not say
+DEFAULT_NUM_SAMPS = 100000
+# Extra time to wait for the first sample after the start time [s]
+START_TIMEOUT_S = 1.0
+
+
+class RXCapture:
+    def __init__(self, engine, device_time, client=None, sample_rate=None, center_freq=0.0, gain=None,
+                 capture_dir=None):
+        """
+        Parameters
+        ----------
+        engine : RXEngine
+            Engine of the streamer to capture with, not running.
+        device_time : callable
+            Returns the current device time [s], e.g.
+            usrp.get_time_now().get_real_secs (time.time for a simulated device).
+        client : Client, optional
+            Used to convert "start_time" to the local clock.
+        sample_rate : float, optional
+            Sample rate [Hz], needed for spectral summaries.
+        center_freq : float
+            Center frequency [Hz], for spectral summaries and recordings.
+        gain : float, optional
+            Receive gain [dB], stored in recordings.
+        capture_dir : str, optional
+            Record every capture to this directory (needs sample_rate).
+        """
+        self.logger = get_logger(__name__, level=logging.DEBUG)
+        self.engine = engine
+        self.device_time = device_time
+        self.client = client
+        self.sample_rate = sample_rate
+        self.center_freq = center_freq
+        self.gain = gain
+        self.capture_dir = capture_dir
+        # one capture at a time: they share the streamer, later ones wait
+        self._busy = threading.Lock()
+
+    def start_time(self, params):
+        """Return the device time [s] a command asks to start at (None: right away)."""
+        if params.get("start_time") is not None:
+            local = self.client.server_to_local(params["start_time"]) if self.client else params["start_time"]
+            return local + self._device_offset()
+        if params.get("at") is not None:
+            return params["at"] / 1000
+        if params.get("delay") is not None:
+            return self.device_time() + params["delay"] / 1000
+        return None
+
+    def server_time(self, device_time):
+        """Convert a device time [s] to the server wall clock (inverse of the start_time conversion)."""
+        local = device_time - self._device_offset()
+        return self.client.local_to_server(local) if self.client else local
+
+    def _device_offset(self):
+        return self.device_time() - time.time()  # device time - local wall clock
+
+    def handle(self, ctx):
+        """CommandExecutor handler: capture and return the result for 'usrp_done'."""
+        params = ctx.params
+        if params.get("dir", "RX").upper() != "RX":
+            raise ValueError(f"Only RX captures are supported, got dir={params.get('dir')}")
+        start = self.start_time(params)
+        self._wait_idle(ctx, start)
+        try:
+            return self.capture(ctx, start, params.get("num_samps", DEFAULT_NUM_SAMPS),
+                                params.get("spectrum", False), self._capture_path(ctx))
+        finally:
+            self._busy.release()
+
+    def capture(self, ctx, start, num_samps, spectrum=False, path=None):
+        """
+        Capture num_samps samples from device time start (None: now), and
+        record them to path (a CaptureWriter name) if given.
+
+        Raises TimeoutError if no sample arrives in time (e.g. the start time
+        had passed when the stream was armed) and CommandCancelled if ctx is
+        cancelled meanwhile.
+        """
+        stats = RXStats()
+        psd = WelchPSD(self.sample_rate, center_freq=self.center_freq) if spectrum and self.sample_rate else None
+        writer = None
+
+        armed = self.device_time()
+        if start is not None and start <= armed:
+            self.logger.warning("Capture start %.6f already passed (device time %.6f)", start, armed)
+        self.engine.start(start_time=start, num_samps=num_samps)
+        try:
+            first = self._first_block(ctx, max((start or armed) - armed, 0.0) + START_TIMEOUT_S)
+            if path is not None:
+                # created once the capture started, so failed captures leave no files
+                writer = CaptureWriter(path, self.sample_rate, self.center_freq, self.gain, self._tile_id(),
+                                       dtype=self.engine.ring.dtype, capacity_samps=num_samps,
+                                       description=f"{ctx.command} {ctx.cmd_id}")
+            actual = first.timestamp
+            received = 0
+            block = first
+            while block is not None:
+                stats.update(block.samples)
+                if psd is not None:
+                    psd.update(block.samples)
+                if writer is not None:
+                    writer.write(block.samples, block.timestamp, block.discontinuity)
+                received += block.num_samps
+                block.release()
+                ctx.check()
+                block = self.engine.get(timeout=START_TIMEOUT_S)
+        finally:
+            self.engine.stop()
+            if writer is not None:
+                writer.close(requested_start=start)
+
+        self.logger.info("Captured %d samples from %.6f (requested %s)", received, actual, start)
+        result = {
+            "requested_start": start,
+            "start_time": actual,
+            "server_start_time": self.server_time(actual),
+            "start_error_s": None if start is None else actual - start,
+            "armed_at": armed,
+            "num_samps": received,
+            "overflows": self.engine.overflows,
+            "dropped": self.engine.dropped,
+            "stats": stats.snapshot(),
+        }
+        if psd is not None:
+            result["spectrum"] = summarize(psd)
+        if writer is not None:
+            result["file"] = writer.path
+        return result
+
+    def _wait_idle(self, ctx, start):
+        """Take the streamer once the running capture (if any) finished, before start if given."""
+        waited = False
+        while not self._busy.acquire(timeout=0.1):
+            if not waited:
+                self.logger.info("Capture %s waits for the running capture", ctx.cmd_id)
+                waited = True
+            ctx.check()
+            if start is not None and self.device_time() >= start:
+                raise RuntimeError("Another capture was still running at the start time")
+
+    def _tile_id(self):
+        return self.client.client_id.decode() if self.client is not None else None
+
+    def _capture_path(self, ctx):
+        if not self.capture_dir or not self.sample_rate:
+            return None
+        # cmd_ids restart with the server, the time keeps names unique across runs
+        stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        name = f"{self._tile_id() or 'capture'}-{stamp}-{ctx.cmd_id if ctx.cmd_id is not None else 0}"
+        return os.path.join(self.capture_dir, name)
+
+    def _first_block(self, ctx, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            ctx.check()
+            block = self.engine.get(timeout=min(0.1, max(0.0, deadline - time.monotonic())))
+            if block is not None:
+                return block
+            if not self.engine.running or time.monotonic() >= deadline:
+                raise TimeoutError(
+                    f"Capture did not start ({self.engine.errors} RX errors, "
+                    f"{self.engine.timeouts} receive timeouts)")
+
+
+__all__ = ["DEFAULT_NUM_SAMPS", "START_TIMEOUT_S", "RXCapture"]
@@ -0,0 +1,512 @@
+"""
+Continuous RX streaming into a preallocated ring of sample blocks.
+
+RXEngine runs the streamer's recv() loop on a dedicated thread and fills the
+fixed-size blocks of a ring that is allocated once, up front:
+
+    streamer --recv()--> ring slot --get()--> consumer --release()--> free slots
+
+Consumers receive RXBlock objects whose samples are views into the ring (no
+copy) and hand the slot back with release() when they are done with it. When
+the consumer falls behind and no slot is free, the oldest block that was not
+picked up yet is overwritten (counted in `dropped`, visible as a gap in the
+block seq); blocks held by the consumer are never touched.
+
+The streamer is a UHD RX streamer (usrp.get_rx_stream(...)) or a
+SimulatedRXStreamer, which implements the same recv/issue_stream_cmd
+interface without a device, so throughput and overflow behavior can be
+tested on any machine. Other backends provide make_metadata() and
+make_stream_cmd() like the simulator.
+
+    engine = RXEngine(usrp.get_rx_stream(uhd.usrp.StreamArgs("fc32", "sc16")))
+    engine.start()
+    for block in engine:
+        process(block.samples, block.timestamp)
+        block.release()
+"""
+import enum
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from .client_logger import *
+
+try:
+    import uhd
+except ImportError:  # only needed for real devices, see SimulatedRXStreamer
+    uhd = None
+
+DEFAULT_BLOCK_SAMPS = 16384
+DEFAULT_NUM_BLOCKS = 64
+
+
+class RXError(enum.Enum):
+    """Simulated RX metadata error codes (names as in uhd.types.RXMetadataErrorCode)."""
+
+    none = 0x0
+    timeout = 0x1
+    late = 0x2
+    broken_chain = 0x4
+    overflow = 0x8
+    alignment = 0xC
+    bad_packet = 0xF
+
+
+class SimTimeSpec:
+    __slots__ = ("secs",)
+
+    def __init__(self, secs=0.0):
+        self.secs = secs
+
+    def get_real_secs(self):
+        return self.secs
+
+
+class SimRXMetadata:
+    """RX metadata of the simulated streamer (the fields RXEngine uses of uhd.types.RXMetadata)."""
+
+    def __init__(self):
+        self.time_spec = SimTimeSpec()
+        self.has_time_spec = False
+        self.error_code = RXError.none
+        self.out_of_sequence = False
+        self.end_of_burst = False
+
+    def strerror(self):
+        return f"ERROR_CODE_{self.error_code.name.upper()}"
+
+
+class SimStreamCommand:
+    __slots__ = ("mode", "num_samps", "stream_now", "time_spec")
+
+    def __init__(self, mode, num_samps=0, stream_now=True, time_spec=None):
+        self.mode = mode  # "start_cont", "stop_cont" or "num_done"
+        self.num_samps = num_samps
+        self.stream_now = stream_now
+        self.time_spec = time_spec
+
+
+class SimulatedRXStreamer:
+    """
+    Device-less stand-in for a UHD RX streamer.
+
+    Produces a complex tone plus white noise, timestamped on the wall clock
+    (like a USRP whose time was set from the host). In realtime mode samples
+    become available at sample_rate; if recv() is not called for longer than
+    the device FIFO holds (fifo_seconds), the samples in between are lost and
+    recv() reports an overflow, as UHD does. Without realtime, samples are
+    produced as fast as they are read, which measures the consumer's
+    throughput.
+
+    The tone is read from a precomputed table, so its frequency is rounded to
+    a multiple of sample_rate / TABLE_SAMPS.
+    """
+
+    TABLE_SAMPS = 1 << 16
+
+    def __init__(self, sample_rate=1e6, tone_freq=0.0, amplitude=0.5, noise=0.01, channels=1,
+                 max_samps=2040, realtime=True, fifo_seconds=0.05, seed=None):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.max_samps = max_samps
+        self.realtime = realtime
+        self.fifo_samps = int(fifo_seconds * sample_rate)
+        self.overflows = 0
+
+        rng = np.random.default_rng(seed)
+        n = np.arange(self.TABLE_SAMPS + max_samps)
+        bin_ = round(tone_freq * self.TABLE_SAMPS / sample_rate)
+        tone = amplitude * np.exp(2j * np.pi * bin_ * n / self.TABLE_SAMPS)
+        noise_std = noise / np.sqrt(2)
+        self._table = (tone + noise_std * (rng.standard_normal((channels, n.size))
+                                           + 1j * rng.standard_normal((channels, n.size)))).astype(np.complex64)
+        # the table repeats every TABLE_SAMPS, the extra max_samps avoid wrapping in a read
+        self._table[:, self.TABLE_SAMPS:] = self._table[:, :max_samps]
+
+        self._lock = threading.Lock()
+        self._streaming = False
+        self._remaining = None
+        # device time of the next sample, and its index (tone phase)
+        self._next_time = 0.0
+        self._index = 0
+        self._inject_overflow = False
+        self._late = False
+
+    # Same constructors for metadata and stream commands as in uhd.types
+    make_metadata = SimRXMetadata
+
+    @staticmethod
+    def make_stream_cmd(mode, num_samps=0, stream_now=True, time_spec=None):
+        return SimStreamCommand(mode, num_samps, stream_now, time_spec)
+
+    def get_max_num_samps(self):
+        return self.max_samps
+
+    def get_num_channels(self):
+        return self.channels
+
+    def issue_stream_cmd(self, cmd):
+        with self._lock:
+            if cmd.mode == "stop_cont":
+                self._streaming = False
+                return
+            if not cmd.stream_now and cmd.time_spec < time.time():
+                # like a USRP: a start time in the past fails with a late error
+                self._late = True
+                return
+            self._streaming = True
+            self._remaining = cmd.num_samps if cmd.mode == "num_done" else None
+            self._next_time = time.time() if cmd.stream_now else cmd.time_spec
+            self._index = 0
+
+    def inject_overflow(self):
+        """Make the next recv() report an overflow (and lose a FIFO worth of samples)."""
+        self._inject_overflow = True
+
+    def recv(self, buffer, metadata, timeout=0.1):
+        """Fill buffer (shape (n,) or (channels, n)) with up to max_samps samples; returns the count."""
+        metadata.error_code = RXError.none
+        metadata.has_time_spec = False
+        metadata.end_of_burst = False
+        with self._lock:
+            streaming = self._streaming
+            late, self._late = self._late, False
+        if late:
+            metadata.error_code = RXError.late
+            return 0
+        if not streaming:
+            time.sleep(timeout)
+            metadata.error_code = RXError.timeout
+            return 0
+
+        num = min(buffer.shape[-1], self.max_samps)
+        if self._remaining is not None:
+            num = min(num, self._remaining)
+
+        if self.realtime:
+            now = time.time()
+            if self._inject_overflow or now - self._next_time > self.fifo_samps / self.sample_rate:
+                # the device FIFO overflowed: continue with the samples arriving now
+                self._inject_overflow = False
+                skipped = max(self.fifo_samps, int((now - self._next_time) * self.sample_rate))
+                self._advance(skipped)
+                self.overflows += 1
+                metadata.error_code = RXError.overflow
+                return 0
+            # wait until the last requested sample has "arrived"
+            wait = self._next_time + num / self.sample_rate - now
+            if wait > timeout:
+                time.sleep(timeout)
+                metadata.error_code = RXError.timeout
+                return 0
+            if wait > 0:
+                time.sleep(wait)
+        elif self._inject_overflow:
+            self._inject_overflow = False
+            self._advance(self.fifo_samps)
+            self.overflows += 1
+            metadata.error_code = RXError.overflow
+            return 0
+
+        start = self._index % self.TABLE_SAMPS
+        if buffer.ndim == 1:
+            buffer[:num] = self._table[0, start:start + num]
+        else:
+            buffer[:, :num] = self._table[:buffer.shape[0], start:start + num]
+        metadata.time_spec = SimTimeSpec(self._next_time)
+        metadata.has_time_spec = True
+        self._advance(num)
+        if self._remaining is not None:
+            self._remaining -= num
+            if self._remaining == 0:
+                # the last sample of a num_done burst
+                metadata.end_of_burst = True
+                with self._lock:
+                    self._streaming = False
+        return num
+
+    def _advance(self, num):
+        self._index += num
+        self._next_time += num / self.sample_rate
+
+
+class RXBlock:
+    """A block of samples in the engine's ring; release() it when done."""
+
+    __slots__ = ("slot", "samples", "timestamp", "seq", "discontinuity", "_engine")
+
+    def __init__(self, engine, slot, samples, timestamp, seq, discontinuity):
+        self._engine = engine
+        self.slot = slot
+        # view into the ring, shape (n,) or (channels, n)
+        self.samples = samples
+        # device time of the first sample [s]
+        self.timestamp = timestamp
+        # block number; gaps are blocks dropped because the consumer fell behind
+        self.seq = seq
+        # the device lost samples (overflow) right before this block
+        self.discontinuity = discontinuity
+
+    @property
+    def num_samps(self):
+        return self.samples.shape[-1]
+
+    def release(self):
+        """Return the slot to the engine; the samples must not be used afterwards."""
+        if self._engine is not None:
+            self._engine._release(self.slot)
+            self._engine = None
+
+
+class RXEngine:
+    def __init__(self, streamer, block_samps=DEFAULT_BLOCK_SAMPS, num_blocks=DEFAULT_NUM_BLOCKS,
+                 dtype=np.complex64, recv_timeout=0.5):
+        """
+        Parameters
+        ----------
+        streamer : uhd.usrp.RXStreamer or SimulatedRXStreamer
+            Source of the samples.
+        block_samps : int
+            Samples per block (per channel).
+        num_blocks : int
+            Blocks in the ring.
+        dtype : numpy.dtype
+            Sample type, matching the streamer's CPU format (fc32: complex64).
+        recv_timeout : float
+            Timeout of a single recv() call [s].
+        """
+        self.logger = get_logger(__name__, level=logging.DEBUG)
+        self.streamer = streamer
+        self.block_samps = block_samps
+        self.num_blocks = num_blocks
+        self.recv_timeout = recv_timeout
+        self.channels = streamer.get_num_channels()
+
+        # The ring: every block is one slot, allocated once
+        shape = (num_blocks, block_samps) if self.channels == 1 else (num_blocks, self.channels, block_samps)
+        self.ring = np.zeros(shape, dtype=dtype)
+        # one extra slot to receive into while the consumer holds every block
+        self._scratch = np.zeros(shape[1:], dtype=dtype)
+        self._free = queue.SimpleQueue()
+        for slot in range(num_blocks):
+            self._free.put(slot)
+        # filled blocks, oldest first; None marks the end of the stream
+        self._filled = queue.Queue()
+
+        self.running = False
+        self.thread = None
+        # Counters of the current (or last) run
+        self.blocks = 0
+        self.samples = 0
+        self.overflows = 0
+        self.dropped = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def start(self, start_time=None, num_samps=None):
+        """
+        Start streaming and the recv thread.
+
+        Parameters
+        ----------
+        start_time : float, optional
+            Device time of the first sample [s], default: right away.
+        num_samps : int, optional
+            Stop after this many samples (per channel), default: continuous.
+        """
+        if self.thread is not None:
+            return  # already running
+
+        # blocks of a previous run that were not read
+        while True:
+            try:
+                block = self._filled.get_nowait()
+            except queue.Empty:
+                break
+            if block is not None:
+                block.release()
+        self.blocks = self.samples = self.overflows = self.dropped = self.timeouts = self.errors = 0
+
+        if num_samps is None:
+            cmd = self._stream_cmd("start_cont", stream_now=start_time is None, time_spec=start_time)
+        else:
+            cmd = self._stream_cmd("num_done", num_samps, start_time is None, start_time)
+        self.streamer.issue_stream_cmd(cmd)
+
+        self.running = True
+        self._num_samps = num_samps
+        self.thread = threading.Thread(target=self._run, name="rx-engine", daemon=True)
+        self.thread.start()
+        self.logger.debug("RX engine started: %d blocks of %d samples", self.num_blocks, self.block_samps)
+
+    def stop(self):
+        """
+        Stop streaming and wait for the recv thread; blocks already received
+        can still be read until the engine is started again.
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.logger.debug(
+            "RX engine stopped: %d blocks, %d overflows, %d dropped", self.blocks, self.overflows, self.dropped)
+
+    def get(self, timeout=None):
+        """
+        Return the next block, or None at the end of the stream (or after timeout seconds).
+        """
+        try:
+            block = self._filled.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if block is None:
+            # keep the end marker for further calls
+            self._filled.put(None)
+        return block
+
+    def __iter__(self):
+        while True:
+            block = self.get()
+            if block is None:
+                return
+            yield block
+
+    def read(self, num_samps, out=None, timeout=None):
+        """
+        Copy the next num_samps samples into out (allocated if None).
+
+        Returns the filled part of out, shorter than num_samps if the stream
+        ended (or timed out) first.
+        """
+        if out is None:
+            shape = (num_samps,) if self.channels == 1 else (self.channels, num_samps)
+            out = np.empty(shape, dtype=self.ring.dtype)
+        filled = 0
+        while filled < num_samps:
+            block = self.get(timeout)
+            if block is None:
+                break
+            n = min(block.num_samps, num_samps - filled)
+            out[..., filled:filled + n] = block.samples[..., :n]
+            block.release()
+            filled += n
+        return out[..., :filled]
+
+    def stats(self):
+        return {
+            "blocks": self.blocks,
+            "samples": self.samples,
+            "overflows": self.overflows,
+            "dropped": self.dropped,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "queued": self._filled.qsize(),
+        }
+
+    def _stream_cmd(self, mode, num_samps=0, stream_now=True, time_spec=None):
+        make_stream_cmd = getattr(self.streamer, "make_stream_cmd", None)
+        if make_stream_cmd is not None:
+            return make_stream_cmd(mode, num_samps, stream_now, time_spec)
+        cmd = uhd.types.StreamCMD(getattr(uhd.types.StreamMode, mode))
+        cmd.num_samps = num_samps
+        cmd.stream_now = stream_now
+        if not stream_now:
+            cmd.time_spec = uhd.types.TimeSpec(time_spec)
+        return cmd
+
+    def _make_metadata(self):
+        make_metadata = getattr(self.streamer, "make_metadata", None)
+        return make_metadata() if make_metadata is not None else uhd.types.RXMetadata()
+
+    def _acquire(self):
+        """Return a free slot, reclaiming the oldest unread block if needed (None: use the scratch slot)."""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        if self._filled.qsize() < 2:
+            # the consumer holds (almost) every block; keep the newest one readable
+            return None
+        oldest = self._filled.get_nowait()
+        self.dropped += 1
+        return oldest.slot
+
+    def _release(self, slot):
+        self._free.put(slot)
+
+    def _run(self):
+        metadata = self._make_metadata()
+        received = 0
+        seq = 0
+        lost = False
+        end_of_burst = False
+        try:
+            while self.running and not end_of_burst and (self._num_samps is None or received < self._num_samps):
+                slot = self._acquire()
+                buf = self._scratch if slot is None else self.ring[slot]
+                # never ask for more than the burst has left: the device does
+                # not send more, so recv would only wait for its timeout
+                want = self.block_samps if self._num_samps is None else min(self.block_samps,
+                                                                             self._num_samps - received)
+                filled = 0
+                timestamp = None
+                overflow = False
+                while filled < want and self.running:
+                    # a view per call, into the preallocated slot
+                    n = self.streamer.recv(buf[..., filled:want], metadata, self.recv_timeout)
+                    error = metadata.error_code.name
+                    if n and timestamp is None:
+                        timestamp = metadata.time_spec.get_real_secs()
+                    filled += n
+                    if metadata.end_of_burst:
+                        end_of_burst = True
+                        break
+                    if error == "none":
+                        continue
+                    if error == "timeout":
+                        self.timeouts += 1
+                        continue
+                    if error == "overflow":
+                        self.overflows += 1
+                        overflow = True
+                        # hand off what we have, the next block starts after the gap
+                        break
+                    self.errors += 1
+                    self.logger.error("RX error: %s", metadata.strerror())
+                    break
+
+                if not filled:
+                    if slot is not None:
+                        self._release(slot)
+                    lost = lost or overflow
+                    continue
+                received += filled
+                self.blocks += 1
+                self.samples += filled
+                if slot is None:
+                    # received into the scratch slot: nowhere to put it
+                    self.dropped += 1
+                else:
+                    self._filled.put(RXBlock(self, slot, self.ring[slot][..., :filled], timestamp, seq, lost))
+                    lost = overflow
+                seq += 1
+        finally:
+            try:
+                self.streamer.issue_stream_cmd(self._stream_cmd("stop_cont"))
+            except Exception as e:
+                self.logger.debug("Stopping the stream raised: %s", e)
+            self.running = False
+            self._filled.put(None)
+
+
+__all__ = [
+    "DEFAULT_BLOCK_SAMPS",
+    "DEFAULT_NUM_BLOCKS",
+    "RXError",
+    "SimulatedRXStreamer",
+    "RXBlock",
+    "RXEngine",
+]
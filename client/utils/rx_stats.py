@@ -0,0 +1,198 @@
+"""
+Streaming signal statistics of received samples.
+
+RXStats accumulates the statistics of a sample stream block by block, in
+constant memory: running float64 sums of I, Q, I^2, Q^2 and I*Q, the peak
+magnitude and the number of clipped samples. Every update is a few
+vectorized passes over the block, with scratch buffers that are allocated
+once, so arbitrarily long captures can be measured as the samples arrive:
+
+    stats = RXStats()
+    for block in engine:
+        stats.update(block.samples)
+        block.release()
+    print(stats.snapshot()["power_dbfs"])
+
+RXStatsReporter sends the statistics of every interval (and the running
+totals) to the server as 'rx_stats' messages, see server/utils/rx_stats.py.
+"""
+import math
+import time
+
+import numpy as np
+
+# Samples at or above this fraction of full scale (in I or Q) count as clipped
+DEFAULT_CLIP_LEVEL = 0.99
+
+
+def _db(value, factor=10):
+    return factor * math.log10(value) if value > 0 else float("-inf")
+
+
+class RXStats:
+    def __init__(self, full_scale=1.0, clip_level=DEFAULT_CLIP_LEVEL):
+        """
+        Parameters
+        ----------
+        full_scale : float
+            Amplitude of a full-scale sample: 1.0 for fc32, 32768 for sc16.
+        clip_level : float
+            Fraction of full scale from which a sample counts as clipped.
+        """
+        self.full_scale = full_scale
+        self.clip_level = clip_level
+        # scratch buffers, grown to the largest block
+        self._float = np.empty((0, 2), dtype=np.float32)
+        self._mag = np.empty(0, dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sum_i = 0.0
+        self.sum_q = 0.0
+        self.sum_ii = 0.0
+        self.sum_qq = 0.0
+        self.sum_iq = 0.0
+        self.peak = 0.0
+        self.clipped = 0
+
+    def update(self, samples):
+        """
+        Add a block of samples of one channel.
+
+        Parameters
+        ----------
+        samples : numpy.ndarray
+            Complex samples, shape (n,), or interleaved I/Q (e.g. sc16),
+            shape (n, 2).
+        """
+        if np.iscomplexobj(samples):
+            iq = np.ascontiguousarray(samples).view(samples.real.dtype).reshape(-1, 2)
+        else:
+            iq = samples.reshape(-1, 2)
+        n = len(iq)
+        if n == 0:
+            return
+        if len(self._mag) < n:
+            self._float = np.empty((n, 2), dtype=np.float32)
+            self._mag = np.empty(n, dtype=np.float32)
+        if iq.dtype != np.float32:
+            # integer samples would overflow in the products below
+            np.copyto(self._float[:n], iq)
+            iq = self._float[:n]
+        i, q = iq[:, 0], iq[:, 1]
+
+        self.count += n
+        self.sum_i += float(i.sum(dtype=np.float64))
+        self.sum_q += float(q.sum(dtype=np.float64))
+        self.sum_ii += float(np.dot(i, i))
+        self.sum_qq += float(np.dot(q, q))
+        self.sum_iq += float(np.dot(i, q))
+
+        mag = np.hypot(i, q, out=self._mag[:n])
+        self.peak = max(self.peak, float(mag.max()))
+
+        threshold = self.clip_level * self.full_scale
+        if max(-float(iq.min()), float(iq.max())) >= threshold:
+            # rare: only count when the block reaches the clip level at all
+            self.clipped += int(np.count_nonzero((np.abs(iq) >= threshold).any(axis=1)))
+
+    def merge(self, other):
+        """Add the statistics accumulated by other (e.g. of the last interval)."""
+        self.count += other.count
+        self.sum_i += other.sum_i
+        self.sum_q += other.sum_q
+        self.sum_ii += other.sum_ii
+        self.sum_qq += other.sum_qq
+        self.sum_iq += other.sum_iq
+        self.peak = max(self.peak, other.peak)
+        self.clipped += other.clipped
+
+    def snapshot(self):
+        """
+        Return the statistics so far; amplitudes and powers are relative to full scale.
+
+        Returns
+        -------
+        dict
+            samples, power, power_dbfs, rms, dc_i, dc_q, dc_dbfs,
+            iq_gain_imbalance_db, iq_phase_imbalance_deg, peak, peak_dbfs,
+            crest_factor_db, clipped and clipped_fraction (values are None
+            without samples).
+        """
+        n = self.count
+        if n == 0:
+            keys = ("power", "power_dbfs", "rms", "dc_i", "dc_q", "dc_dbfs", "iq_gain_imbalance_db",
+                    "iq_phase_imbalance_deg", "peak", "peak_dbfs", "crest_factor_db", "clipped_fraction")
+            return dict({key: None for key in keys}, samples=0, clipped=0)
+
+        scale = self.full_scale
+        power = (self.sum_ii + self.sum_qq) / n / scale ** 2
+        mean_i = self.sum_i / n
+        mean_q = self.sum_q / n
+        # IQ imbalance from the (DC-free) second moments of I and Q
+        var_i = max(self.sum_ii / n - mean_i ** 2, 0.0)
+        var_q = max(self.sum_qq / n - mean_q ** 2, 0.0)
+        cov = self.sum_iq / n - mean_i * mean_q
+        gain_db = _db(var_i / var_q) if var_q > 0 and var_i > 0 else None
+        phase_deg = (math.degrees(math.asin(max(-1.0, min(1.0, cov / math.sqrt(var_i * var_q)))))
+                     if var_i > 0 and var_q > 0 else None)
+        peak = self.peak / scale
+
+        return {
+            "samples": n,
+            "power": power,
+            "power_dbfs": _db(power),
+            "rms": math.sqrt(power),
+            "dc_i": mean_i / scale,
+            "dc_q": mean_q / scale,
+            "dc_dbfs": _db((mean_i ** 2 + mean_q ** 2) / scale ** 2),
+            "iq_gain_imbalance_db": gain_db,
+            "iq_phase_imbalance_deg": phase_deg,
+            "peak": peak,
+            "peak_dbfs": _db(peak, 20),
+            "crest_factor_db": _db(peak ** 2 / power) if power > 0 else None,
+            "clipped": self.clipped,
+            "clipped_fraction": self.clipped / n,
+        }
+
+
+class RXStatsReporter:
+    """
+    Accumulate RXStats and report them to the server every interval_s seconds.
+
+    Each 'rx_stats' message holds the statistics of the last interval
+    ("interval") and of the whole stream so far ("total"), plus any extra
+    fields given to the constructor (e.g. channel or center_freq). Call
+    update() from the thread that consumes the samples; sending is done
+    through Client.send, which is thread-safe.
+    """
+
+    MSG_TYPE = "rx_stats"
+
+    def __init__(self, client, interval_s=1.0, full_scale=1.0, clip_level=DEFAULT_CLIP_LEVEL, **fields):
+        self.client = client
+        self.interval_s = interval_s
+        self.fields = fields
+        self.interval = RXStats(full_scale, clip_level)
+        self.total = RXStats(full_scale, clip_level)
+        self._next_report = time.monotonic() + interval_s
+
+    def update(self, samples, timestamp=None):
+        """Add a block; reports if the interval elapsed."""
+        self.interval.update(samples)
+        if timestamp is not None:
+            self.fields["timestamp"] = timestamp
+        if time.monotonic() >= self._next_report:
+            self.report()
+
+    def report(self):
+        """Send the statistics of the current interval now and start a new one."""
+        interval = self.interval.snapshot()
+        self.total.merge(self.interval)
+        self.interval.reset()
+        self._next_report = time.monotonic() + self.interval_s
+        self.client.send(self.MSG_TYPE, dict(self.fields, interval=interval, total=self.total.snapshot()))
+
+
+__all__ = ["DEFAULT_CLIP_LEVEL", "RXStats", "RXStatsReporter"]
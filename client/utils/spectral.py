@@ -0,0 +1,285 @@
+"""
+Spectral measurements on received samples.
+
+WelchPSD averages the power spectra of windowed, overlapping segments of the
+blocks it is fed (Welch's method). Segments are taken as strided views of a
+block and transformed in batches: the window is computed once, windowing
+writes into a preallocated batch buffer and the FFTs of a batch are done in
+one call. scipy.fft is used when it is installed (it caches its FFT plans
+and runs batches on several cores), numpy.fft otherwise.
+
+The functions below reduce a PSD to a few numbers (band power, tones, SNR),
+and summarize() to a compact dict that can be sent to the server instead of
+the raw samples:
+
+    psd = WelchPSD(sample_rate=1e6, nfft=1024)
+    for block in engine:
+        psd.update(block.samples)
+        block.release()
+    summary = summarize(psd, band=(-50e3, 50e3))
+
+Powers are relative to full scale (1.0 for fc32 samples): the PSD is in
+FS^2/Hz, band powers in FS^2 and their dB values in dBFS.
+"""
+import math
+
+import numpy as np
+
+try:
+    import scipy.fft as _fft
+except ImportError:  # numpy.fft is slower, but always available
+    _fft = None
+
+DEFAULT_NFFT = 1024
+# Segments windowed and transformed per FFT call
+DEFAULT_BATCH = 64
+
+# Periodic windows, and the half-width of their main lobe in bins (the bins a
+# tone's power is spread over)
+WINDOWS = {
+    "rect": (lambda n: np.ones(n), 1),
+    "hann": (lambda n: 0.5 - 0.5 * np.cos(2 * np.pi * n / n.size), 2),
+    "hamming": (lambda n: 0.54 - 0.46 * np.cos(2 * np.pi * n / n.size), 2),
+    "blackman": (lambda n: 0.42 - 0.5 * np.cos(2 * np.pi * n / n.size) + 0.08 * np.cos(4 * np.pi * n / n.size), 3),
+}
+
+
+def _db(value):
+    return 10 * math.log10(value) if value > 0 else float("-inf")
+
+
+class WelchPSD:
+    def __init__(self, sample_rate, nfft=DEFAULT_NFFT, overlap=0.5, window="hann", center_freq=0.0,
+                 batch=DEFAULT_BATCH, workers=None):
+        """
+        Parameters
+        ----------
+        sample_rate : float
+            Sample rate [Hz].
+        nfft : int
+            Segment (and FFT) length; the frequency resolution is
+            sample_rate / nfft.
+        overlap : float
+            Overlap of consecutive segments, as a fraction of nfft.
+        window : str
+            One of WINDOWS.
+        center_freq : float
+            Added to the frequencies, so bands can be given as RF frequencies.
+        batch : int
+            Segments transformed per FFT call.
+        workers : int, optional
+            Threads per FFT call (scipy.fft only), default: one.
+        """
+        if window not in WINDOWS:
+            raise ValueError(f"Unknown window '{window}', expected one of {sorted(WINDOWS)}")
+        self.sample_rate = sample_rate
+        self.nfft = nfft
+        self.step = max(1, int(round(nfft * (1 - overlap))))
+        self.center_freq = center_freq
+        self.batch = batch
+        self.workers = workers
+
+        make_window, self.mainlobe_bins = WINDOWS[window]
+        self.window = make_window(np.arange(nfft)).astype(np.float32)
+        # density scaling: a tone of power P integrates to P, white noise of
+        # variance s^2 to s^2 over the full band
+        self._scale = 1.0 / (sample_rate * float(np.sum(self.window.astype(np.float64) ** 2)))
+        self.bin_width = sample_rate / nfft
+
+        # allocated on the first update, for the channel layout of the blocks
+        self._buf = None
+        self._mag = None
+        self.reset()
+
+    def reset(self):
+        """Forget the segments averaged so far."""
+        self.segments = 0
+        self._acc = None
+
+    def update(self, samples):
+        """
+        Add the segments of a block.
+
+        Segments do not span blocks: samples after the last complete segment
+        of a block are not used, so use blocks that are a multiple of the
+        segment step (or much longer than nfft).
+
+        Parameters
+        ----------
+        samples : numpy.ndarray
+            Complex samples, shape (n,) or (channels, n).
+        """
+        if samples.shape[-1] < self.nfft:
+            return
+        # (..., segments, nfft) view on the block, no copy
+        segments = np.lib.stride_tricks.sliding_window_view(samples, self.nfft, axis=-1)[..., ::self.step, :]
+        lead = samples.shape[:-1]
+        if self._buf is None or self._buf.shape[:-2] != lead:
+            self._buf = np.empty(lead + (self.batch, self.nfft), dtype=np.complex64)
+            self._mag = np.empty(lead + (self.batch, self.nfft), dtype=np.float32)
+        if self._acc is None:
+            self._acc = np.zeros(lead + (self.nfft,), dtype=np.float64)
+
+        count = segments.shape[-2]
+        for start in range(0, count, self.batch):
+            n = min(self.batch, count - start)
+            buf = self._buf[..., :n, :]
+            np.multiply(segments[..., start:start + n, :], self.window, out=buf)
+            if _fft is not None:
+                spectra = _fft.fft(buf, axis=-1, overwrite_x=True, workers=self.workers)
+            else:
+                spectra = np.fft.fft(buf, axis=-1)
+            mag = np.abs(spectra, out=self._mag[..., :n, :])
+            mag *= mag
+            self._acc += mag.sum(axis=-2)
+        self.segments += count
+
+    def freqs(self):
+        """Bin frequencies [Hz], ascending (center_freq in the middle)."""
+        return self.center_freq + np.fft.fftshift(np.fft.fftfreq(self.nfft, 1 / self.sample_rate))
+
+    def psd(self):
+        """Averaged PSD [FS^2/Hz], shape (nfft,) or (channels, nfft), matching freqs(); None before any segment."""
+        if not self.segments:
+            return None
+        return np.fft.fftshift(self._acc * (self._scale / self.segments), axes=-1)
+
+
+def band_power(psd, freqs, f_lo, f_hi):
+    """Power in [f_lo, f_hi) [FS^2], per channel for a 2-D psd."""
+    df = freqs[1] - freqs[0]
+    mask = (freqs >= f_lo) & (freqs < f_hi)
+    return psd[..., mask].sum(axis=-1) * df
+
+
+def noise_floor(psd):
+    """Noise density estimate [FS^2/Hz]: the median bin, which ignores tones and narrow signals."""
+    return np.median(psd, axis=-1)
+
+
+def detect_tones(psd, freqs, threshold_db=10.0, max_tones=5, mainlobe_bins=2):
+    """
+    Find the strongest tones of a 1-D PSD.
+
+    A tone is a local maximum more than threshold_db above the noise floor.
+    Its power is summed over its main lobe (mainlobe_bins on either side,
+    see WelchPSD.mainlobe_bins), minus the noise in those bins.
+
+    Returns
+    -------
+    list of dict
+        freq [Hz], power_dbfs and snr_db (against the noise in one bin),
+        strongest first.
+    """
+    floor = float(noise_floor(psd))
+    df = float(freqs[1] - freqs[0])
+    threshold = floor * 10 ** (threshold_db / 10)
+    inner = psd[1:-1]
+    peaks = np.flatnonzero((inner > psd[:-2]) & (inner >= psd[2:]) & (inner > threshold)) + 1
+
+    tones = []
+    taken = np.zeros(len(psd), dtype=bool)
+    for i in peaks[np.argsort(psd[peaks])[::-1]]:
+        if taken[i]:
+            continue  # a side lobe of a stronger tone
+        lo, hi = max(0, i - mainlobe_bins), min(len(psd), i + mainlobe_bins + 1)
+        taken[lo:hi] = True
+        power = max(float(psd[lo:hi].sum() - floor * (hi - lo)) * df, 0.0)
+        # interpolate the peak frequency between bins (parabola through the log magnitudes)
+        offset = 0.0
+        if 0 < i < len(psd) - 1:
+            a, b, c = np.log(psd[i - 1:i + 2])
+            if a - 2 * b + c != 0:
+                offset = 0.5 * (a - c) / (a - 2 * b + c)
+        tones.append({
+            "freq": float(freqs[i] + offset * df),
+            "power_dbfs": _db(power),
+            "snr_db": _db(power / (floor * df)),
+        })
+        if len(tones) == max_tones:
+            break
+    return tones
+
+
+def channel_snr(psd, freqs, f_lo, f_hi):
+    """
+    SNR [dB] of the signal in [f_lo, f_hi) of a 1-D PSD.
+
+    The noise density is the noise floor of the bins outside the band, the
+    signal power what the band holds above it.
+    """
+    mask = (freqs >= f_lo) & (freqs < f_hi)
+    if mask.all() or not mask.any():
+        raise ValueError("The band must hold some, but not all bins")
+    floor = float(noise_floor(psd[~mask]))
+    df = float(freqs[1] - freqs[0])
+    noise = floor * df * int(mask.sum())
+    signal = max(float(psd[mask].sum()) * df - noise, 0.0)
+    return _db(signal / noise) if noise > 0 else float("inf")
+
+
+def summarize(welch, band=None, bins=128, threshold_db=10.0, max_tones=5):
+    """
+    Reduce the PSD of a 1-D WelchPSD to a compact, JSON-serializable dict.
+
+    Parameters
+    ----------
+    welch : WelchPSD
+        Accumulated PSD of a single channel.
+    band : (float, float), optional
+        Channel (f_lo, f_hi) [Hz, same axis as welch.freqs()] for the
+        in-band/out-of-band power and SNR.
+    bins : int
+        Bins of the decimated PSD in the summary (averages of neighboring
+        bins; nfft if larger).
+    threshold_db, max_tones
+        Tone detection parameters, see detect_tones.
+
+    Returns
+    -------
+    dict
+        segments, bin_width, total_power_dbfs, noise_floor_dbfs_hz, tones,
+        psd_dbfs_hz (bins values, 0.01 dB resolution) with psd_f_start and
+        psd_f_step [Hz], and with a band: in_band_power_dbfs,
+        out_of_band_power_dbfs and snr_db.
+    """
+    psd = welch.psd()
+    if psd is None:
+        return {"segments": 0}
+    freqs = welch.freqs()
+    df = welch.bin_width
+    total = float(psd.sum()) * df
+
+    bins = min(bins, len(psd))
+    decimated = psd[:len(psd) // bins * bins].reshape(bins, -1).mean(axis=-1)
+    step = df * (len(psd) // bins)
+    summary = {
+        "segments": welch.segments,
+        "bin_width": df,
+        "total_power_dbfs": _db(total),
+        "noise_floor_dbfs_hz": _db(float(noise_floor(psd))),
+        "tones": detect_tones(psd, freqs, threshold_db, max_tones, welch.mainlobe_bins),
+        # the bin centers of the decimated PSD start at psd_f_start
+        "psd_f_start": float(freqs[0]) + (step - df) / 2,
+        "psd_f_step": step,
+        "psd_dbfs_hz": np.round(10 * np.log10(np.maximum(decimated, 1e-30)), 2).tolist(),
+    }
+    if band is not None:
+        in_band = float(band_power(psd, freqs, *band))
+        summary["in_band_power_dbfs"] = _db(in_band)
+        summary["out_of_band_power_dbfs"] = _db(max(total - in_band, 0.0))
+        summary["snr_db"] = channel_snr(psd, freqs, *band)
+    return summary
+
+
+__all__ = [
+    "DEFAULT_NFFT",
+    "DEFAULT_BATCH",
+    "WINDOWS",
+    "WelchPSD",
+    "band_power",
+    "noise_floor",
+    "detect_tones",
+    "channel_snr",
+    "summarize",
+]
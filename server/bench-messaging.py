@@ -0,0 +1,343 @@
+from utils.server_com import ServerSideCom
+from utils.usrp_control import USRP_Control
+from utils import codec
+import argparse
+import config
+import importlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import yaml
+import zmq
+
+"""
+Microbenchmarks of the messaging hot paths of the control plane.
+
+Benchmarks:
+  - send:            ServerSideCom.send throughput to one client
+  - send_batch:      ServerSideCom.send_batch throughput (batches of 100)
+  - broadcast:       ServerSideCom.broadcast throughput to --clients clients
+  - command_rtt:     USRP_Control.send_command round trip (ACK + DONE)
+  - client_dispatch: Client._handle_server_message cost per command (no I/O)
+  - heartbeat:       ServerSideCom heartbeat processing per message (no I/O)
+
+The network benchmarks run over loopback TCP and/or inproc, for every codec
+and with optional socket options applied to the server and client sockets.
+Results are printed and can be written as JSON (--json) to compare runs:
+
+    python3 bench-messaging.py --json before.json
+    python3 bench-messaging.py --codec msgpack --sockopt SNDHWM=0 --sockopt RCVHWM=0
+"""
+
+"""Parse the command line arguments"""
+parser = argparse.ArgumentParser(description="Benchmark the server/client messaging hot paths.")
+parser.add_argument("--transport", nargs="+", choices=["tcp", "inproc"], default=["tcp", "inproc"])
+parser.add_argument("--codec", nargs="+", choices=["json", "msgpack"], default=codec.supported_codecs())
+parser.add_argument("--sockopt", action="append", default=[], metavar="NAME=VALUE",
+                    help="ZMQ socket option for all sockets, e.g. SNDHWM=0 (repeatable)")
+parser.add_argument("--bench", nargs="+",
+                    choices=["send", "send_batch", "broadcast", "command_rtt", "client_dispatch", "heartbeat"],
+                    default=["send", "send_batch", "broadcast", "command_rtt", "client_dispatch", "heartbeat"])
+parser.add_argument("--messages", type=int, default=20000, help="Messages per throughput benchmark")
+parser.add_argument("--clients", type=int, default=8, help="Clients of the broadcast/command_rtt benchmarks")
+parser.add_argument("--iterations", type=int, default=500, help="Commands of the command_rtt benchmark")
+parser.add_argument("--port", type=int, default=25700, help="First TCP port to use")
+parser.add_argument("--json", type=str, help="Write the results to this file")
+
+args = parser.parse_args()
+
+# Typical command header
+HEADER = {"cmd_id": 1, "at": 10, "dir": "RX", "timeout_s": 10}
+RECV_TIMEOUT_S = 30
+
+# client/utils is a separate "utils" package, load it under another name
+_client_utils = types.ModuleType("client_utils")
+_client_utils.__path__ = [os.path.join(config.PROJECT_DIR, "client", "utils")]
+sys.modules["client_utils"] = _client_utils
+Client = importlib.import_module("client_utils.client_com").Client
+client_codec = importlib.import_module("client_utils.codec")
+
+
+def parse_sockopts(options):
+    parsed = []
+    for option in options:
+        name, _, value = option.partition("=")
+        parsed.append((getattr(zmq, name.upper()), int(value)))
+    return parsed
+
+
+SOCKOPTS = parse_sockopts(args.sockopt)
+
+
+def percentiles_us(values):
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1e6
+    return {"p50": pick(0.50), "p99": pick(0.99), "max": values[-1] * 1e6}
+
+
+def result(name, transport, codec_name, ops, seconds, **extra):
+    return dict(
+        bench=name,
+        transport=transport,
+        codec=codec_name,
+        sockopts=args.sockopt,
+        ops=ops,
+        seconds=seconds,
+        ops_per_s=ops / seconds if seconds > 0 else None,
+        **extra,
+    )
+
+
+class Setup:
+    """A started server with n connected clients that all negotiated codec_name."""
+
+    def __init__(self, settings_file, transport, codec_name, n_clients):
+        if transport == "inproc":
+            self.context = zmq.Context()
+            endpoints = ("inproc://bench-messaging", "inproc://bench-sync")
+        else:
+            self.context = None
+            endpoints = (f"tcp://127.0.0.1:{args.port}", f"tcp://127.0.0.1:{args.port + 1}")
+
+        self.server = ServerSideCom(settings_file, context=self.context, endpoints=endpoints)
+        for sock in (self.server.messaging, self.server.sync):
+            for option, value in SOCKOPTS:
+                sock.setsockopt(option, value)
+        self.usrp = USRP_Control(self.server)
+        self.usrp.start()
+
+        self.received = 0
+        self.target = 0
+        self.last_received_at = 0.0
+        self.all_received = threading.Event()
+        self._count_lock = threading.Lock()
+
+        self.clients = []
+        for i in range(n_clients):
+            client = Client(settings_file, hostname=f"rpi-BENCH{i}", context=self.context)
+            client.messaging_endpoint, client.sync_endpoint = endpoints
+            # advertise only the codec under test
+            client._heartbeat_frames[1] = client_codec.JSON.encode({"codecs": [codec_name]})
+            for sock in (client.messaging, client.sync):
+                for option, value in SOCKOPTS:
+                    sock.setsockopt(option, value)
+            client.on("bench", self._on_bench)
+            client.on("usrp_sync", self._make_command_handler(client))
+            client.start()
+            self.clients.append(client)
+
+        ids = [c.client_id for c in self.clients]
+        missing = self.server.wait_for_clients(ids, 10)
+        if missing:
+            raise RuntimeError(f"Clients did not connect: {missing}")
+        deadline = time.monotonic() + 10
+        while not all(self.server.clients[cid].subscribed for cid in ids):
+            if time.monotonic() > deadline:
+                raise RuntimeError("Clients did not confirm their subscriptions")
+            time.sleep(0.01)
+        # let the SUB subscriptions reach the PUB socket
+        time.sleep(0.3)
+        self.usrp.set_required_hosts([cid.decode() for cid in ids])
+
+    def _on_bench(self, command, cmd_args):
+        with self._count_lock:
+            self.received += 1
+            self.last_received_at = time.perf_counter()
+            if self.received == self.target:
+                self.all_received.set()
+
+    @staticmethod
+    def _make_command_handler(client):
+        def handle(command, cmd_args):
+            client.respond("usrp_ack", cmd_args)
+            client.respond("usrp_done", cmd_args)
+        return handle
+
+    def expect(self, n):
+        with self._count_lock:
+            self.received = 0
+            self.target = n
+            self.all_received.clear()
+
+    def wait_received(self):
+        """Wait for the expected messages; return the count and when the last one arrived."""
+        self.all_received.wait(RECV_TIMEOUT_S)
+        return self.received, self.last_received_at
+
+    def close(self):
+        for client in self.clients:
+            client.stop()
+        for client in self.clients:
+            client.join()
+        self.server.stop()
+        self.server.join()
+        if self.context is not None:
+            self.context.term()
+
+
+def bench_send(setup, transport, codec_name, batch=False):
+    cid = setup.clients[0].client_id
+    n = args.messages
+    setup.expect(n)
+    t0 = time.perf_counter()
+    if batch:
+        for i in range(0, n, 100):
+            setup.server.send_batch([(cid, "bench", HEADER)] * min(100, n - i))
+    else:
+        for _ in range(n):
+            setup.server.send(cid, "bench", HEADER)
+    # if messages were dropped, the rate is taken up to the last delivery
+    delivered, last = setup.wait_received()
+    seconds = last - t0
+    return result("send_batch" if batch else "send", transport, codec_name, delivered, seconds,
+                  sent=n, clients=1)
+
+
+def bench_broadcast(setup, transport, codec_name):
+    n = args.messages
+    setup.expect(n * len(setup.clients))
+    t0 = time.perf_counter()
+    for _ in range(n):
+        setup.server.broadcast("bench", HEADER)
+    # if messages were dropped, the rate is taken up to the last delivery
+    delivered, last = setup.wait_received()
+    seconds = last - t0
+    return result("broadcast", transport, codec_name, delivered, seconds,
+                  sent=n, clients=len(setup.clients))
+
+
+def bench_command_rtt(setup, transport, codec_name):
+    latencies = []
+    for _ in range(args.iterations):
+        t0 = time.perf_counter()
+        setup.usrp.send_command(setup.usrp.Command.SYNC, timeout_s=5)
+        latencies.append(time.perf_counter() - t0)
+    return result("command_rtt", transport, codec_name, len(latencies), sum(latencies),
+                  clients=len(setup.clients), latency_us=percentiles_us(latencies))
+
+
+def bench_client_dispatch(settings_file, codec_name):
+    header_codec = client_codec.MSGPACK if codec_name == "msgpack" else client_codec.JSON
+    client = Client(settings_file, hostname="rpi-BENCH0")
+    client.on("usrp_sync", lambda command, cmd_args: None)
+    frames = [zmq.Frame(b"usrp_sync"), zmq.Frame(header_codec.encode(HEADER))]
+
+    n = args.messages
+    for _ in range(1000):  # warm-up
+        client._handle_server_message(frames)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        client._handle_server_message(frames)
+    seconds = time.perf_counter() - t0
+    client.context.destroy(linger=0)
+    return result("client_dispatch", "none", codec_name, n, seconds, ns_per_op=seconds / n * 1e9)
+
+
+def bench_heartbeat(settings_file, codec_name, n_clients=1000):
+    server = ServerSideCom(settings_file, endpoints=(f"tcp://127.0.0.1:{args.port}", f"tcp://127.0.0.1:{args.port + 1}"))
+    heartbeat = codec.JSON.encode({"codecs": [codec_name]})
+    messages = [
+        [zmq.Frame(f"BENCH{i}".encode()), zmq.Frame(b"heartbeat"), zmq.Frame(heartbeat)]
+        for i in range(n_clients)
+    ]
+    for frames in messages:  # register all clients
+        server._handle_frames(frames)
+
+    n = args.messages
+    t0 = time.perf_counter()
+    for i in range(n):
+        # one loop iteration of ServerSideCom.run
+        server._handle_frames(messages[i % n_clients])
+        server._run_timers()
+    seconds = time.perf_counter() - t0
+    server._cleanup()
+    return result("heartbeat", "none", codec_name, n, seconds, clients=n_clients, ns_per_op=seconds / n * 1e9)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=config.PROJECT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(r):
+    line = f"{r['bench']:<16} {r['transport']:<7} {r['codec']:<8} {r['ops_per_s'] or 0:>12.0f} ops/s"
+    if "sent" in r and r["ops"] != r["sent"] * r["clients"]:
+        # messages dropped at a high water mark
+        line += f"  (delivered {r['ops']}/{r['sent'] * r['clients']})"
+    if "latency_us" in r:
+        lat = r["latency_us"]
+        line += f"  p50 {lat['p50']:.0f} us  p99 {lat['p99']:.0f} us  max {lat['max']:.0f} us"
+    if "ns_per_op" in r:
+        line += f"  {r['ns_per_op']:.0f} ns/op"
+    print(line)
+
+
+if __name__ == "__main__":
+    # Client loggers are created at DEBUG level, which would dominate the timings
+    logging.disable(logging.INFO)
+
+    for codec_name in args.codec:
+        if codec_name not in codec.supported_codecs():
+            parser.error(f"codec {codec_name} is not available (is msgpack installed?)")
+
+    settings = {
+        "server": {"host": "127.0.0.1", "messaging_port": args.port, "sync_port": args.port + 1},
+        "heartbeat_interval": 10,
+        "clock_sync_interval": 0,
+    }
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        yaml.safe_dump(settings, f)
+        settings_file = f.name
+
+    network = [b for b in args.bench if b in ("send", "send_batch", "broadcast", "command_rtt")]
+    results = []
+    try:
+        for codec_name in args.codec:
+            if "client_dispatch" in args.bench:
+                results.append(bench_client_dispatch(settings_file, codec_name))
+                print_result(results[-1])
+            if "heartbeat" in args.bench:
+                results.append(bench_heartbeat(settings_file, codec_name))
+                print_result(results[-1])
+
+            for transport in args.transport if network else []:
+                setup = Setup(settings_file, transport, codec_name, args.clients)
+                try:
+                    for name in network:
+                        if name == "send":
+                            results.append(bench_send(setup, transport, codec_name))
+                        elif name == "send_batch":
+                            results.append(bench_send(setup, transport, codec_name, batch=True))
+                        elif name == "broadcast":
+                            results.append(bench_broadcast(setup, transport, codec_name))
+                        elif name == "command_rtt":
+                            results.append(bench_command_rtt(setup, transport, codec_name))
+                        print_result(results[-1])
+                finally:
+                    setup.close()
+    finally:
+        os.unlink(settings_file)
+
+    if args.json:
+        report = {
+            "timestamp": time.time(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "pyzmq": zmq.__version__,
+            "libzmq": zmq.zmq_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
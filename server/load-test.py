@@ -0,0 +1,204 @@
+from utils.server_com import ServerSideCom
+from utils.usrp_control import USRP_Control
+import argparse
+import config
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+"""
+Load test of the control plane with simulated tiles.
+
+For every swarm size N, a ServerSideCom/USRP_Control pair is started in this
+process and N simulated tiles (client/sim-tiles.py) are spawned across a few
+processes on localhost. Once all tiles are connected, a storm of alternating
+SYNC/PILOT commands is sent and the following is reported:
+
+  - connect:    time until all N tiles registered
+  - fan-out:    command submit -> last usrp_ack
+  - completion: command submit -> last usrp_done
+  - server CPU: user+sys time of this process during the storm
+
+Example:
+    python3 load-test.py --tiles 10 100 1000 5000 --commands 50 --work-delay 0.01
+"""
+
+"""Parse the command line arguments"""
+parser = argparse.ArgumentParser(description="Load test the server with simulated tiles.")
+parser.add_argument("--tiles", type=int, nargs="+", default=[10, 100, 500, 1000, 2000, 5000],
+                    help="Swarm sizes to test")
+parser.add_argument("--commands", type=int, default=20, help="Commands per swarm size")
+parser.add_argument("--in-flight", type=int, default=1, help="Commands submitted back to back before waiting")
+parser.add_argument("--work-delay", type=float, default=0.0, help="Fake work time of the tiles [s]")
+parser.add_argument("--work-jitter", type=float, default=0.0, help="Uniform +/- jitter on the work time [s]")
+parser.add_argument("--tiles-per-process", type=int, default=250, help="Simulated tiles per client process")
+parser.add_argument("--connect-timeout", type=float, default=60.0, help="Max time for the swarm to connect [s]")
+parser.add_argument("--command-timeout", type=float, default=10.0, help="Max time per command [s]")
+parser.add_argument("--settle", type=float, default=1.0,
+                    help="Wait after connecting so all PUB subscriptions are active [s]")
+parser.add_argument("--keep-going", action="store_true", help="Continue after a swarm size failed")
+parser.add_argument("--json", type=str, help="Also write the results to this file")
+
+args = parser.parse_args()
+
+settings_path = os.path.join(config.PROJECT_DIR, "experiment-settings.yaml")
+sim_tiles_path = os.path.join(config.PROJECT_DIR, "client", "sim-tiles.py")
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of values (None if empty)."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def spawn_swarm(settings_file, tile_ids):
+    procs = []
+    for i in range(0, len(tile_ids), args.tiles_per_process):
+        cmd = [
+            sys.executable, sim_tiles_path,
+            "--config-file", settings_file,
+            "--work-delay", str(args.work_delay),
+            "--work-jitter", str(args.work_jitter),
+            "--ids", *tile_ids[i:i + args.tiles_per_process],
+        ]
+        procs.append(subprocess.Popen(cmd, cwd=os.path.dirname(sim_tiles_path)))
+    return procs
+
+
+def stop_swarm(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def run(settings_file, n_tiles):
+    """Run the command storm against n_tiles simulated tiles and return the results."""
+    result = {"tiles": n_tiles, "ok": False}
+    tile_ids = [f"S{i:05d}" for i in range(n_tiles)]
+
+    server = ServerSideCom(settings_file)
+    usrp = USRP_Control(server)
+    usrp.start()
+    usrp.set_required_hosts(tile_ids)
+
+    t0 = time.monotonic()
+    procs = spawn_swarm(settings_file, tile_ids)
+    try:
+        try:
+            usrp.wait_until_connected(timeout_s=args.connect_timeout)
+        except TimeoutError:
+            result["connected"] = len(server.get_connected())
+            return result
+        result["connect_s"] = time.monotonic() - t0
+        time.sleep(args.settle)
+
+        fanout = []
+        completion = []
+        timeouts = 0
+        commands = [usrp.Command.SYNC, usrp.Command.PILOT]
+
+        cpu0, wall0 = cpu_time(), time.monotonic()
+        for i in range(0, args.commands, args.in_flight):
+            batch = [usrp.submit_command(commands[j % 2]) for j in range(i, min(i + args.in_flight, args.commands))]
+            for pending in batch:
+                try:
+                    usrp.wait_until_done(pending, args.command_timeout)
+                except TimeoutError:
+                    timeouts += 1
+                    continue
+                fanout.append(max(pending.ack_at.values()) - pending.sent_at)
+                completion.append(pending.done_at - pending.sent_at)
+        cpu, wall = cpu_time() - cpu0, time.monotonic() - wall0
+
+        result.update(
+            ok=timeouts == 0,
+            timeouts=timeouts,
+            commands_per_s=args.commands / wall,
+            fanout_s=summarize(fanout),
+            completion_s=summarize(completion),
+            server_cpu_s=cpu,
+            server_cpu_pct=100 * cpu / wall,
+        )
+        return result
+    finally:
+        stop_swarm(procs)
+        server.stop()
+        server.join()
+
+
+def fmt(value):
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+
+if __name__ == "__main__":
+    # each tile holds two TCP connections to the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if 2 * max(args.tiles) + 256 > hard:
+        print(f"Warning: open file limit ({hard}) is too low for {max(args.tiles)} tiles")
+
+    with open(settings_path, "r") as f:
+        experiment_settings = yaml.safe_load(f)
+    # the simulated tiles run on this machine
+    experiment_settings.setdefault("server", {})["host"] = "127.0.0.1"
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        yaml.safe_dump(experiment_settings, f)
+        settings_file = f.name
+
+    results = []
+    try:
+        for n_tiles in args.tiles:
+            print(f"--- {n_tiles} tiles ---")
+            result = run(settings_file, n_tiles)
+            results.append(result)
+            if not result["ok"]:
+                print(f"FAILED at {n_tiles} tiles: {result}")
+                if not args.keep_going:
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(settings_file)
+
+    print()
+    print(f"{'tiles':>6} {'connect':>8} {'cmd/s':>7} {'fanout p50/p99/max [ms]':>24} "
+          f"{'done p50/p99/max [ms]':>24} {'cpu':>6} {'timeouts':>8}")
+    for r in results:
+        if "fanout_s" not in r:
+            print(f"{r['tiles']:>6} {'FAILED':>8} (only {r.get('connected', 0)} tiles connected)")
+            continue
+        f, c = r["fanout_s"], r["completion_s"]
+        print(f"{r['tiles']:>6} {r['connect_s']:>7.1f}s {r['commands_per_s']:>7.1f} "
+              f"{fmt(f['p50']) + '/' + fmt(f['p99']) + '/' + fmt(f['max']):>24} "
+              f"{fmt(c['p50']) + '/' + fmt(c['p99']) + '/' + fmt(c['max']):>24} "
+              f"{r['server_cpu_pct']:>5.0f}% {r['timeouts']:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
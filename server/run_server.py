@@ -1,5 +1,7 @@
 from utils.server_com import ServerSideCom
 from utils.usrp_control import USRP_Control
+from utils.iq_collector import IQCollector
+from utils.rx_stats import RXStatsMonitor
 import config
 import os
 import sys
@@ -39,35 +41,75 @@ if len(tiles) == 0:
 # Retrieve the host list for the targeted tiles
 host_list = get_target_hosts(config.INVENTORY_PATH, limit=tiles, suppress_warnings=True)
 
+# Resolve the group names (e.g. "segmentB") among the targeted tiles, so commands
+# to a whole group can be sent as a single publish
+groups = {}
+for name in tiles.split():
+    members = get_target_hosts(config.INVENTORY_PATH, limit=name, suppress_warnings=True)
+    if list(members) != [name]:
+        groups[name] = members
+
 # ---------------------------------------------------------
 # Configure server parameters
 # ---------------------------------------------------------
 
 # Instantiate server object for communication with the tiles
 server = ServerSideCom(settings_path)
-# Instantiate usrp object for communication with the tiles' usrps
-usrp = USRP_Control(server)
+# Instantiate usrp object for communication with the tiles' usrps, with the
+# per-tile latency statistics of previous runs for adaptive timeouts
+latency_stats_file = experiment_settings.get("server", {}).get("latency_stats_file")
+if latency_stats_file:
+    latency_stats_file = os.path.join(config.PROJECT_DIR, latency_stats_file)
+usrp = USRP_Control(server, latency_stats_path=latency_stats_file)
+# Keep the RX statistics the tiles report (power, DC offset, clipping, ...)
+rx_stats = RXStatsMonitor(server)
+# Record the IQ streams of the tiles (if enabled), one directory per run
+iq_collector = None
+iq_capture_dir = experiment_settings.get("server", {}).get("iq_capture_dir")
+if iq_capture_dir:
+    capture_dir = os.path.join(config.PROJECT_DIR, iq_capture_dir, time.strftime("%Y%m%d-%H%M%S"))
+    iq_collector = IQCollector(settings_path, capture_dir, stats=server.stats)
 
 server.start() # optional
+if iq_collector:
+    iq_collector.start()
 usrp.start()
 usrp.set_required_hosts(host_list)
+usrp.set_groups(groups)
 
 # ---------------------------------------------------------
 # Main loop: monitor client connections and manage transmissions
 # ---------------------------------------------------------
 try:
     usrp.wait_until_connected(timeout_s=30)
+    pending = usrp.submit_command(usrp.Command.SYNC, tiles=["A05"], delay=2000, dir="RX")
     try:
-        usrp.send_command(usrp.Command.SYNC, tiles=["A05"], at=10, dir="RX", timeout_s=1)
+        usrp.wait_until_done(pending, timeout_s=1)
     except TimeoutError as e:
         print("this timemout is expected")
-    usrp.send_command(usrp.Command.SYNC, at=10, dir="RX", timeout_s=10)
+        # A05 is still armed: cancel its capture, so the streamer is free
+        # again for the next one
+        usrp.cancel_command(pending)
+    # every tile starts capturing at the same time, picked by the server. The
+    # margin leaves A05 time to stop its cancelled capture (up to a receive
+    # timeout); it queues the new one meanwhile
+    pending = usrp.send_command(usrp.Command.SYNC, dir="RX", start_margin_s=1.0, timeout_s=10)
     print("sync completed")
+    # first sample of every tile's capture, converted by the tile to the server
+    # clock (device times of different tiles are not comparable)
+    starts = {tile: result.get("server_start_time") for tile, result in pending.results.items()}
+    if starts and None not in starts.values():
+        print(f"capture start spread: {(max(starts.values()) - min(starts.values())) * 1e6:.1f} us")
     time.sleep(10)
 except KeyboardInterrupt:
     # Catch Ctrl+C in main thread for clean shutdown
     pass
-
-server.stop()
-server.join()
+finally:
+    # also after a failed command
+    usrp.save_latency_stats()
+    if iq_collector:
+        iq_collector.stop()
+        iq_collector.join()
+    server.stop()
+    server.join()
 print("Server terminated.")
\ No newline at end of file
@@ -63,7 +63,7 @@ echo "pip: $(pip --version)"
 if [[ "${INSTALL_PACKAGES:-0}" == "1" ]]; then
     echo "Installing required packages..."
     pip install --upgrade --quiet pip
-    pip install --upgrade --quiet ansible-runner ansible-core pyzmq pyvisa numpy scipy
+    pip install --upgrade --quiet ansible-runner ansible-core pyzmq msgpack pyvisa numpy scipy
     # add other python packages you might need
 fi
 
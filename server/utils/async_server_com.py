@@ -0,0 +1,185 @@
+import asyncio
+import time
+import zmq
+import zmq.asyncio
+
+from utils.server_com import GLOBAL_TOPIC, ServerSideCom
+
+
+class AsyncServerSideCom(ServerSideCom):
+    """
+    asyncio variant of ServerSideCom built on zmq.asyncio.
+
+    The receive loop runs as a task on the caller's event loop instead of a
+    background thread, so several command sequences and other I/O can be
+    overlapped in a single loop. Everything runs on the loop's thread, so
+    sends go out directly instead of through the outbox. Callbacks registered with `on` may be plain
+    functions or coroutine functions.
+
+    Usage
+    -----
+    server = AsyncServerSideCom(settings_path)
+    server.start()                      # inside a running event loop
+    async for client_id, msg_type, payload in server.messages():
+        ...
+    """
+
+    context_class = zmq.asyncio.Context
+
+    def __init__(self, settings_path="", silent=True, context=None, endpoints=None):
+        super().__init__(settings_path, silent, context, endpoints)
+        self.task = None
+        # Sends of the server itself (subscriptions, clock probes, repairs) in flight
+        self._background_sends = set()
+        # Queues of the active `messages()` iterators
+        self._subscribers = set()
+        # Set (and replaced) whenever a new client registers
+        self._clients_event = asyncio.Event()
+
+    def start(self):
+        """Start the server loop as a task on the running event loop."""
+        if self.task is not None:
+            return  # already running
+
+        if self.stats_server:
+            self.stats_server.start()
+        self.running = True
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def join(self):
+        """Wait for the server task to finish."""
+        if self.task is not None:
+            await self.task
+
+    async def run(self):
+        print("Server running... waiting for clients (Ctrl+C or Ctrl+Z to stop)")
+
+        poller = zmq.asyncio.Poller()
+        poller.register(self.messaging, zmq.POLLIN)
+        poller.register(self.sync, zmq.POLLIN)
+
+        try:
+            while self.running:
+                try:
+                    events = dict(await poller.poll(self._poll_timeout_ms()))
+                except zmq.error.ZMQError:
+                    break
+
+                woke = time.perf_counter()
+
+                if self.sync in events:
+                    # subscriptions of (re)connecting tiles, see _handle_subscription
+                    self._handle_subscription(await self.sync.recv())
+
+                if self.messaging in events:
+                    frames = await self.messaging.recv_multipart(copy=False)
+                    message = self._handle_frames(frames)
+                    if message is not None:
+                        for queue in self._subscribers:
+                            queue.put_nowait(message)
+
+                self._run_timers()
+                self._poll_hist.observe(time.perf_counter() - woke)
+
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # wake up iterators so they can finish
+            for queue in self._subscribers:
+                queue.put_nowait(None)
+            self._cleanup()
+
+    async def messages(self, *msg_types):
+        """
+        Asynchronously iterate over incoming messages.
+
+        Parameters
+        ----------
+        msg_types : str
+            Only yield messages of these types. If omitted, yield every message
+            (heartbeats included).
+
+        Yields
+        ------
+        tuple
+            (client_id, msg_type, msg_payload)
+        """
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    return
+                if not msg_types or message[1] in msg_types:
+                    yield message
+        finally:
+            self._subscribers.discard(queue)
+
+    async def send(self, client_id, msg_type, *payload_frames):
+        """Send a message to a specific connected client (see ServerSideCom.send)."""
+        self._check_clients((client_id,))
+        await self._send(client_id, msg_type, *payload_frames)
+
+    async def send_batch(self, messages):
+        messages = [tuple(m) for m in messages]
+        self._check_clients(m[0] for m in messages)
+        await asyncio.gather(*(self._send(*m) for m in messages))
+
+    async def broadcast(self, msg_type, *payload_frames):
+        await self._publish(GLOBAL_TOPIC, msg_type, *payload_frames)
+
+    async def publish(self, topic, msg_type, *payload_frames):
+        await self._publish(topic, msg_type, *payload_frames)
+
+    async def multicast(self, client_ids, msg_type, *payload_frames):
+        """Send a message to a subset of the clients (see ServerSideCom.multicast)."""
+        client_ids = list(client_ids)
+        self._check_clients(client_ids)
+        await asyncio.gather(*self._multicast(client_ids, msg_type, payload_frames))
+
+    async def wait_for_clients(self, client_ids, timeout=None):
+        """
+        Wait until all given clients are connected or the timeout expires.
+
+        Returns
+        -------
+        list of bytes
+            Identities that are still not connected (empty on success).
+        """
+        client_ids = list(client_ids)
+
+        def missing():
+            return [cid for cid in client_ids if cid not in self.clients]
+
+        async def wait_all():
+            while missing():
+                await self._clients_event.wait()
+
+        try:
+            await asyncio.wait_for(wait_all(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return missing()
+
+    def _background(self, result):
+        # zmq.asyncio sends return futures: keep them referenced and report failures
+        if isinstance(result, asyncio.Future):
+            self._background_sends.add(result)
+            result.add_done_callback(self._background_done)
+        return result
+
+    def _background_done(self, future):
+        self._background_sends.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            print(f"[{__class__}] send failed: {future.exception()}")
+
+    def _dispatch(self, msg_type, client_id, msg_payload):
+        result = self.callbacks[msg_type](client_id, msg_payload)
+        if asyncio.iscoroutine(result):
+            asyncio.get_running_loop().create_task(result)
+
+    def _notify_clients_changed(self):
+        # wake current waiters, later waiters use a fresh event
+        self._clients_event.set()
+        self._clients_event = asyncio.Event()
@@ -0,0 +1,165 @@
+import asyncio
+import math
+import time
+
+from utils.usrp_control import USRP_Control
+
+
+class AsyncUSRP_Control(USRP_Control):
+    """
+    asyncio variant of USRP_Control, to be used with an AsyncServerSideCom.
+
+    `send_command` is a coroutine that resolves when all addressed tiles
+    report DONE. Commands carry correlation IDs, so they can run concurrently:
+
+        await asyncio.gather(
+            usrp.send_command(usrp.Command.SYNC, tiles=segment_a),
+            usrp.send_command(usrp.Command.PILOT, tiles=segment_b),
+        )
+    """
+
+    async def wait_until_connected(self, host_list = None, *, timeout_s = None):
+        if host_list is None:
+            host_list = list(self.required_hosts)
+
+        missing = await self.server.wait_for_clients((h.encode() for h in host_list), timeout_s or None)
+        if missing:
+            missing_list = [cid.decode() for cid in missing]
+            raise TimeoutError(f"Not all hosts connected in time. Missing {missing_list}.")
+
+    async def send_command(self, command: USRP_Control.Command = USRP_Control.Command.UNDEFINED, **args):
+        """
+        Send a command to one or more tiles and wait until completion.
+
+        Same arguments, semantics and return value as USRP_Control.send_command.
+
+        Raises
+        ------
+        ConnectionError
+            If one or more required tiles are not connected at send time.
+        TimeoutError
+            If the quorum is not reached before the timeout expires (unless
+            best_effort is set).
+        RuntimeError
+            If so many tiles reported an error that the quorum cannot be
+            reached anymore (unless best_effort is set).
+        """
+        pending = await self.submit_command(command, **args)
+        return await self.wait_until_done(pending, self._timeout(pending, args), best_effort=args.get("best_effort", False))
+
+    async def submit_command(self, command: USRP_Control.Command = USRP_Control.Command.UNDEFINED, **args):
+        """Send a command without waiting for its completion (see USRP_Control.submit_command)."""
+        tiles, pending, payload = self._prepare_command(command, args)
+        loop = asyncio.get_running_loop()
+        pending.future = loop.create_future()
+        pending.changed = asyncio.Event()
+        if pending.settled:
+            pending.future.set_result(pending)
+
+        if tiles: # tiles specified -> group/tile topic publishes
+            await self.server.multicast([tile.encode() for tile in tiles], command.value, payload)
+        else: # no tiles specified -> broadcast
+            await self.server.broadcast(command.value, payload)
+        return pending
+
+    async def wait_until_done(self, pending, timeout_s = None, best_effort = False):
+        """Wait until the quorum of hosts reported DONE, or errors made it unreachable (see USRP_Control.wait_until_done)."""
+        deadline = time.monotonic() + timeout_s if timeout_s else math.inf
+        resend_after = pending.resend_after_s
+        resend_at = pending.sent_at + resend_after if resend_after else math.inf
+        check_at = self._flag_stragglers(pending)
+
+        while True:
+            wake_at = min(deadline, resend_at, check_at)
+            try:
+                await asyncio.wait_for(asyncio.shield(pending.future),
+                                       None if wake_at == math.inf else max(0, wake_at - time.monotonic()))
+                break
+            except asyncio.TimeoutError:
+                pass
+
+            now = time.monotonic()
+            check_at = self._flag_stragglers(pending)
+            if now < resend_at and now < deadline:
+                continue
+            if now >= deadline:
+                if not best_effort:
+                    self._release(pending)
+                    raise TimeoutError(f"Not all hosts reported done in time for command {pending.cmd_id}.")
+                break
+            await self._resend_unacked(pending)
+            resend_after *= 2
+            resend_at = now + resend_after
+
+        if pending.released and not pending.settled:
+            # cancelled (cancel_command) or given up by another waiter meanwhile
+            if not best_effort:
+                raise RuntimeError(f"Command {pending.cmd_id} was released before its quorum was reached.")
+            return pending
+        if not pending.done:
+            self._release(pending, timed_out=not pending.settled)
+        self._check_failed(pending, best_effort)
+        return pending
+
+    async def cancel_command(self, pending):
+        """Ask the hosts that did not finish pending yet to cancel it (see USRP_Control.cancel_command)."""
+        hosts = [host for host, status in pending.status.items()
+                 if status in (self.CommandStatus.RUNNING, self.CommandStatus.ACK)]
+        if hosts:
+            await self.server.multicast([host.encode() for host in hosts], self.CANCEL_COMMAND,
+                                        {"cancel_id": pending.cmd_id})
+        if not pending.done:
+            self._release(pending, timed_out=False)
+
+    async def progress(self, pending, timeout_s = None):
+        """
+        Asynchronously iterate over the replies to pending as they arrive
+        (see USRP_Control.progress).
+
+            pending = await usrp.submit_command(usrp.Command.SYNC)
+            async for host, status in usrp.progress(pending, timeout_s=10):
+                print(host, status.name)
+        """
+        deadline = time.monotonic() + timeout_s if timeout_s else None
+        index = 0
+        while True:
+            if len(pending.events) == index and not (pending.done or pending.released):
+                pending.changed.clear()
+                try:
+                    await asyncio.wait_for(pending.changed.wait(),
+                                           None if deadline is None else max(0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    return
+            events = pending.events[index:]
+            if not events:
+                return
+            index += len(events)
+            for event in events:
+                yield event
+
+    async def _resend_unacked(self, pending):
+        if pending.released:
+            return  # cancelled, the tiles must not get it again
+        payload = dict(pending.payload, resend=True)
+        for host in self._unacked_hosts(pending):
+            try:
+                await self.server.send(host.encode(), pending.command.value, payload)
+            except ValueError:
+                continue  # timed out in the meantime
+            self.stats.counter("usrp_command_resends_total", "Commands resent to tiles that did not ACK",
+                               command=pending.command.name).inc()
+
+    def _command_done(self, pending):
+        # callbacks run on the event loop thread, so the future can be resolved directly
+        if pending.future is not None and not pending.future.done():
+            pending.future.set_result(pending)
+
+    def _command_progress(self, pending):
+        if pending.changed is not None:
+            pending.changed.set()
+
+    def _release(self, pending, timed_out=True):
+        super()._release(pending, timed_out)
+        # wake wait_until_done, e.g. after cancel_command from another task
+        self._command_done(pending)
+        self._command_progress(pending)
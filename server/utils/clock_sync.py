@@ -0,0 +1,76 @@
+"""
+NTP-style clock offset and round-trip time estimation between the server and the tiles.
+
+The server periodically sends a 'time_req' with its send time t1. The tile
+stamps the receive time t2 and reply time t3 and answers with 'time_resp';
+the server stamps the receive time t4. For each exchange:
+
+    rtt    = (t4 - t1) - (t3 - t2)
+    offset = ((t2 - t1) + (t3 - t4)) / 2      (tile clock - server clock)
+
+Like NTP's clock filter, the offset is taken from the sample with the lowest
+RTT in a sliding window, since that sample suffered the least queueing delay.
+All timestamps are time.time() wall clock values.
+"""
+import collections
+import math
+
+
+class ClockEstimator:
+    """Filtered offset/RTT estimate of a single tile."""
+
+    def __init__(self, window=32):
+        # (rtt, offset) of the most recent exchanges
+        self.samples = collections.deque(maxlen=window)
+
+    def add_sample(self, t1, t2, t3, t4):
+        rtt = (t4 - t1) - (t3 - t2)
+        offset = ((t2 - t1) + (t3 - t4)) / 2
+        if rtt < 0:
+            return  # clock stepped during the exchange
+        self.samples.append((rtt, offset))
+
+    @property
+    def valid(self):
+        return len(self.samples) > 0
+
+    @property
+    def offset(self):
+        """Tile clock minus server clock in seconds (None without samples)."""
+        if not self.samples:
+            return None
+        return min(self.samples)[1]
+
+    @property
+    def rtt(self):
+        """Lowest round-trip time in the window."""
+        if not self.samples:
+            return None
+        return min(self.samples)[0]
+
+    @property
+    def rtt_mean(self):
+        if not self.samples:
+            return None
+        return sum(rtt for rtt, _ in self.samples) / len(self.samples)
+
+    @property
+    def rtt_jitter(self):
+        """Standard deviation of the round-trip time."""
+        if len(self.samples) < 2:
+            return 0.0
+        mean = self.rtt_mean
+        return math.sqrt(sum((rtt - mean) ** 2 for rtt, _ in self.samples) / (len(self.samples) - 1))
+
+    def delivery_bound(self, k=3.0):
+        """
+        Conservative one-way delivery time: half the mean RTT plus k standard
+        deviations. A command scheduled this far in the future reaches the
+        tile in time with high probability.
+        """
+        if not self.samples:
+            return None
+        return self.rtt_mean / 2 + k * self.rtt_jitter
+
+
+__all__ = ["ClockEstimator"]
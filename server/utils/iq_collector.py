@@ -0,0 +1,364 @@
+"""
+Parallel recording of the tiles' IQ streams to disk.
+
+IQCollector receives the sample blocks published by the tiles (see
+server/utils/iq_stream.py) and writes every tile's stream to preallocated,
+memory-mapped chunk files. Tiles are spread over a number of writer shards
+(one thread each, e.g. one per core) by a stable hash of their ID:
+
+    tiles --tcp--> SUB (receive thread) --inproc, zero copy--> PULL (writer shard i)
+
+The receive thread only routes frames; decoding, copying into the memory map
+and indexing happen on the shards. Copies into the maps are numpy array
+assignments, which release the GIL, so the shards write in parallel.
+
+On disk, per tile:
+
+    <output_dir>/<tile>/chunk-00000.dat   blocks back to back, raw samples
+    <output_dir>/<tile>/index.jsonl       one line per block: its header
+                                          plus "chunk", "offset" (bytes into
+                                          the chunk), "nbytes", "lost_before"
+
+Chunks are preallocated with chunk_bytes (or the block size, if larger) and
+truncated to their used size when the next one is started. load_index and
+read_block give random access to a recording afterwards; while recording,
+IQCollector.lookup finds the block of a timestamp.
+
+Blocks the shards cannot keep up with are dropped by the receive thread
+(iq_collector_dropped_total) instead of stalling the tiles' streams; every
+block that is not written, dropped here or lost before, is counted in
+iq_collector_lost_total. Blocks that cannot be routed or written (bad
+topic or header, write errors) are skipped and counted in
+iq_invalid_messages_total. iq_collector_backlog and
+iq_collector_write_lag_seconds show how far each shard is behind.
+
+The collector binds the IQ port itself, so it is used instead of (not next
+to) an IQSubscriber.
+"""
+import bisect
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+import yaml
+import zmq
+
+from utils import codec
+from utils.stats import Stats
+from utils.iq_stream import IQ_PORT, IQ_TOPIC, iq_topic
+
+# Default size of a preallocated chunk file
+DEFAULT_CHUNK_BYTES = 256 * 1024 * 1024
+
+INDEX_FILE = "index.jsonl"
+
+
+def chunk_path(tile_dir, chunk):
+    return os.path.join(tile_dir, f"chunk-{chunk:05d}.dat")
+
+
+def shard_of(tile, shards):
+    """Writer shard of a tile (stable across runs and processes)."""
+    return zlib.crc32(tile.encode()) % shards
+
+
+def load_index(tile_dir):
+    """Return the index entries (dicts, in write order) of a recorded tile."""
+    with open(os.path.join(tile_dir, INDEX_FILE), "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_block(tile_dir, entry):
+    """Return the samples of an index entry (a read-only array on the chunk file)."""
+    data = np.memmap(chunk_path(tile_dir, entry["chunk"]), dtype=np.uint8, mode="r",
+                     offset=entry["offset"], shape=(entry["nbytes"],))
+    return data.view(entry["dtype"]).reshape(entry["shape"])
+
+
+class TileWriter:
+    """Writes the blocks of one tile; only used by the shard the tile belongs to."""
+
+    def __init__(self, tile_dir, chunk_bytes, stats, tile):
+        os.makedirs(tile_dir, exist_ok=True)
+        self.tile_dir = tile_dir
+        self.chunk_bytes = chunk_bytes
+        self.chunk = -1
+        self.map = None
+        self.pos = 0
+        self.next_seq = None
+        self.index_file = open(os.path.join(tile_dir, INDEX_FILE), "w")
+        # in-memory index for lookups while recording: block timestamps and
+        # their (chunk, offset, header) entries
+        self.timestamps = []
+        self.entries = []
+        self._blocks = stats.counter("iq_collector_blocks_written_total", "IQ blocks written to disk", tile=tile)
+        self._bytes = stats.counter("iq_collector_bytes_written_total", "IQ sample bytes written to disk", tile=tile)
+        self._lost = stats.counter("iq_collector_lost_total", "IQ blocks not written (lost or dropped)", tile=tile)
+
+    def write(self, header, data):
+        nbytes = len(data)
+        if self.map is None or self.pos + nbytes > len(self.map):
+            self._next_chunk(nbytes)
+        self.map[self.pos:self.pos + nbytes] = np.frombuffer(data, dtype=np.uint8)
+
+        seq = header.get("seq", 0)
+        lost = seq - self.next_seq if self.next_seq is not None and seq > self.next_seq else 0
+        self.next_seq = seq + 1
+
+        entry = dict(header, chunk=self.chunk, offset=self.pos, nbytes=nbytes, lost_before=lost)
+        self.index_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.timestamps.append(header.get("timestamp", 0.0))
+        self.entries.append(entry)
+        self.pos += nbytes
+
+        self._blocks.inc()
+        self._bytes.inc(nbytes)
+        if lost:
+            self._lost.inc(lost)
+
+    def close(self):
+        self._close_chunk()
+        self.index_file.close()
+
+    def _next_chunk(self, nbytes):
+        self._close_chunk()
+        self.chunk += 1
+        size = max(self.chunk_bytes, nbytes)
+        path = chunk_path(self.tile_dir, self.chunk)
+        with open(path, "wb") as f:
+            # reserve the blocks up front, so writing does not extend the file
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+        self.map = np.memmap(path, dtype=np.uint8, mode="r+", shape=(size,))
+        self.pos = 0
+
+    def _close_chunk(self):
+        if self.map is None:
+            return
+        self.map.flush()
+        self.map = None  # unmaps the chunk
+        os.truncate(chunk_path(self.tile_dir, self.chunk), self.pos)
+        self.index_file.flush()
+
+
+class IQCollector:
+    def __init__(self, settings_path="", output_dir="", shards=None, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 tiles=None, context=None, stats=None, queue_blocks=256, rcvhwm=1000):
+        """
+        Parameters
+        ----------
+        settings_path : str
+            Path to the experiment settings YAML file (for server/iq_port).
+        output_dir : str
+            Directory the per-tile recordings are written to.
+        shards : int, optional
+            Number of writer threads, defaults to the number of cores.
+        chunk_bytes : int
+            Size of the preallocated chunk files.
+        tiles : Iterable[str], optional
+            Only record these tiles (default: all tiles).
+        context : zmq.Context, optional
+            Shared ZMQ context. A shared context is not terminated when the
+            collector stops.
+        stats : Stats, optional
+            Registry for the recording metrics, e.g. ServerSideCom.stats.
+        queue_blocks : int
+            Blocks queued per shard before the receive thread drops blocks.
+        rcvhwm : int
+            Receive high water mark (messages) per connected tile.
+        """
+        if not settings_path:
+            raise ValueError(f"[{__class__}] 'settings_path' not specified")
+        if not output_dir:
+            raise ValueError(f"[{__class__}] 'output_dir' not specified")
+
+        with open(settings_path, "r") as f:
+            settings = yaml.safe_load(f)
+        server_settings = (settings or {}).get("server", {})
+        iq_port = server_settings.get("iq_port", IQ_PORT)
+
+        self.output_dir = output_dir
+        self.chunk_bytes = chunk_bytes
+        self.shards = shards or os.cpu_count() or 1
+        self.stats = Stats() if stats is None else stats
+
+        self._own_context = context is None
+        # one ZMQ I/O thread per few shards, so TCP reception keeps up too
+        self.context = zmq.Context(io_threads=max(1, self.shards // 4)) if context is None else context
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.RCVHWM, rcvhwm)
+        self.socket.bind(f"tcp://*:{iq_port}")
+        for topic in ([iq_topic(tile) for tile in tiles] if tiles else [IQ_TOPIC]):
+            self.socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+
+        # Receive thread -> shard queues (bounded, see queue_blocks)
+        self._shard_endpoints = [f"inproc://iq-collector-{id(self)}-{i}" for i in range(self.shards)]
+        self._pull = []
+        self._push = []
+        for endpoint in self._shard_endpoints:
+            pull = self.context.socket(zmq.PULL)
+            pull.setsockopt(zmq.RCVHWM, queue_blocks)
+            pull.bind(endpoint)
+            push = self.context.socket(zmq.PUSH)
+            push.setsockopt(zmq.SNDHWM, queue_blocks)
+            push.connect(endpoint)
+            self._pull.append(pull)
+            self._push.append(push)
+
+        # Blocks handed to / written by every shard (backlog = difference)
+        self._queued = [0] * self.shards
+        self._written = [0] * self.shards
+        # tile -> TileWriter, each written by its own shard only
+        self.writers = {}
+        self._writers_lock = threading.Lock()
+        self._dropped = {}
+        # counted by the receive thread and per shard, so every counter has a single writer
+        self._invalid = self.stats.counter("iq_invalid_messages_total", "Malformed IQ messages")
+        self._shard_invalid = []
+        self._lag_hists = []
+        for i in range(self.shards):
+            self._shard_invalid.append(
+                self.stats.counter("iq_invalid_messages_total", "Malformed IQ messages", shard=str(i)))
+            self.stats.gauge("iq_collector_backlog", "IQ blocks queued for a writer shard",
+                             func=lambda i=i: self._queued[i] - self._written[i], shard=str(i))
+            self._lag_hists.append(self.stats.histogram(
+                "iq_collector_write_lag_seconds", "Time from receiving an IQ block to writing it", shard=str(i)))
+
+        self.running = False
+        self.thread = None
+        self.shard_threads = []
+
+    def start(self):
+        """Start the receive thread and the writer shards."""
+        if self.thread is not None:
+            return  # already running
+
+        self.running = True
+        self.shard_threads = [
+            threading.Thread(target=self._run_shard, args=(i,), name=f"iq-writer-{i}", daemon=True)
+            for i in range(self.shards)
+        ]
+        for thread in self.shard_threads:
+            thread.start()
+        self.thread = threading.Thread(target=self.run, name="iq-collector", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Ask the collector to stop; queued blocks are still written."""
+        self.running = False
+
+    def join(self):
+        """Wait until the receive thread and all shards finished."""
+        if self.thread is not None:
+            self.thread.join()
+        for thread in self.shard_threads:
+            thread.join()
+        if self._own_context:
+            self.context.term()
+
+    def lookup(self, tile, timestamp):
+        """
+        Return the index entry of the block of tile that contains timestamp
+        (the last block starting at or before it), or None.
+        """
+        writer = self.writers.get(tile)
+        if writer is None:
+            return None
+        i = bisect.bisect_right(writer.timestamps, timestamp) - 1
+        return writer.entries[i] if i >= 0 else None
+
+    def run(self):
+        try:
+            while self.running:
+                if not self.socket.poll(100):
+                    continue
+                # drain everything that is queued before polling again
+                while True:
+                    try:
+                        frames = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    try:
+                        self._route(frames)
+                    except zmq.ZMQError:
+                        raise
+                    except Exception:
+                        self._invalid.inc()
+        except zmq.ZMQError:
+            pass
+        finally:
+            self.socket.close(linger=0)
+            # an empty message tells the shard to finish. Waits for a full
+            # queue to drain, unless the shard is gone and never will.
+            for push, thread in zip(self._push, self.shard_threads):
+                while thread.is_alive():
+                    if push.poll(100, zmq.POLLOUT):
+                        push.send(b"")
+                        break
+            for push in self._push:
+                push.close()
+
+    def _route(self, frames):
+        if len(frames) != 3:
+            self._invalid.inc()
+            return
+        topic, header, data = frames
+        tile = topic.bytes.decode()[len(IQ_TOPIC):].rstrip("/")
+        if not tile or "/" in tile or tile in (".", ".."):
+            # the tile ID names its directory under output_dir
+            raise ValueError(f"Invalid IQ topic {topic.bytes!r}")
+        shard = shard_of(tile, self.shards)
+        try:
+            self._push[shard].send_multipart(
+                [tile.encode(), struct.pack("d", time.monotonic()), header, data], zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            counter = self._dropped.get(tile)
+            if counter is None:
+                counter = self._dropped[tile] = self.stats.counter(
+                    "iq_collector_dropped_total", "IQ blocks dropped because a writer shard fell behind", tile=tile)
+            counter.inc()
+            return
+        self._queued[shard] += 1
+
+    def _run_shard(self, shard):
+        pull = self._pull[shard]
+        lag_hist = self._lag_hists[shard]
+        writers = {}
+        try:
+            while True:
+                frames = pull.recv_multipart(copy=False)
+                if len(frames) == 1:
+                    break
+                tile, received, header, data = frames
+                try:
+                    self._write(writers, tile.bytes.decode(), header, data)
+                except Exception:
+                    # a bad header, or the tile's directory or chunk cannot be written
+                    self._shard_invalid[shard].inc()
+                self._written[shard] += 1
+                lag_hist.observe(time.monotonic() - struct.unpack("d", received.bytes)[0])
+        finally:
+            for writer in writers.values():
+                writer.close()
+            pull.close(linger=0)
+
+    def _write(self, writers, tile, header, data):
+        header = codec.decode(header)
+        if not isinstance(header, dict):
+            raise ValueError(f"IQ block header is not a dict: {header!r}")
+        writer = writers.get(tile)
+        if writer is None:
+            writer = writers[tile] = TileWriter(
+                os.path.join(self.output_dir, tile), self.chunk_bytes, self.stats, tile)
+            with self._writers_lock:
+                self.writers[tile] = writer
+        writer.write(header, data.buffer)
+
+
+__all__ = ["DEFAULT_CHUNK_BYTES", "chunk_path", "shard_of", "load_index", "read_block", "TileWriter", "IQCollector"]
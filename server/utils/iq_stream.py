@@ -0,0 +1,258 @@
+"""
+Server side of the IQ sample streams published by the tiles.
+
+The tiles' IQPublishers (client/utils/iq_stream.py) connect to a SUB socket
+that the IQSubscriber binds on the IQ port (server/iq_port in the experiment
+settings, 50001 by default). Every message is one block of samples:
+
+    [b"iq/<ID>/", header, samples]
+
+The samples are received without copying: every block's array is a view on
+the received ZMQ frame. Blocks are queued per tile in a TileStream, which
+tracks the block sequence numbers to detect blocks lost on the way (dropped
+by the tile at its high water mark, or by this subscriber's receive queue):
+
+    iq = IQSubscriber(settings_path, stats=server.stats)
+    iq.start()
+    blocks = iq.stream("A05").read(timeout_s=1.0)
+    for timestamp, samples in contiguous_runs(blocks):
+        ...
+    iq.stop()
+    iq.join()
+
+Keep the message layout in sync with client/utils/iq_stream.py.
+"""
+import collections
+import threading
+
+import numpy as np
+import yaml
+import zmq
+
+from utils import codec
+from utils.stats import Stats
+
+IQ_PORT = 50001
+IQ_TOPIC = "iq/"
+
+
+def iq_topic(tile_id):
+    return f"{IQ_TOPIC}{tile_id}/"
+
+
+class IQBlock:
+    """One received block of samples."""
+
+    __slots__ = ("tile", "seq", "timestamp", "samples", "header", "lost_before")
+
+    def __init__(self, tile, header, samples, lost_before=0):
+        self.tile = tile
+        self.seq = header["seq"]
+        # hardware time of the first sample
+        self.timestamp = header["timestamp"]
+        self.samples = samples
+        # full header, including the publisher's extra metadata
+        self.header = header
+        # number of blocks lost between the previous block and this one
+        self.lost_before = lost_before
+
+
+class TileStream:
+    """Received blocks of one tile, in order, with loss accounting."""
+
+    def __init__(self, tile, max_blocks=256):
+        self.tile = tile
+        self.max_blocks = max_blocks
+        self.blocks = collections.deque()
+        self.changed = threading.Condition()
+        self.next_seq = None
+        # blocks received, lost in transit, discarded because nobody read
+        # them in time, and publisher restarts (sequence numbers going back)
+        self.received = 0
+        self.lost = 0
+        self.overruns = 0
+        self.restarts = 0
+        self.last_timestamp = None
+
+    def read(self, max_blocks=None, timeout_s=None):
+        """
+        Remove and return the queued blocks (oldest first, at most
+        max_blocks). Waits up to timeout_s for a block if none is queued.
+        """
+        with self.changed:
+            if not self.blocks and timeout_s:
+                self.changed.wait_for(lambda: self.blocks, timeout_s)
+            n = len(self.blocks) if max_blocks is None else min(max_blocks, len(self.blocks))
+            return [self.blocks.popleft() for _ in range(n)]
+
+    def _add(self, header, samples):
+        """Queue a received block and return it."""
+        seq = header["seq"]
+        lost = 0
+        if self.next_seq is not None:
+            if seq >= self.next_seq:
+                lost = seq - self.next_seq
+            else:
+                self.restarts += 1
+        self.next_seq = seq + 1
+
+        with self.changed:
+            if len(self.blocks) >= self.max_blocks:
+                self.blocks.popleft()
+                self.overruns += 1
+            block = IQBlock(self.tile, header, samples, lost)
+            self.blocks.append(block)
+            self.received += 1
+            self.lost += lost
+            self.last_timestamp = block.timestamp
+            self.changed.notify_all()
+        return block
+
+
+def contiguous_runs(blocks):
+    """
+    Join blocks into runs of gapless samples.
+
+    Returns a list of (timestamp, samples), starting a new run after every
+    lost block. Runs of a single block are returned without copying.
+    """
+    runs = []
+    current = []
+    for block in blocks:
+        if current and block.lost_before:
+            runs.append(current)
+            current = []
+        current.append(block)
+    if current:
+        runs.append(current)
+
+    return [
+        (run[0].timestamp, run[0].samples if len(run) == 1 else np.concatenate([b.samples for b in run]))
+        for run in runs
+    ]
+
+
+class IQSubscriber:
+    def __init__(self, settings_path="", tiles=None, context=None, stats=None, max_blocks=256, rcvhwm=1000):
+        """
+        Parameters
+        ----------
+        settings_path : str
+            Path to the experiment settings YAML file.
+        tiles : Iterable[str], optional
+            Only receive the streams of these tiles (default: all tiles).
+        context : zmq.Context, optional
+            Shared ZMQ context. A shared context is not terminated when the
+            subscriber stops.
+        stats : Stats, optional
+            Registry for the stream counters, e.g. ServerSideCom.stats.
+        max_blocks : int
+            Blocks queued per tile before the oldest are discarded.
+        rcvhwm : int
+            Receive high water mark (messages) per connected tile.
+        """
+        if not settings_path:
+            raise ValueError(f"[{__class__}] 'settings_path' not specified")
+
+        with open(settings_path, "r") as f:
+            settings = yaml.safe_load(f)
+        server_settings = (settings or {}).get("server", {})
+        iq_port = server_settings.get("iq_port", IQ_PORT)
+
+        self._own_context = context is None
+        self.context = zmq.Context() if context is None else context
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.RCVHWM, rcvhwm)
+        self.socket.bind(f"tcp://*:{iq_port}")
+        for topic in ([iq_topic(tile) for tile in tiles] if tiles else [IQ_TOPIC]):
+            self.socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+
+        self.max_blocks = max_blocks
+        # tile -> TileStream, created on the first block of a tile
+        self.streams = {}
+        self._streams_lock = threading.Lock()
+        self.callbacks = []
+        self.stats = Stats() if stats is None else stats
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start receiving in a background thread."""
+        if self.thread is not None:
+            return  # already running
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Ask the receive loop to stop."""
+        self.running = False
+
+    def join(self):
+        """Wait for the receive thread to finish."""
+        if self.thread is not None:
+            self.thread.join()
+
+    def on_block(self, func):
+        """Register func(block) to be called (on the receive thread) for every block."""
+        self.callbacks.append(func)
+
+    def stream(self, tile):
+        """Return the TileStream of tile (created empty if nothing was received yet)."""
+        with self._streams_lock:
+            stream = self.streams.get(tile)
+            if stream is None:
+                stream = self.streams[tile] = TileStream(tile, self.max_blocks)
+            return stream
+
+    def run(self):
+        try:
+            while self.running:
+                if not self.socket.poll(100):
+                    continue
+                # drain everything that is queued before polling again
+                while True:
+                    try:
+                        frames = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self._handle_frames(frames)
+        except zmq.ZMQError:
+            pass
+        finally:
+            self.socket.close(linger=0)
+            if self._own_context:
+                self.context.term()
+
+    def _handle_frames(self, frames):
+        if len(frames) != 3:
+            self.stats.counter("iq_invalid_messages_total", "Malformed IQ messages").inc()
+            return
+        topic, header, data = frames
+        tile = topic.bytes[len(IQ_TOPIC):].rstrip(b"/").decode(errors="replace")
+        try:
+            header = codec.decode(header)
+            # a view on the received frame, no copy
+            samples = np.frombuffer(data.buffer, dtype=header["dtype"]).reshape(header["shape"])
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Invalid IQ block from {tile}: {e}")
+            self.stats.counter("iq_invalid_messages_total", "Malformed IQ messages").inc()
+            return
+
+        block = self.stream(tile)._add(header, samples)
+        self.stats.counter("iq_blocks_received_total", "IQ blocks received", tile=tile).inc()
+        self.stats.counter("iq_bytes_received_total", "IQ sample bytes received", tile=tile).inc(len(data.buffer))
+        if block.lost_before:
+            self.stats.counter("iq_blocks_lost_total", "IQ blocks lost between tile and server",
+                               tile=tile).inc(block.lost_before)
+
+        if self.callbacks:
+            for func in self.callbacks:
+                try:
+                    func(block)
+                except Exception as e:
+                    print(f"IQ block callback error: {e}")
+
+
+__all__ = ["IQ_PORT", "iq_topic", "IQBlock", "TileStream", "contiguous_runs", "IQSubscriber"]
@@ -0,0 +1,74 @@
+"""
+Rolling ACK/DONE latency statistics per tile and command type.
+
+USRP_Control records, for every reply, the time since the command was sent:
+
+    "ack":  command sent -> tile's usrp_ack
+    "done": command sent -> tile's usrp_done
+
+The most recent samples of every (tile, command, kind) are kept and used to
+derive adaptive timeouts and to flag stragglers. The statistics can be saved
+to and loaded from a JSON file, so a new server run starts from the
+estimates of the previous one.
+"""
+import collections
+import json
+import math
+import os
+
+
+class LatencyStats:
+    def __init__(self, window=200):
+        self.window = window
+        # (tile, command, kind) -> deque of latencies in seconds
+        self.samples = {}
+
+    def add(self, tile, command, kind, seconds):
+        key = (tile, command, kind)
+        samples = self.samples.get(key)
+        if samples is None:
+            samples = self.samples[key] = collections.deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, tile, command, kind, q, min_samples=5):
+        """
+        q-th percentile (0-100) of the recent latencies, or None if fewer than
+        min_samples were recorded.
+        """
+        samples = self.samples.get((tile, command, kind))
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1)]
+
+    def count(self, tile, command, kind):
+        return len(self.samples.get((tile, command, kind), ()))
+
+    def save(self, path):
+        """Write the statistics to path (atomically)."""
+        data = {"window": self.window, "samples": {}}
+        for (tile, command, kind), samples in self.samples.items():
+            data["samples"].setdefault(tile, {}).setdefault(command, {})[kind] = list(samples)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, window=200):
+        """Read statistics saved with save(); a missing file gives empty statistics."""
+        stats = cls(window)
+        if not os.path.exists(path):
+            return stats
+        with open(path, "r") as f:
+            data = json.load(f)
+        for tile, commands in data.get("samples", {}).items():
+            for command, kinds in commands.items():
+                for kind, samples in kinds.items():
+                    for seconds in samples[-window:]:
+                        stats.add(tile, command, kind, seconds)
+        return stats
+
+
+__all__ = ["LatencyStats"]
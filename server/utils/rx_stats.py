@@ -0,0 +1,73 @@
+"""
+Collect the periodic RX statistics reports of the tiles.
+
+Tiles measuring a stream with RXStatsReporter (client/utils/rx_stats.py)
+send an 'rx_stats' message every interval: the statistics of that interval
+and the running totals of the stream. RXStatsMonitor keeps the latest report
+of every tile and exports the interval values as gauges, e.g.
+
+    tile_rx_power_dbfs{tile="A05"} -31.2
+    tile_rx_clipped_total{tile="A05"} 0
+
+Keep the message layout in sync with client/utils/rx_stats.py.
+"""
+import threading
+
+# interval statistics exported as tile_rx_<name>{tile=...}
+GAUGES = {
+    "power_dbfs": "Received power in the last report interval [dBFS]",
+    "dc_dbfs": "DC offset power in the last report interval [dBFS]",
+    "peak_dbfs": "Peak magnitude in the last report interval [dBFS]",
+    "iq_gain_imbalance_db": "IQ gain imbalance in the last report interval [dB]",
+    "iq_phase_imbalance_deg": "IQ phase imbalance in the last report interval [deg]",
+}
+
+
+class RXStatsMonitor:
+    MSG_TYPE = "rx_stats"
+
+    def __init__(self, server_side_com, stats=None, silent=True):
+        """
+        Parameters
+        ----------
+        server_side_com : ServerSideCom
+            Server the tiles report to.
+        stats : Stats, optional
+            Registry for the gauges, defaults to the server's.
+        silent : bool
+            Suppress printing every report.
+        """
+        self.server = server_side_com
+        self.stats = server_side_com.stats if stats is None else stats
+        self.silent = silent
+        # tile -> latest report
+        self.reports = {}
+        self._lock = threading.Lock()
+        self.server.on(self.MSG_TYPE, self._handle_report)
+
+    def latest(self, tile=None):
+        """Return the latest report of a tile, or of all tiles (dict by tile)."""
+        with self._lock:
+            return self.reports.get(tile) if tile is not None else dict(self.reports)
+
+    def _handle_report(self, id, args):
+        if not args or not isinstance(args[0], dict):
+            return
+        report = args[0]
+        with self._lock:
+            self.reports[id] = report
+
+        interval = report.get("interval", {})
+        for name, help in GAUGES.items():
+            value = interval.get(name)
+            if value is not None:
+                self.stats.gauge(f"tile_rx_{name}", help, tile=id).set(value)
+        total = report.get("total", {})
+        if total.get("clipped") is not None:
+            self.stats.gauge("tile_rx_clipped_total", "Clipped samples since the stream started", tile=id).set(
+                total["clipped"])
+        if not self.silent:
+            print(f"[RX_STATS] {id}: {interval.get('power_dbfs')} dBFS, {interval.get('clipped')} clipped")
+
+
+__all__ = ["RXStatsMonitor"]
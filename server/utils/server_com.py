@@ -2,12 +2,87 @@ import zmq
 import json
 import yaml
 import time
+import heapq
+import collections
+import queue
 import signal
 import threading
-from datetime import datetime, timedelta
+import uuid
+from utils import codec
+from utils.stats import Stats, StatsServer
+from utils.clock_sync import ClockEstimator
+
+# PUB topics. Every published message starts with a topic frame; clients
+# subscribe to the global topic, their own tile topic and the topics of the
+# groups the server assigns them to (see ServerSideCom.set_groups). The
+# trailing "/" keeps prefix matching exact ("tile/A05/" != "tile/A050/").
+#
+# Every publish carries a per-topic sequence number appended to its topic
+# frame ("all/17"). Clients NACK the numbers they missed and the server
+# resends them by unicast ('repub') from a bounded history, see
+# ServerSideCom._handle_nack. Subscriptions still match on the topic prefix.
+#
+# Every server run has a session epoch. It is published (unnumbered, as
+# 'epoch') on a tile's topic as soon as the tile's SUB socket subscribes, i.e.
+# when it (re)connects. A tile that sees a new epoch resets its sequence
+# numbers and sends an immediate 'hello' (a heartbeat), so the fleet is
+# registered again within a round trip after a server restart. Tiles have a
+# session ID of their own in their heartbeat; when it changes, the server
+# pushes its state (subscriptions, sequence numbers) to the restarted tile.
+GLOBAL_TOPIC = "all/"
+
+# Default interval between clock probes of every tile [s]
+CLOCK_SYNC_INTERVAL = 30.0
+# Clock probes sent back to back to a new (or restarted) tile, so it has an
+# offset estimate before the first scheduled start instead of one interval later
+CLOCK_STARTUP_PROBES = 4
+
+
+def tile_topic(tile_id):
+    return f"tile/{tile_id}/"
+
+
+def group_topic(group_name):
+    return f"group/{group_name}/"
+
+
+class ClientInfo:
+    """Liveness record of a connected client (times on the time.monotonic() clock)."""
+
+    __slots__ = ("last_seen", "subscribed", "codec", "msgpack", "hello", "session")
+
+    def __init__(self, last_seen):
+        self.last_seen = last_seen
+        # True once the client confirmed its topic subscriptions
+        self.subscribed = False
+        # Header codec negotiated from the client's heartbeat (None: not yet, use JSON)
+        self.codec = None
+        # True when that codec is msgpack (the client is not counted as legacy)
+        self.msgpack = False
+        # Raw header of the last processed heartbeat, and the client's session ID
+        self.hello = None
+        self.session = None
+
 
 class ServerSideCom:
-    def __init__(self, settings_path="", silent=True):
+    # Overridden by the asyncio variant (see async_server_com.py)
+    context_class = zmq.Context
+
+    def __init__(self, settings_path="", silent=True, context=None, endpoints=None):
+        """
+        Parameters
+        ----------
+        settings_path : str
+            Path to the experiment settings YAML file.
+        silent : bool
+            Suppress the per-message console output.
+        context : zmq.Context, optional
+            Shared ZMQ context (required for inproc endpoints). A shared
+            context is not terminated when the server stops.
+        endpoints : tuple of str, optional
+            (messaging, sync) endpoints to bind instead of tcp://*:<port>
+            from the settings, e.g. for benchmarks over inproc.
+        """
         if not settings_path:
             raise ValueError(f"[{__class__}] 'settings_path' not specified")
         
@@ -23,27 +98,97 @@ class ServerSideCom:
         
         # Heartbeat interval for client liveness detection
         heartbeat_timeout = int(settings.get("heartbeat_interval", "")) + 5
+        # Interval between clock offset/RTT probes of every client (0 disables)
+        clock_sync_interval = float(settings.get("clock_sync_interval", CLOCK_SYNC_INTERVAL))
         messaging_port = server_settings.get("messaging_port", "")
         sync_port = server_settings.get("sync_port", "")
+        # Optional local Prometheus-style metrics endpoint
+        stats_port = server_settings.get("stats_port", "")
+        # Publishes kept per topic for NACK repair
+        publish_history = int(server_settings.get("publish_history", 256))
                 
-        self.context = zmq.Context()
+        if endpoints is None:
+            endpoints = (f"tcp://*:{messaging_port}", f"tcp://*:{sync_port}")
+
+        self._own_context = context is None
+        self.context = self.context_class() if context is None else context
         self.messaging = self.context.socket(zmq.ROUTER)
-        self.messaging.bind(f"tcp://*:{messaging_port}")
-        self.sync = self.context.socket(zmq.PUB)
-        self.sync.bind(f"tcp://*:{sync_port}")
+        # a restarted tile takes over its identity right away, instead of
+        # being rejected until its old connection is found dead
+        self.messaging.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.messaging.bind(endpoints[0])
+        # XPUB: the subscriptions of (re)connecting tiles trigger the epoch
+        # announcement, see _handle_subscription
+        self.sync = self.context.socket(zmq.XPUB)
+        self.sync.setsockopt(zmq.XPUB_VERBOSE, 1)
+        self.sync.bind(endpoints[1])
+        # Session epoch of this server run
+        self.epoch = uuid.uuid4().hex
+        # Actor design: only the server thread touches the ROUTER/PUB sockets.
+        # Other threads put batches of operations on the outbox and wake the
+        # server thread through their own inproc PUSH socket.
+        self._outbox = queue.SimpleQueue()
+        self._wake_endpoint = f"inproc://server-outbox-{id(self)}"
+        self._wake = self.context.socket(zmq.PULL)
+        self._wake.bind(self._wake_endpoint)
+        self._local = threading.local()
+        self._wake_sockets = []
+        self._wake_lock = threading.Lock()
+        # topic -> last sequence number, and topic -> deque of (seq, frames)
+        self._pub_seq = {}
+        self._history = {}
+        self.publish_history = publish_history
         self.clients = {}
+        # Held by the server thread while adding/removing clients (see get_connected)
+        self._clients_lock = threading.Lock()
+        # Expiry index: heap of (deadline, client_id) with one entry per client.
+        # Entries are only refreshed when they come due, so a heartbeat costs
+        # O(1) and expiry work is only done when a deadline has passed.
+        self._expiry = []
+        # Notified whenever a new client registers (see wait_for_clients)
+        self.clients_changed = threading.Condition()
         self.heartbeat_timeout = heartbeat_timeout
         self.silent = silent
         self.running = False
         self.thread = None
         # Event handling
         self.callbacks = {}
+        # Protocol messages handled by the server itself
+        self._internal_handlers = {
+            "subscribed": self._handle_subscribed,
+            "time_resp": self._handle_time_resp,
+            "nack": self._handle_nack,
+        }
+        # client id -> ClockEstimator (kept when a client times out)
+        self.clocks = {}
+        self.clock_sync_interval = clock_sync_interval
+        self._next_clock_probe = time.monotonic()
+        # group name -> frozenset of client ids, and client id -> group names
+        self.groups = {}
+        self._client_groups = {}
+        # Number of connected clients that do not (or not yet) speak msgpack;
+        # publishes are only msgpack encoded when this is zero
+        self._legacy_clients = 0
+        # Instrumentation (shared with USRP_Control)
+        self.stats = Stats()
+        self.stats_server = StatsServer(self.stats, int(stats_port)) if stats_port else None
+        self.stats.gauge("server_connected_clients", "Clients seen within the heartbeat timeout", func=lambda: len(self.clients))
+        self._poll_hist = self.stats.histogram("server_poll_iteration_seconds", "Processing time per poll loop wakeup")
+        # msg_type -> metric caches, to avoid a registry lookup per message
+        self._rx_counters = {}
+        self._tx_counters = {}
+        self._callback_hists = {}
+        self._repub_counter = self.stats.counter("server_repub_total", "Publishes resent after a NACK")
+        self._repub_missed_counter = self.stats.counter(
+            "server_repub_unavailable_total", "NACKed publishes no longer in the history")
 
     def start(self):
         """Start the server in a background thread."""
         if self.thread is not None:
             return  # already running
 
+        if self.stats_server:
+            self.stats_server.start()
         self.running = True
         self.thread = threading.Thread(target=self.run, daemon=True)
         self.thread.start()
@@ -68,13 +213,21 @@ class ServerSideCom:
         try:
             self.messaging.close(linger=0)
             self.sync.close(linger=0)
+            self._wake.close(linger=0)
+            with self._wake_lock:
+                for sock in self._wake_sockets:
+                    sock.close(linger=0)
         except Exception:
             pass
 
-        try:
-            self.context.term()
-        except Exception:
-            pass
+        if self._own_context:
+            try:
+                self.context.term()
+            except Exception:
+                pass
+
+        if self.stats_server:
+            self.stats_server.stop()
 
         print("Server stopped cleanly.")
 
@@ -83,11 +236,13 @@ class ServerSideCom:
 
         poller = zmq.Poller()
         poller.register(self.messaging, zmq.POLLIN)
+        poller.register(self.sync, zmq.POLLIN)
+        poller.register(self._wake, zmq.POLLIN)
 
         try:
             while self.running:
                 try:
-                    messages = dict(poller.poll(1000))  # may be interrupted
+                    messages = dict(poller.poll(self._poll_timeout_ms()))  # may be interrupted
                 except zmq.error.ZMQError:
                     break
                 except KeyboardInterrupt:
@@ -95,37 +250,20 @@ class ServerSideCom:
                     self.running = False
                     break
 
+                woke = time.perf_counter()
+
                 if self.messaging in messages:
-                    frames = self.messaging.recv_multipart()
-                    if not frames:
-                        continue
-
-                    identity, *payload = frames
-
-                    # First payload frame is the message type
-                    msg_type = payload[0].decode() if len(payload) >= 1 else ""
-                    msg_payload = payload[1:] if len(payload) > 1 else []
-
-                    # Update last_seen
-                    self.clients[identity] = {"last_seen": datetime.utcnow()}
-
-                    # Handle messages
-                    if msg_type == "heartbeat":
-                        if not self.silent:
-                            print(f"[HEARTBEAT] {identity.decode()}")
-                    else:
-                        if not self.silent:
-                            print(f"[MESSAGE] {identity.decode()}: {msg_payload}")
-                        if msg_type in self.callbacks:
-                            try:
-                                self.callbacks[msg_type](identity.decode(), msg_payload)
-                            except Exception as e:
-                                print(f"Callback error for {msg_type}: {e}")
-                        else:
-                            if not self.silent:
-                                print(f"[{__class__}] unhandled message")
-
-                self._purge_dead()
+                    frames = self.messaging.recv_multipart(copy=False)
+                    self._handle_frames(frames)
+
+                if self.sync in messages:
+                    self._drain_subscriptions()
+
+                if self._wake in messages:
+                    self._drain_outbox()
+
+                self._run_timers()
+                self._poll_hist.observe(time.perf_counter() - woke)
 
         except KeyboardInterrupt:
             # Interrupt outside poll, e.g. between iterations
@@ -133,16 +271,274 @@ class ServerSideCom:
         finally:
             self._cleanup()
 
+    def _handle_frames(self, frames):
+        """
+        Process one multipart message received on the ROUTER socket.
+
+        Frames are expected as zmq.Frame objects (recv_multipart(copy=False)).
+        The header frame of the payload is decoded with the codec module, raw
+        frames after it are handed to the callbacks untouched.
+
+        Returns
+        -------
+        tuple or None
+            (client_id, msg_type, msg_payload) of the handled message, or None
+            if the frame list was empty.
+        """
+        if not frames:
+            return None
+
+        identity, *payload = frames
+        identity = identity.bytes
+
+        # First payload frame is the message type
+        msg_type = payload[0].bytes.decode() if len(payload) >= 1 else ""
+        msg_payload = payload[1:] if len(payload) > 1 else []
+        self._count(self._rx_counters, "server_messages_received_total", msg_type)
+
+        # Update last_seen
+        now = time.monotonic()
+        info = self.clients.get(identity)
+        is_new = info is None
+        if is_new:
+            info = ClientInfo(now)
+            with self._clients_lock:
+                self.clients[identity] = info
+            heapq.heappush(self._expiry, (now + self.heartbeat_timeout, identity))
+            self._legacy_clients += 1
+        else:
+            info.last_seen = now
+
+        # Handle messages
+        if msg_type == "heartbeat" or msg_type == "hello":
+            # the header only changes when the client (re)starts
+            header = msg_payload[0].bytes if msg_payload else b""
+            if header != info.hello:
+                self._handle_hello(identity, info, header, is_new)
+            if not self.silent:
+                print(f"[{msg_type.upper()}] {identity.decode()}")
+        else:
+            try:
+                if msg_payload:
+                    msg_payload[0] = codec.decode(msg_payload[0])
+            except ValueError as e:
+                print(f"Could not decode {msg_type} from {identity.decode()}: {e}")
+                return None
+
+            if msg_type in self._internal_handlers:
+                # a malformed protocol message must not take down the server loop
+                try:
+                    self._internal_handlers[msg_type](identity, msg_payload)
+                except Exception as e:
+                    print(f"Could not handle {msg_type} from {identity.decode()}: {e}")
+            else:
+                if not self.silent:
+                    print(f"[MESSAGE] {identity.decode()}: {msg_payload}")
+                if msg_type in self.callbacks:
+                    started = time.perf_counter()
+                    try:
+                        self._dispatch(msg_type, identity.decode(), msg_payload)
+                    except Exception as e:
+                        print(f"Callback error for {msg_type}: {e}")
+                    self._callback_hist(msg_type).observe(time.perf_counter() - started)
+                else:
+                    if not self.silent:
+                        print(f"[{__class__}] unhandled message")
+
+        if is_new:
+            self._push_subscriptions(identity)
+            self._probe_clock(identity)
+            self._notify_clients_changed()
+
+        return (identity.decode(), msg_type, msg_payload)
+
+    def _handle_hello(self, identity, info, header, is_new):
+        """Process a new heartbeat header: negotiate the codec and detect client restarts."""
+        info.hello = header
+        try:
+            hello = codec.decode(header) if header else None
+        except ValueError:
+            hello = None
+        # legacy clients send the plain text "alive"
+        if not isinstance(hello, dict):
+            hello = {}
+
+        self._negotiate_codec(identity, info, hello.get("codecs", []))
+
+        session = hello.get("session")
+        if not is_new and info.session is not None and session != info.session:
+            # the tile restarted: it lost its group subscriptions and sequence numbers
+            self.stats.counter("server_client_restarts_total", "Clients that restarted while connected").inc()
+            if not self.silent:
+                print(f"[RESTART] {identity.decode()}")
+            info.subscribed = False
+            self.clocks.pop(identity, None)
+            self._push_subscriptions(identity)
+            self._probe_clock(identity)
+        info.session = session
+
+    def _negotiate_codec(self, identity, info, peer_codecs):
+        """Pick the header codec from the codecs a client lists in its heartbeat."""
+        info.codec = codec.select_codec(peer_codecs)
+        # codec.MSGPACK is None without msgpack installed, so compare explicitly
+        msgpack = codec.MSGPACK is not None and info.codec is codec.MSGPACK
+        if msgpack != info.msgpack:
+            self._legacy_clients += -1 if msgpack else 1
+            info.msgpack = msgpack
+        if not self.silent:
+            print(f"[CODEC] {identity.decode()}: {info.codec.name}")
+
+    def _drain_subscriptions(self):
+        """Handle the subscription messages queued on the XPUB socket."""
+        while True:
+            try:
+                message = self.sync.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self._handle_subscription(message)
+
+    def _handle_subscription(self, message):
+        """Announce the epoch to a tile as soon as its tile topic is subscribed."""
+        # b"\x01<topic>" subscribes, b"\x00<topic>" unsubscribes
+        topic = message[1:].decode(errors="replace")
+        if message[:1] == b"\x01" and topic.startswith("tile/"):
+            self._background(self.sync.send_multipart(
+                [topic.encode()] + codec.encode_frames("epoch", [{"epoch": self.epoch}], codec.JSON)))
+
+    def _handle_subscribed(self, identity, msg_payload):
+        self.clients[identity].subscribed = True
+
+    def _handle_time_resp(self, identity, msg_payload):
+        t4 = time.time()
+        if not msg_payload or not isinstance(msg_payload[0], dict):
+            return
+        stamps = [msg_payload[0].get(k) for k in ("t1", "t2", "t3")]
+        if not all(isinstance(t, (int, float)) and not isinstance(t, bool) for t in stamps):
+            if not self.silent:
+                print(f"[TIME] {identity.decode()}: malformed time_resp {msg_payload[0]}")
+            return
+        estimator = self.clocks.get(identity)
+        if estimator is None:
+            estimator = self.clocks[identity] = ClockEstimator()
+        estimator.add_sample(*stamps, t4)
+        if len(estimator.samples) < CLOCK_STARTUP_PROBES:
+            self._probe_clock(identity)
+
+    def _handle_nack(self, identity, msg_payload):
+        """Resend the publishes a client missed on a topic by unicast."""
+        if not msg_payload or not isinstance(msg_payload[0], dict):
+            return
+        topic = msg_payload[0].get("topic")
+        seqs = msg_payload[0].get("seqs")
+        if (not isinstance(topic, str) or not isinstance(seqs, (list, tuple)) or len(seqs) != 2
+                or not all(isinstance(seq, int) and not isinstance(seq, bool) for seq in seqs)):
+            print(f"Ignoring malformed nack from {identity.decode()}: {msg_payload[0]}")
+            return
+        # never count (or look for) publishes that were not made yet
+        first, last = seqs[0], min(seqs[1], self._pub_seq.get(topic, 0))
+        if first < 1 or first > last:
+            return
+        resent = 0
+        for seq, frames in self._history.get(topic, ()):
+            if first <= seq <= last:
+                self._background(self.messaging.send_multipart(
+                    [identity, b"repub", f"{topic}{seq}".encode()] + frames, copy=False))
+                resent += 1
+        self._repub_counter.inc(resent)
+        self._repub_missed_counter.inc(last - first + 1 - resent)
+        if not self.silent:
+            print(f"[NACK] {identity.decode()}: {topic} {first}-{last}, resent {resent}")
+
+    def _probe_clocks(self):
+        """Start a timestamp exchange with every connected client."""
+        for cid in list(self.clients):
+            self._probe_clock(cid)
+
+    def _probe_clock(self, client_id):
+        """Start a timestamp exchange with a client (no-op with clock sync disabled)."""
+        if self.clock_sync_interval <= 0 or client_id not in self.clients:
+            return
+        estimator = self.clocks.get(client_id)
+        # tell the client our current estimate, so it can convert server times
+        offset = estimator.offset if estimator else None
+        self._background(self._send(client_id, "time_req", {"t1": time.time(), "offset": offset}))
+
+    def clock_estimate(self, client_id):
+        """Return the ClockEstimator of a client, or None if it was never probed."""
+        return self.clocks.get(client_id)
+
+    def _push_subscriptions(self, client_id):
+        """
+        Tell a client which group topics it has to subscribe to, along with
+        the current sequence number of each of its topics so it can detect
+        publishes it misses from now on.
+        """
+        topics = [group_topic(name) for name in self._client_groups.get(client_id, ())]
+        seqs = {
+            topic: self._pub_seq.get(topic, 0)
+            for topic in [GLOBAL_TOPIC, tile_topic(client_id.decode())] + topics
+        }
+        self._background(self._send(client_id, "subscribe", topics, seqs))
+
+    def _count(self, cache, name, msg_type):
+        counter = cache.get(msg_type)
+        if counter is None:
+            counter = cache[msg_type] = self.stats.counter(name, "Messages by type", type=msg_type)
+        counter.inc()
+
+    def _callback_hist(self, msg_type):
+        hist = self._callback_hists.get(msg_type)
+        if hist is None:
+            hist = self._callback_hists[msg_type] = self.stats.histogram(
+                "server_callback_seconds", "Callback execution time", type=msg_type)
+        return hist
+
+    def _dispatch(self, msg_type, client_id, msg_payload):
+        """Invoke the registered callback for msg_type."""
+        self.callbacks[msg_type](client_id, msg_payload)
+
+    def _notify_clients_changed(self):
+        with self.clients_changed:
+            self.clients_changed.notify_all()
+
+    def _poll_timeout_ms(self, max_ms=1000):
+        """Time until the earliest liveness deadline or clock probe, capped at max_ms."""
+        deadline = self._expiry[0][0] if self._expiry else None
+        if self.clock_sync_interval > 0 and (deadline is None or self._next_clock_probe < deadline):
+            deadline = self._next_clock_probe
+        if deadline is None:
+            return max_ms
+        remaining = (deadline - time.monotonic()) * 1000
+        return min(max_ms, max(0, int(remaining) + 1))
+
+    def _run_timers(self):
+        """Handle liveness expiry and periodic clock probes that are due."""
+        self._purge_dead()
+        if self.clock_sync_interval > 0:
+            now = time.monotonic()
+            if now >= self._next_clock_probe:
+                self._next_clock_probe = now + self.clock_sync_interval
+                self._probe_clocks()
+
     def _purge_dead(self):
-        now = datetime.utcnow()
-        dead = []
-        for cid, info in list(self.clients.items()):
-            if now - info["last_seen"] > timedelta(seconds=self.heartbeat_timeout):
-                dead.append(cid)
-        for cid in dead:
+        now = time.monotonic()
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            _, cid = heapq.heappop(expiry)
+            info = self.clients.get(cid)
+            if info is None:
+                continue
+            deadline = info.last_seen + self.heartbeat_timeout
+            if deadline > now:
+                # seen since the entry was pushed, reschedule
+                heapq.heappush(expiry, (deadline, cid))
+                continue
             if not self.silent:
                 print(f"[TIMEOUT] Removing client {cid.decode()}")
-            del self.clients[cid]
+            if not info.msgpack:
+                self._legacy_clients -= 1
+            with self._clients_lock:
+                del self.clients[cid]
                 
     def print_clients(self, short=False):
         if len(self.clients) == 0:
@@ -158,11 +554,72 @@ class ServerSideCom:
                 print(cidstr)
             else:
                 print("connected clients:")
+                now = time.monotonic()
                 for cid, info in list(self.clients.items()):
-                    print(cid, "- last seen:", info["last_seen"])
+                    print(cid, "- last seen:", f"{now - info.last_seen:.1f}s ago")
 
     def get_connected(self):
-        return self.clients
+        """Return a snapshot (dict copy) of the connected clients."""
+        with self._clients_lock:
+            return dict(self.clients)
+
+    def wait_for_clients(self, client_ids, timeout=None):
+        """
+        Block until all given clients are connected or the timeout expires.
+
+        The waiter is woken by the server thread each time a new client
+        registers, so there is no polling delay.
+
+        Parameters
+        ----------
+        client_ids : Iterable[bytes]
+            ROUTER identities of the clients to wait for.
+        timeout : float, optional
+            Maximum number of seconds to wait. If omitted, wait indefinitely.
+
+        Returns
+        -------
+        list of bytes
+            Identities that are still not connected (empty on success).
+        """
+        client_ids = list(client_ids)
+
+        def missing():
+            return [cid for cid in client_ids if cid not in self.clients]
+
+        with self.clients_changed:
+            self.clients_changed.wait_for(lambda: not missing(), timeout)
+        return missing()
+
+    def set_groups(self, groups):
+        """
+        Define the tile groups (e.g. inventory segments) that can be addressed
+        with a single publish.
+
+        Connected clients are told to (re)subscribe to their group topics
+        immediately, clients that connect later on registration.
+
+        Parameters
+        ----------
+        groups : dict
+            Maps group names to iterables of client ids (str).
+        """
+        groups = {
+            name: frozenset(cid.encode() for cid in members)
+            for name, members in groups.items()
+        }
+        self._submit([(self._apply_groups, (groups,))])
+
+    def _apply_groups(self, groups):
+        self.groups = groups
+        self._client_groups = {}
+        for name, members in self.groups.items():
+            for cid in members:
+                self._client_groups.setdefault(cid, []).append(name)
+
+        for cid in list(self.clients):
+            self.clients[cid].subscribed = False
+            self._push_subscriptions(cid)
 
     def send(self, client_id, msg_type, *payload_frames):
         """
@@ -174,27 +631,170 @@ class ServerSideCom:
             The ROUTER identity of the client.
         msg_type : str
             Message type string (e.g., 'command', 'ping', etc.).
-        payload_frames : list of bytes or str
-            Optional additional frames after the message type.
+        payload_frames : list of bytes, str or objects
+            Optional additional frames after the message type. Objects (dict,
+            list, ...) are encoded with the negotiated codec (see codec.py),
+            raw buffers (bytes, numpy arrays) are sent without a copy.
+        """
+        self._check_clients((client_id,))
+        self._submit([(self._send, (client_id, msg_type) + payload_frames)])
+
+    def send_batch(self, messages):
+        """
+        Send several unicast messages with a single handoff to the server thread.
+
+        Parameters
+        ----------
+        messages : Iterable[tuple]
+            (client_id, msg_type, *payload_frames) tuples, see send.
         """
+        messages = [tuple(m) for m in messages]
+        self._check_clients(m[0] for m in messages)
+        self._submit([(self._send, m) for m in messages])
+
+    def broadcast(self, msg_type, *payload_frames):
+        """Publish a message to all clients."""
+        self._submit([(self._publish, (GLOBAL_TOPIC, msg_type) + payload_frames)])
+
+    def publish(self, topic, msg_type, *payload_frames):
+        """Publish a message to all clients subscribed to topic."""
+        self._submit([(self._publish, (topic, msg_type) + payload_frames)])
+
+    def multicast(self, client_ids, msg_type, *payload_frames):
+        """
+        Send a message to a subset of the connected clients with as few sends
+        as possible.
+
+        Groups (see set_groups) that are entirely part of client_ids are
+        addressed with one publish on their group topic. The remaining
+        clients get a publish on their tile topic, or a ROUTER unicast if they
+        did not confirm their subscriptions yet. Every client receives the
+        message exactly once.
+
+        Parameters
+        ----------
+        client_ids : Iterable[bytes]
+            ROUTER identities of the addressed clients.
+        msg_type : str
+            Message type string.
+        payload_frames : list of bytes, str or objects
+            Optional additional frames after the message type. Objects (dict,
+            list, ...) are encoded with the negotiated codec (see codec.py),
+            raw buffers (bytes, numpy arrays) are sent without a copy.
+        """
+        client_ids = list(client_ids)
+        self._check_clients(client_ids)
+        self._submit([(self._multicast, (client_ids, msg_type, payload_frames))])
+
+    def _check_clients(self, client_ids):
+        for cid in client_ids:
+            if cid not in self.clients:
+                raise ValueError(f"Client {cid!r} is not connected.")
+
+    def _submit(self, ops):
+        """
+        Run a batch of (func, args) operations on the server thread.
+
+        Called from the server thread itself (callbacks) or before the server
+        is started, the operations run immediately.
+        """
+        if self.thread is None or threading.current_thread() is self.thread:
+            return self._execute(ops)
+        if not self.running:
+            raise RuntimeError("Server is not running.")
+
+        self._outbox.put(ops)
+        try:
+            self._wake_socket().send(b"", zmq.NOBLOCK)
+        except zmq.Again:
+            pass  # the server thread has plenty of wake-ups queued already
+
+    def _wake_socket(self):
+        sock = getattr(self._local, "wake", None)
+        if sock is None:
+            sock = self.context.socket(zmq.PUSH)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(self._wake_endpoint)
+            self._local.wake = sock
+            with self._wake_lock:
+                self._wake_sockets.append(sock)
+        return sock
+
+    def _drain_outbox(self):
+        # consume all wake-ups first, every queued batch is handled below
+        while True:
+            try:
+                self._wake.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        while True:
+            try:
+                ops = self._outbox.get_nowait()
+            except queue.Empty:
+                break
+            self._execute(ops)
+
+    def _execute(self, ops):
+        results = []
+        for func, args in ops:
+            try:
+                results.append(func(*args))
+            except Exception as e:
+                print(f"[{__class__}] {func.__name__} failed: {e}")
+        return results
+
+    def _multicast(self, client_ids, msg_type, payload_frames):
+        remaining = set(client_ids)
+        results = []
+
+        # largest groups first, so a segment is never split into tiles
+        for name, members in sorted(self.groups.items(), key=lambda g: -len(g[1])):
+            if members and members <= remaining and all(
+                    cid in self.clients and self.clients[cid].subscribed for cid in members):
+                results.append(self._publish(group_topic(name), msg_type, *payload_frames))
+                remaining -= members
+
+        for cid in client_ids:
+            if cid not in remaining:
+                continue
+            if cid not in self.clients:
+                continue  # timed out since multicast was called
+            if self.clients[cid].subscribed:
+                results.append(self._publish(tile_topic(cid.decode()), msg_type, *payload_frames))
+            else:
+                results.append(self._send(cid, msg_type, *payload_frames))
+
+        return results
+
+    def _send(self, client_id, msg_type, *payload_frames):
         if client_id not in self.clients:
             raise ValueError(f"Client {client_id!r} is not connected.")
 
         # Build multipart message
-        frames = [client_id, msg_type.encode()]
-        for frame in payload_frames:
-            if isinstance(frame, str):
-                frame = frame.encode()
-            frames.append(frame)
+        self._count(self._tx_counters, "server_messages_sent_total", msg_type)
+        frames = [client_id] + codec.encode_frames(msg_type, payload_frames, self.clients[client_id].codec or codec.JSON)
 
-        self.messaging.send_multipart(frames)
+        return self.messaging.send_multipart(frames, copy=False)
 
-    def broadcast(self, msg_type, *payload_frames):
-        frames = [msg_type.encode()]
+    def _publish(self, topic, msg_type, *payload_frames):
+        self._count(self._tx_counters, "server_messages_sent_total", msg_type)
+        frames = codec.encode_frames(msg_type, payload_frames, self._publish_codec())
+
+        seq = self._pub_seq.get(topic, 0) + 1
+        self._pub_seq[topic] = seq
+        history = self._history.get(topic)
+        if history is None:
+            history = self._history[topic] = collections.deque(maxlen=self.publish_history)
+        history.append((seq, frames))
+
+        return self.sync.send_multipart([f"{topic}{seq}".encode()] + frames, copy=False)
 
-        for f in payload_frames:
-            if isinstance(f, str):
-                f = f.encode()
-            frames.append(f)
+    def _background(self, result):
+        """Hook for the result of a send issued by the server itself, which nobody awaits."""
+        return result
 
-        self.sync.send_multipart(frames)
+    def _publish_codec(self):
+        """Codec that every connected client understands."""
+        if codec.MSGPACK is not None and self._legacy_clients == 0:
+            return codec.MSGPACK
+        return codec.JSON
@@ -0,0 +1,186 @@
+"""
+Lightweight runtime statistics for the control plane.
+
+Counters, gauges and histograms are kept in a Stats registry and can be
+exposed in the Prometheus text format on a local HTTP endpoint:
+
+    stats = Stats()
+    stats.counter("messages_received_total", "Received messages", type="usrp_done").inc()
+    StatsServer(stats, port=5680).start()
+    # curl http://127.0.0.1:5680/metrics
+
+Metrics are updated without locking: they are written from the server thread
+(and occasionally the main thread), and a scrape may see a value that is one
+update behind.
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets in seconds, roughly logarithmic from 100 us to 60 s
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0,
+)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield (name, labels, self.value)
+
+
+class Gauge:
+    __slots__ = ("value", "func")
+
+    def __init__(self, func=None):
+        self.value = 0
+        # optional callable evaluated at scrape time
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield (name, labels, self.func() if self.func else self.value)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # one count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Approximate quantile (upper bound of the bucket it falls in)."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield (name + "_bucket", labels + (("le", le),), cumulative)
+        yield (name + "_sum", labels, self.sum)
+        yield (name + "_count", labels, self.count)
+
+
+class Stats:
+    """Registry of named metrics, each with any number of label combinations."""
+
+    _types = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help, {labels: metric})
+        self._metrics = {}
+
+    def counter(self, name, help="", **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", func=None, **labels):
+        return self._get(Gauge, name, help, labels, func)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def _get(self, cls, name, help, labels, *init):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._metrics.get(name)
+            if family is None:
+                family = self._metrics[name] = (cls, help, {})
+            elif family[0] is not cls:
+                raise ValueError(f"Metric {name} already registered as {self._types[family[0]]}")
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(*init)
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            families = [(name, cls, help, list(metrics.items())) for name, (cls, help, metrics) in self._metrics.items()]
+
+        for name, cls, help, metrics in sorted(families, key=lambda f: f[0]):
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {self._types[cls]}")
+            for labels, metric in metrics:
+                for sample_name, sample_labels, value in metric.samples(name, labels):
+                    if sample_labels:
+                        label_str = ",".join(f'{k}="{v}"' for k, v in sample_labels)
+                        lines.append(f"{sample_name}{{{label_str}}} {value}")
+                    else:
+                        lines.append(f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class StatsServer:
+    """Serve a Stats registry as Prometheus text on http://<host>:<port>/metrics."""
+
+    def __init__(self, stats, port, host="127.0.0.1"):
+        self.stats = stats
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path not in ("/", "/metrics"):
+                    handler.send_error(404)
+                    return
+                body = stats.render().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass  # keep the server console clean
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.thread = None
+
+
+__all__ = ["Counter", "Gauge", "Histogram", "Stats", "StatsServer"]
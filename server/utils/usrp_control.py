@@ -1,6 +1,10 @@
 from utils.server_com import ServerSideCom
+from utils.latency_stats import LatencyStats
 from enum import Enum
+import itertools
 import json
+import math
+import threading
 import time
 
 class USRP_Control:
@@ -13,6 +17,7 @@ class USRP_Control:
     class Response(Enum):
         ACK = "usrp_ack"
         DONE = "usrp_done"
+        ERROR = "usrp_error"
 
     class ReturnCode(Enum):
         OK = 1
@@ -21,21 +26,66 @@ class USRP_Control:
         PREVIOUS_COMMAND_RUNNING = 4
         UNKNOWN_ERROR = 255
     
+    # Assumed one-way delivery time of tiles without clock estimates yet
+    UNKNOWN_DELIVERY_S = 1.0
+    # Resend a command by unicast to tiles that did not ACK it within this
+    # time (doubled after every resend), e.g. because they missed the publish
+    RESEND_AFTER_S = 0.5
+    # Adaptive timeouts and straggler limits: percentile of a tile's recent
+    # latencies, times a factor, plus a fixed margin
+    TIMEOUT_PERCENTILE = 99
+    TIMEOUT_FACTOR = 1.5
+    TIMEOUT_MARGIN_S = 0.5
+    # Tile message that cancels a command (handled by the tiles' CommandExecutor)
+    CANCEL_COMMAND = "usrp_cancel"
+
     class CommandStatus(Enum):
         RUNNING = 0
         ACK = 1
         DONE = 2
         TIMEOUT = 3
         MISSING_HOSTS = 4
+        ERROR = 5
     
-    def __init__(self, server_side_com=None, silent=True):
+    def __init__(self, server_side_com=None, silent=True, latency_stats_path=None):
+        """
+        Parameters
+        ----------
+        server_side_com : ServerSideCom
+            Server used to reach the tiles.
+        silent : bool
+            Suppress console output (e.g. straggler warnings).
+        latency_stats_path : str, optional
+            JSON file the per-tile latency statistics are loaded from and
+            saved to (see save_latency_stats), so adaptive timeouts start
+            from the estimates of previous runs.
+        """
         if not server_side_com:
             raise ValueError(f"{__class__}: server_side_com not specified")
         
         self.server = server_side_com
         self.server.on(self.Response.ACK.value, self._handle_ack)
         self.server.on(self.Response.DONE.value, self._handle_done)
+        self.server.on(self.Response.ERROR.value, self._handle_error)
         self.required_hosts = {}
+        # Guards required_hosts and the command tables; notified when a command completes
+        self._status_changed = threading.Condition()
+        # Correlation IDs: every command carries a "cmd_id" that tiles echo in
+        # their ACK/DONE, so several commands can be in flight at once
+        self._cmd_ids = itertools.count(1)
+        # cmd_id -> PendingCommand
+        self._commands = {}
+        # host -> cmd_ids it still has to report DONE for, oldest first
+        # (used to match replies of tiles that do not echo the cmd_id)
+        self._host_commands = {}
+        # Latency instrumentation, exported through the server's stats registry
+        self.stats = self.server.stats
+        self._ack_hists = {}
+        self._done_hists = {}
+        # Rolling per-tile, per-command latencies for adaptive timeouts
+        self.silent = silent
+        self.latency_stats_path = latency_stats_path
+        self.latency = LatencyStats.load(latency_stats_path) if latency_stats_path else LatencyStats()
         
     def start(self):
         if not self.server.running:
@@ -43,23 +93,43 @@ class USRP_Control:
             self.server.start()
     
     def set_required_hosts(self, host_list = []):
-        for h in host_list:
-            self.required_hosts[h] = {"command_status": self.CommandStatus.DONE}
+        with self._status_changed:
+            for h in host_list:
+                self.required_hosts[h] = {"command_status": self.CommandStatus.DONE}
     
-    def wait_until_connected(self, host_list = None, *, timeout_s = None):
-        start = time.monotonic()
-        interval = 0.1
+    def save_latency_stats(self):
+        """Persist the latency statistics to latency_stats_path (if set)."""
+        if self.latency_stats_path:
+            with self._status_changed:
+                self.latency.save(self.latency_stats_path)
 
-        while True:
-            all_connected, missing_list = self._check_connected(host_list)
-            if all_connected:
-                break
+    def expected_latency(self, tile, command, kind):
+        """
+        Latency limit (seconds since sending) within which tile normally sends
+        its ACK (kind="ack") or DONE (kind="done") for command, based on its
+        recent history. None if there is not enough history yet.
+        """
+        with self._status_changed:
+            latency = self.latency.percentile(tile, command.name, kind, self.TIMEOUT_PERCENTILE)
+        if latency is None:
+            return None
+        return latency * self.TIMEOUT_FACTOR + self.TIMEOUT_MARGIN_S
+
+    def set_groups(self, groups):
+        """
+        Register tile groups (name -> list of tiles), e.g. inventory segments.
+        Commands addressing all tiles of a group are sent as a single publish.
+        """
+        self.server.set_groups(groups)
 
-            if timeout_s:
-                if time.monotonic() - start >= timeout_s:
-                    raise TimeoutError(f"Not all hosts connected in time. Missing {missing_list}.")
+    def wait_until_connected(self, host_list = None, *, timeout_s = None):
+        if host_list is None:
+            host_list = list(self.required_hosts)
 
-            time.sleep(interval)
+        missing = self.server.wait_for_clients((h.encode() for h in host_list), timeout_s or None)
+        if missing:
+            missing_list = [cid.decode() for cid in missing]
+            raise TimeoutError(f"Not all hosts connected in time. Missing {missing_list}.")
     
     def send_command(self, command: Command = Command.UNDEFINED, **args):
         """
@@ -69,12 +139,19 @@ class USRP_Control:
         (i.e., have sent a recent heartbeat). If any required tile is offline,
         the command is not sent and an exception is raised.
 
-        If a list of tiles is provided, the command is sent sequentially as
-        individual unicasts. If no tiles are specified, the command is broadcast
-        to all known tiles.
+        If a list of tiles is provided, the command is published once per tile
+        group that is entirely addressed (see set_groups) and once per
+        remaining tile. If no tiles are specified, the command is broadcast to
+        all known tiles.
+
+        Every command gets a correlation ID that is added to its arguments as
+        "cmd_id" and echoed by the tiles in their ACK/DONE replies, so replies
+        to an earlier (timed out) command cannot complete this one.
 
-        After sending, the method waits until all addressed tiles report
-        CommandStatus.DONE or until an optional timeout expires.
+        After sending, the method waits until the addressed tiles report
+        CommandStatus.DONE (all of them, or the quorum given by `quorum`) or
+        until an optional timeout expires. Tiles that fail the command reply
+        with 'usrp_error' instead and count as CommandStatus.ERROR.
 
         Parameters
         ----------
@@ -88,65 +165,348 @@ class USRP_Control:
             - timeout_s (float, optional):
                 Maximum number of seconds to wait for all tiles to report
                 CommandStatus.DONE. If omitted, wait indefinitely.
+            - quorum (int or float, optional):
+                Complete as soon as this many tiles (int, k-of-n) or this
+                fraction of the tiles (float in (0, 1]) report DONE. Defaults
+                to all tiles.
+            - best_effort (bool, optional):
+                Return at the timeout with whatever completed instead of
+                raising TimeoutError.
+            - adaptive_timeout (bool, optional):
+                Derive the timeout from the DONE latencies of the addressed
+                tiles for this command type (see expected_latency). Falls
+                back to timeout_s while any tile lacks history.
+            - start_margin_s (float, optional):
+                Schedule a synchronized start. The command gets a "start_time"
+                (server wall clock, seconds since the epoch) that lies the
+                measured delivery time of the slowest addressed tile plus
+                this margin in the future. Tiles convert it to their own
+                clock with the offset the server measured for them.
+            - resend_after_s (float, optional):
+                Resend the command by unicast to tiles that did not ACK it
+                after this many seconds (doubling every time). Tiles that
+                missed a publish normally recover it sooner by NACK; this
+                covers the last publish on a topic. Defaults to
+                RESEND_AFTER_S, 0 disables resending.
             - TODO: add command specific arguments
 
+        Returns
+        -------
+        PendingCommand
+            The command; its completed, late (ACK but no DONE) and missing
+            (no reply at all) tiles are listed in the attributes of the same
+            name. Tiles that were slower than their history predicts are
+            listed in its stragglers attribute.
+
         Raises
         ------
         ConnectionError
             If one or more required tiles are not connected at send time.
         TimeoutError
-            If not all tiles report CommandStatus.DONE before the timeout expires.
+            If the quorum is not reached before the timeout expires (unless
+            best_effort is set).
+        RuntimeError
+            If so many tiles reported an error that the quorum cannot be
+            reached anymore (unless best_effort is set).
+        """
+        pending = self.submit_command(command, **args)
+        timeout_s = self._timeout(pending, args)
+
+        # wait for "CommandStatus.DONE"
+        return self.wait_until_done(pending, timeout_s, best_effort=args.get("best_effort", False))
+
+    def submit_command(self, command: Command = Command.UNDEFINED, **args):
+        """
+        Send a command without waiting for its completion.
+
+        Takes the same arguments as send_command. Independent commands (e.g.
+        to disjoint tile groups) can be submitted back to back and waited for
+        afterwards with wait_until_done.
+
+        Returns
+        -------
+        PendingCommand
+            Handle holding the command's cmd_id and per-host status.
+        """
+        tiles, pending, payload = self._prepare_command(command, args)
+
+        if tiles: # tiles specified -> group/tile topic publishes
+            self.server.multicast([tile.encode() for tile in tiles], command.value, payload)
+        else: # no tiles specified -> broadcast
+            # send commmand
+            self.server.broadcast(command.value, payload)
+
+        return pending
+
+    def wait_until_done(self, pending, timeout_s = None, best_effort = False):
+        """
+        Block until the quorum of hosts addressed by pending (all by default,
+        see send_command) report DONE.
+
+        Once this returns or raises, the command is released: replies from
+        hosts that were not DONE yet are ignored. Waiting also ends when the
+        command is released elsewhere, e.g. by cancel_command.
+
+        Returns
+        -------
+        PendingCommand
+            pending, see PendingCommand.completed/late/missing.
+
+        Raises
+        ------
+        TimeoutError
+            If the quorum is not reached before the timeout expires and
+            best_effort is not set.
+        RuntimeError
+            If too many hosts reported an error to reach the quorum, or the
+            command was released before reaching it, and best_effort is not
+            set.
+        """
+        deadline = time.monotonic() + timeout_s if timeout_s else math.inf
+        resend_after = pending.resend_after_s
+        resend_at = pending.sent_at + resend_after if resend_after else math.inf
+        check_at = self._flag_stragglers(pending)
+
+        while True:
+            wake_at = min(deadline, resend_at, check_at)
+            # woken by _handle_done/_handle_error as soon as the outcome is known,
+            # and by _release
+            with self._status_changed:
+                settled = self._status_changed.wait_for(
+                    lambda: pending.settled or pending.released,
+                    None if wake_at == math.inf else max(0, wake_at - time.monotonic()))
+            if settled:
+                break
+
+            now = time.monotonic()
+            check_at = self._flag_stragglers(pending)
+            if now < resend_at and now < deadline:
+                continue
+            if now >= deadline:
+                if not best_effort:
+                    self._release(pending)
+                    raise TimeoutError(f"Not all hosts reported done in time for command {pending.cmd_id}.")
+                break
+            self._resend_unacked(pending)
+            resend_after *= 2
+            resend_at = now + resend_after
+
+        if pending.released and not pending.settled:
+            # cancelled (cancel_command) or given up by another waiter meanwhile
+            if not best_effort:
+                raise RuntimeError(f"Command {pending.cmd_id} was released before its quorum was reached.")
+            return pending
+        if not pending.done:
+            self._release(pending, timed_out=not pending.settled)
+        self._check_failed(pending, best_effort)
+        return pending
+
+    def cancel_command(self, pending):
+        """
+        Ask the hosts that did not finish pending yet to cancel it, and stop
+        waiting for them.
+
+        Tiles running the command with a CommandExecutor abort it and reply
+        'usrp_error' with error "cancelled".
+        """
+        with self._status_changed:
+            hosts = [host for host, status in pending.status.items()
+                     if status in (self.CommandStatus.RUNNING, self.CommandStatus.ACK)]
+        if hosts:
+            self.server.multicast([host.encode() for host in hosts], self.CANCEL_COMMAND, {"cancel_id": pending.cmd_id})
+        if not pending.done:
+            self._release(pending, timed_out=False)
+
+    def progress(self, pending, timeout_s = None):
+        """
+        Iterate over the replies to pending as they arrive.
+
+        Yields (host, CommandStatus) for every ACK, DONE and ERROR, until all
+        hosts replied, the command is released (e.g. by wait_until_done) or the
+        timeout expires. Unlike wait_until_done, this neither raises nor
+        resends the command:
+
+            pending = usrp.submit_command(usrp.Command.SYNC)
+            for host, status in usrp.progress(pending, timeout_s=10):
+                print(host, status.name)
         """
+        deadline = time.monotonic() + timeout_s if timeout_s else None
+        index = 0
+        while True:
+            with self._status_changed:
+                self._status_changed.wait_for(
+                    lambda: len(pending.events) > index or pending.done or pending.released,
+                    None if deadline is None else max(0, deadline - time.monotonic()))
+                events = pending.events[index:]
+            if not events:
+                return
+            index += len(events)
+            yield from events
+
+    def _prepare_command(self, command, args):
+        """Check connectivity, assign a cmd_id and register the command before it is sent."""
         tiles = args.get("tiles", None)
-        timeout_s = args.get("timeout_s", None)
-        
+
         # check if all tiles we want to send to are connected (recently got a heartbeat)
         (all_connected, missing) = self._check_connected(tiles)
-        
+
         # no use in continuing
         if not all_connected:
             raise ConnectionError(f"No connection with tiles {missing}")
-        else:
-            # seen all necessary tiles withing the last heartbeat interval
-            if tiles: # tiles specified -> sequential unicast
-                for tile in tiles:
-                    # update command status
-                    self.required_hosts[tile]["command_status"] = self.CommandStatus.RUNNING
-                    # send command
-                    self.server.send(tile.encode(), command.value, json.dumps(args))
-            else: # no tiles specified -> broadcast
-                # update command status
-                for tile in self.required_hosts:
-                    self.required_hosts[tile]["command_status"] = self.CommandStatus.RUNNING
-                # send commmand
-                self.server.broadcast(command.value, json.dumps(args))
-            
-            # wait for "CommandStatus.DONE"
+
+        # seen all necessary tiles withing the last heartbeat interval
+        # register before sending, so a fast reply cannot be missed
+        pending = self._register(command, tiles if tiles else list(self.required_hosts))
+        # encoded by ServerSideCom with the codec negotiated with the tiles
+        payload = dict(args, cmd_id=pending.cmd_id)
+        if args.get("start_margin_s") is not None:
+            payload["start_time"] = self._schedule_start(pending.status, args["start_margin_s"])
+        pending.payload = payload
+        pending.resend_after_s = args.get("resend_after_s", self.RESEND_AFTER_S)
+        pending.required = self._quorum_size(args.get("quorum"), len(pending.status))
+        pending.limits = {
+            host: (self.expected_latency(host, command, "ack"), self.expected_latency(host, command, "done"))
+            for host in pending.status
+        }
+        return (tiles, pending, payload)
+
+    def _timeout(self, pending, args):
+        """Timeout of a command: adaptive (if requested and known) or timeout_s."""
+        if args.get("adaptive_timeout"):
+            done_limits = [done for _, done in pending.limits.values()]
+            if done_limits and None not in done_limits:
+                return max(done_limits)
+        return args.get("timeout_s", None)
+
+    def _flag_stragglers(self, pending):
+        """
+        Flag hosts of pending that did not ACK/DONE within their expected
+        latency (see expected_latency). Returns the time.monotonic() at which
+        the next host may turn into a straggler (math.inf if none).
+        """
+        now = time.monotonic()
+        elapsed = now - pending.sent_at
+        next_check = math.inf
+        with self._status_changed:
+            for host, (ack_limit, done_limit) in pending.limits.items():
+                status = pending.status[host]
+                if host in pending.stragglers or status in (self.CommandStatus.DONE, self.CommandStatus.ERROR):
+                    continue
+                limits = [done_limit]
+                if status is self.CommandStatus.RUNNING:
+                    limits.append(ack_limit)
+                limits = [limit for limit in limits if limit is not None]
+                if any(elapsed >= limit for limit in limits):
+                    pending.stragglers.append(host)
+                    self.stats.counter("usrp_stragglers_total", "Tiles slower than their latency history",
+                                       tile=host).inc()
+                    if not self.silent:
+                        print(f"[STRAGGLER] {host}: no {'ACK' if status is self.CommandStatus.RUNNING else 'DONE'} "
+                              f"for command {pending.cmd_id} after {elapsed:.2f}s")
+                elif limits:
+                    next_check = min(next_check, pending.sent_at + min(limits))
+        return next_check
+
+    def _check_failed(self, pending, best_effort):
+        """Raise if errors made the quorum of pending unreachable (unless best_effort)."""
+        if pending.satisfied or not pending.settled or best_effort:
+            return
+        errors = ", ".join(f"{host}: {error}" for host, error in pending.errors.items())
+        raise RuntimeError(f"Command {pending.cmd_id} failed on too many hosts ({errors}).")
+
+    @staticmethod
+    def _quorum_size(quorum, n):
+        """Number of DONE replies out of n required by a quorum (see send_command)."""
+        if quorum is None:
+            return n
+        if isinstance(quorum, float):
+            if not 0 < quorum <= 1:
+                raise ValueError(f"Quorum fraction must be in (0, 1], got {quorum}")
+            return min(n, math.ceil(quorum * n))
+        return max(0, min(n, int(quorum)))
+
+    def _unacked_hosts(self, pending):
+        """Connected hosts that did not ACK (or complete) pending yet."""
+        connected = self.server.clients
+        with self._status_changed:
+            return [host for host, status in pending.status.items()
+                    if status is self.CommandStatus.RUNNING and host.encode() in connected]
+
+    def _resend_unacked(self, pending):
+        """Resend pending by unicast to the hosts that did not ACK it."""
+        if pending.released:
+            return  # cancelled, the tiles must not get it again
+        payload = dict(pending.payload, resend=True)
+        for host in self._unacked_hosts(pending):
             try:
-                self._wait_until_done(timeout_s)
-            except TimeoutError as e:
-                raise e
-    
-    
-    def _wait_until_done(self, timeout_s = None):
-        start = time.monotonic()
-        interval = 0.1
+                self.server.send(host.encode(), pending.command.value, payload)
+            except ValueError:
+                continue  # timed out in the meantime
+            self.stats.counter("usrp_command_resends_total", "Commands resent to tiles that did not ACK",
+                               command=pending.command.name).inc()
 
-        while True:
-            all_done = all(
-                entry['command_status'] is self.CommandStatus.DONE
-                for entry in self.required_hosts.values()
-            )
-            if all_done:
-                break
+    def _schedule_start(self, tiles, margin_s):
+        """Earliest start time (server clock) that all tiles can make, plus margin_s."""
+        lead = 0.0
+        for tile in tiles:
+            estimator = self.server.clock_estimate(tile.encode())
+            bound = estimator.delivery_bound() if estimator and estimator.valid else None
+            lead = max(lead, self.UNKNOWN_DELIVERY_S if bound is None else bound)
+        return time.time() + lead + margin_s
+
+    def _register(self, command, tiles):
+        """Create the PendingCommand for tiles and mark them RUNNING."""
+        with self._status_changed:
+            pending = PendingCommand(command, tiles, next(self._cmd_ids))
+            self._commands[pending.cmd_id] = pending
+            self.stats.counter("usrp_commands_total", "Commands sent", command=command.name).inc()
+            for tile in tiles:
+                self.required_hosts[tile]["command_status"] = self.CommandStatus.RUNNING
+                self._host_commands.setdefault(tile, []).append(pending.cmd_id)
+            if pending.settled:
+                self._command_done(pending)
+        return pending
+
+    def _release(self, pending, timed_out=True):
+        """Forget a command (after a timeout or reaching its quorum), so late replies are ignored."""
+        if timed_out:
+            self.stats.counter("usrp_command_timeouts_total", "Commands that timed out", command=pending.command.name).inc()
+        with self._status_changed:
+            pending.released = True
+            self._status_changed.notify_all()
+            self._commands.pop(pending.cmd_id, None)
+            for tile in pending.status:
+                cmd_ids = self._host_commands.get(tile)
+                if cmd_ids and pending.cmd_id in cmd_ids:
+                    cmd_ids.remove(pending.cmd_id)
 
-            # check for timeout
-            if timeout_s:
-                if time.monotonic() - start >= timeout_s:
-                    raise TimeoutError("Not all hosts reported done in time.")
+    def _command_done(self, pending):
+        """Called with _status_changed held when pending is settled (possibly more than once)."""
+        self._status_changed.notify_all()
 
-            time.sleep(interval)
-                
+    def _command_progress(self, pending):
+        """Called with _status_changed held on every ACK/DONE/ERROR of pending (see progress)."""
+        self._status_changed.notify_all()
+
+    def _tile_hist(self, cache, name, help, tile):
+        hist = cache.get(tile)
+        if hist is None:
+            hist = cache[tile] = self.stats.histogram(name, help, tile=tile)
+        return hist
+
+    def _find_command(self, id, args):
+        """Return the PendingCommand a reply from host id belongs to, or None."""
+        cmd_id = None
+        if args and isinstance(args[0], dict):
+            cmd_id = args[0].get("cmd_id")
+
+        if cmd_id is None:
+            # tile does not echo cmd_ids: assume it answers its oldest command
+            cmd_ids = self._host_commands.get(id)
+            cmd_id = cmd_ids[0] if cmd_ids else None
+
+        return self._commands.get(cmd_id)
+    
     
     def _check_connected(self, host_list=None):
         connected_hosts = self.server.get_connected()
@@ -161,14 +521,169 @@ class USRP_Control:
             
             
     def _handle_ack(self, id, args):
-        try:
-            self.required_hosts[id]["command_status"] = self.CommandStatus.ACK
-        except LookupError as e:
-            raise LookupError(f"Got ACK from {id}, but it is not in required host list.\nAre other tiles still running?\n{e}")
+        with self._status_changed:
+            try:
+                entry = self.required_hosts[id]
+            except LookupError as e:
+                raise LookupError(f"Got ACK from {id}, but it is not in required host list.\nAre other tiles still running?\n{e}")
+            pending = self._find_command(id, args)
+            if pending and pending.ack(id):
+                entry["command_status"] = self.CommandStatus.ACK
+                self._tile_hist(self._ack_hists, "usrp_send_to_ack_seconds",
+                                "Time from sending a command to the tile's ACK", id).observe(
+                    pending.ack_at[id] - pending.sent_at)
+                self.latency.add(id, pending.command.name, "ack", pending.ack_at[id] - pending.sent_at)
+                self._command_progress(pending)
         
         
     def _handle_done(self, id, args):
-        try:
-            self.required_hosts[id]["command_status"] = self.CommandStatus.DONE
-        except LookupError as e:
-            raise LookupError(f"Got DONE from {id}, but it is not in required host list.\nAre other tiles still running?\n{e}")
+        self._handle_finished(id, args)
+
+    def _handle_error(self, id, args):
+        error = args[0].get("error", "unknown error") if args and isinstance(args[0], dict) else "unknown error"
+        self._handle_finished(id, args, error)
+
+    def _handle_finished(self, id, args, error=None):
+        """Record a DONE (error is None) or ERROR reply of host id."""
+        with self._status_changed:
+            try:
+                entry = self.required_hosts[id]
+            except LookupError as e:
+                raise LookupError(f"Got {'ERROR' if error else 'DONE'} from {id}, but it is not in required host list.\nAre other tiles still running?\n{e}")
+            pending = self._find_command(id, args)
+            if not pending:
+                # reply to a command that already timed out or reached its quorum
+                self.stats.counter("usrp_late_replies_total", "DONE/ERROR replies to released commands").inc()
+                return
+            cmd_ids = self._host_commands.get(id)
+            if cmd_ids and pending.cmd_id in cmd_ids:
+                cmd_ids.remove(pending.cmd_id)
+            if not cmd_ids:
+                entry["command_status"] = self.CommandStatus.ERROR if error else self.CommandStatus.DONE
+            if error is not None:
+                if pending.status.get(id) in (self.CommandStatus.RUNNING, self.CommandStatus.ACK):
+                    self.stats.counter("usrp_command_errors_total", "Commands that failed on a tile",
+                                       command=pending.command.name).inc()
+                    if not self.silent:
+                        print(f"[ERROR] {id}: command {pending.cmd_id} failed: {error}")
+                completed = pending.fail(id, error)
+            else:
+                if pending.status.get(id) in (self.CommandStatus.RUNNING, self.CommandStatus.ACK):
+                    self.latency.add(id, pending.command.name, "done", time.monotonic() - pending.sent_at)
+                result = {k: v for k, v in args[0].items() if k != "cmd_id"} if args and isinstance(args[0], dict) else {}
+                completed = pending.complete(id, result)
+                if id in pending.ack_at:
+                    self._tile_hist(self._done_hists, "usrp_ack_to_done_seconds",
+                                    "Time from the tile's ACK to its DONE", id).observe(
+                        time.monotonic() - pending.ack_at[id])
+            if completed:
+                del self._commands[pending.cmd_id]
+                self.stats.histogram("usrp_command_seconds", "Time from sending a command to the last DONE",
+                                     command=pending.command.name).observe(time.monotonic() - pending.sent_at)
+            if pending.settled:
+                self._command_done(pending)
+            self._command_progress(pending)
+
+
+class PendingCommand:
+    """Completion state of one in-flight command, tracked per (command, host)."""
+
+    def __init__(self, command, hosts, cmd_id):
+        self.command = command
+        self.cmd_id = cmd_id
+        self.status = dict.fromkeys(hosts, USRP_Control.CommandStatus.RUNNING)
+        # number of addressed hosts that did not report DONE (or ERROR) yet,
+        # and the number of DONE replies that completes the command (quorum)
+        self.remaining = len(self.status)
+        self.required = len(self.status)
+        # host -> error message of its usrp_error reply
+        self.errors = {}
+        # host -> fields of its usrp_done reply (e.g. the start time of a capture)
+        self.results = {}
+        # (host, status) in arrival order, see USRP_Control.progress
+        self.events = []
+        # set once the command is forgotten and later replies are ignored
+        self.released = False
+        # completion future and progress event of the asyncio variant
+        self.future = None
+        self.changed = None
+        # time.monotonic() timestamps for latency statistics
+        self.sent_at = time.monotonic()
+        self.ack_at = {}
+        self.done_at = None
+        # sent payload, kept to resend it to tiles that did not ACK
+        self.payload = None
+        self.resend_after_s = None
+        # host -> (ACK, DONE) latency limits from its history, and the hosts
+        # that exceeded them
+        self.limits = {}
+        self.stragglers = []
+
+    @property
+    def done(self):
+        return self.remaining == 0
+
+    @property
+    def satisfied(self):
+        """True once the quorum of hosts reported DONE."""
+        return len(self.status) - self.remaining - len(self.errors) >= self.required
+
+    @property
+    def settled(self):
+        """True once the quorum was reached, or errors made it unreachable."""
+        done = len(self.status) - self.remaining - len(self.errors)
+        return done >= self.required or done + self.remaining < self.required
+
+    @property
+    def completed(self):
+        """Hosts that reported DONE."""
+        return [h for h, s in self.status.items() if s is USRP_Control.CommandStatus.DONE]
+
+    @property
+    def late(self):
+        """Hosts that acknowledged the command but did not report DONE (yet)."""
+        return [h for h, s in self.status.items() if s is USRP_Control.CommandStatus.ACK]
+
+    @property
+    def failed(self):
+        """Hosts that reported an error, see errors for the messages."""
+        return list(self.errors)
+
+    @property
+    def missing(self):
+        """Hosts that did not reply at all."""
+        return [h for h, s in self.status.items() if s is USRP_Control.CommandStatus.RUNNING]
+
+    def ack(self, host):
+        """Mark host ACK and return True if its status changed."""
+        # a DONE may overtake its ACK; never move back from DONE
+        if self.status.get(host) is not USRP_Control.CommandStatus.RUNNING:
+            return False
+        self.status[host] = USRP_Control.CommandStatus.ACK
+        self.ack_at[host] = time.monotonic()
+        self.events.append((host, USRP_Control.CommandStatus.ACK))
+        return True
+
+    def complete(self, host, result=None):
+        """Mark host DONE and return True if it was the last outstanding host."""
+        if self.status.get(host) in (USRP_Control.CommandStatus.RUNNING, USRP_Control.CommandStatus.ACK):
+            self.results[host] = result or {}
+        return self._finish(host, USRP_Control.CommandStatus.DONE)
+
+    def fail(self, host, error):
+        """Mark host ERROR and return True if it was the last outstanding host."""
+        if self.status.get(host) not in (USRP_Control.CommandStatus.RUNNING, USRP_Control.CommandStatus.ACK):
+            return False
+        self.errors[host] = error
+        return self._finish(host, USRP_Control.CommandStatus.ERROR)
+
+    def _finish(self, host, status):
+        if self.status.get(host) not in (USRP_Control.CommandStatus.RUNNING, USRP_Control.CommandStatus.ACK):
+            return False
+        self.status[host] = status
+        self.events.append((host, status))
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.done_at = time.monotonic()
+            return True
+        return False